@@ -1,48 +1,26 @@
 from __future__ import annotations
 
+from typing import Any
+
 import idaapi
 
 import pyphrank.utils as utils
 import pyphrank.settings as settings
-from pyphrank.type_flow_graph_parts import SExpr, ASTCtx, Node, NOP_NODE
-from pyphrank.type_flow_graph_parts import Var, VarUse, VarUseChain, UNKNOWN_SEXPR
+import pyphrank.snapshot_lifter as snapshot_lifter
+import pyphrank.tfg_payload as tfg_payload
+from pyphrank.snapshot_lifter import CTreeSnapshot, SnapshotLifter, lift_snapshot
+from pyphrank.snapshot_lifter import CALL_REGULAR, CALL_MEMSET, CALL_IMPORT, CALL_HELPER
+from pyphrank.snapshot_lifter import HELPER_KNOWN, HELPER_PARTIAL, HELPER_COMBINE, HELPER_INTERLOCKED_ASG
+from pyphrank.snapshot_lifter import HELPER_INTERLOCKED_RV, HELPER_VA_ARG, HELPER_COERCE, HELPER_ADJ, HELPER_UNKNOWN
+from pyphrank.type_flow_graph_parts import SExpr, ASTCtx, Node
+from pyphrank.type_flow_graph_parts import Var, VarUse, VarUseChain
 from pyphrank.type_flow_graph import TFG
+from pyphrank.tfg_storage import TFGDecoder
 
 
-bool_operations = {
-	idaapi.cot_uge, idaapi.cot_sge,
-	idaapi.cot_sgt, idaapi.cot_eq, idaapi.cot_ne, idaapi.cot_slt,
-	idaapi.cot_land, idaapi.cot_sle, idaapi.cot_ult,
-	idaapi.cot_ule, idaapi.cot_lor, idaapi.cot_ugt,
-}
-
-binary_operations = {
-	idaapi.cot_mul, idaapi.cot_sub, idaapi.cot_bor, idaapi.cot_band,
-	idaapi.cot_sshr, idaapi.cot_ushr, idaapi.cot_shl, idaapi.cot_add,
-	idaapi.cot_sdiv, idaapi.cot_udiv, idaapi.cot_smod, idaapi.cot_umod,
-	idaapi.cot_xor,
-}
-
-fbinary_operations = {
-	idaapi.cot_fadd, idaapi.cot_fdiv, idaapi.cot_fmul, idaapi.cot_fsub,
-}
-
-unary_operations = {idaapi.cot_lnot, idaapi.cot_sizeof}
-
-keep_type_operations = bool_operations | fbinary_operations | unary_operations
-
-int_rw_operations = {
-	idaapi.cot_postdec, idaapi.cot_predec, idaapi.cot_preinc,
-	idaapi.cot_postinc,
-}
-
-value_rw_operations = {
-	idaapi.cot_asgadd, idaapi.cot_asgband, idaapi.cot_asgbor,
-	idaapi.cot_asgmul, idaapi.cot_asgsdiv, idaapi.cot_asgshl,
-	idaapi.cot_asgsmod, idaapi.cot_asgsshr, idaapi.cot_asgsub,
-	idaapi.cot_asgudiv, idaapi.cot_asgumod, idaapi.cot_asgushr,
-	idaapi.cot_asgxor,
-}
+assert tfg_payload.NODE_EXPR == Node.EXPR and tfg_payload.NODE_RETURN == Node.RETURN
+assert tfg_payload.NODE_CALL_CAST == Node.CALL_CAST and tfg_payload.NODE_TYPE_CAST == Node.TYPE_CAST
+assert tfg_payload.SEXPR_COMBINE == SExpr.TYPE_COMBINE and tfg_payload.VAR_REF == VarUse.VAR_REF
 
 segment_helpers = {
 	"__CS__", "__SS__", "__DS__",
@@ -165,6 +143,40 @@ interlocked_rv_helpers = {
 	"_InterlockedExchangeAdd64", "_InterlockedExchangeAdd128",
 }
 
+# helpers with these prefixes are lifted like known helpers
+known_helper_prefixes = ("_mm_", "_m_", "sys_")
+
+def create_helper2kind() -> dict[str,int]:
+	""" helper from earlier group wins, if it is in several groups """
+	helper2kind = {}
+	for helpers, kind in (
+		(known_helpers, HELPER_KNOWN),
+		(helper2offset, HELPER_PARTIAL),
+		(combine_helpers, HELPER_COMBINE),
+		(interlocked_asg_helpers, HELPER_INTERLOCKED_ASG),
+		(interlocked_rv_helpers, HELPER_INTERLOCKED_RV),
+		({"va_arg"}, HELPER_VA_ARG),
+		(coerces, HELPER_COERCE),
+		({"ADJ"}, HELPER_ADJ),
+	):
+		for helper in helpers:
+			helper2kind.setdefault(helper, kind)
+	return helper2kind
+
+# kinds of helper calls by helper name, helpers with known prefixes are not in it
+helper2kind = create_helper2kind()
+
+def get_helper_kind(helper:str) -> int:
+	if helper.startswith(known_helper_prefixes):
+		return HELPER_KNOWN
+	return helper2kind.get(helper, HELPER_UNKNOWN)
+
+# IDA op codes to snapshot op codes
+ida2snapshot_op = {
+	getattr(idaapi, name): op for name, op in snapshot_lifter.CTREE_OPS.items()
+	if hasattr(idaapi, name)
+}
+
 
 def is_known_call(func_expr:idaapi.cexpr_t, funcnames:set[str]) -> bool:
 	if func_expr.op != idaapi.cot_call:
@@ -195,308 +207,201 @@ def get_var(expr:idaapi.cexpr_t, actx:ASTCtx) -> Var|None:
 		return Var(expr.obj_ea)
 	return None
 
-def extract_vars(expr:idaapi.cexpr_t, actx:ASTCtx) -> set[Var]:
-	v = get_var(expr, actx)
-	if v is not None:
-		return {v}
-	vars = set()
-	if expr.x is not None:
-		vars.update(extract_vars(expr.x, actx))
-	if expr.y is not None:
-		vars.update(extract_vars(expr.y, actx))
-	if expr.z is not None:
-		vars.update(extract_vars(expr.z, actx))
-	if expr.op == idaapi.cot_call:
-		for a in expr.a:
-			vars.update(extract_vars(a, actx))
-	return vars
-
-def get_var_helper(expr:idaapi.cexpr_t, actx:ASTCtx) -> VarUseChain|None:
-	if expr.op != idaapi.cot_call or expr.x.op != idaapi.cot_helper or len(expr.a) != 1:
-		return None
-	if (offset := helper2offset.get(expr.x.helper)) is None:
-		return None
+def get_snapshot_var(varid:Any) -> Var:
+	""" Var of snapshot var, that is identified the same way as varid of Var """
+	if isinstance(varid, tuple):
+		return Var(*varid)
+	return Var(varid)
 
-	if (var := get_var(expr.a[0], actx)) is None:
-		return None
+def annotate_expr(expr:idaapi.cexpr_t, actx:ASTCtx) -> tuple[SnapshotLifter, int]:
+	""" Lifter of snapshot of expr, that has vars and var use chains of expr and its operands """
+	# only subtree of expr is taken, without types, that annotations do not need
+	builder = CTreeSnapshotBuilder(actx.addr, annotate_only=True)
+	snapshot_expr = builder.add_expr(expr)
+	return SnapshotLifter(builder.snapshot), snapshot_expr
 
-	return VarUseChain(var, VarUse(offset, VarUse.VAR_HELPER))
+def extract_vars(expr:idaapi.cexpr_t, actx:ASTCtx) -> set[Var]:
+	lifter, snapshot_expr = annotate_expr(expr, actx)
+	return {get_snapshot_var(v) for v in lifter.extract_vars(snapshot_expr)}
 
 def get_var_use_chain(expr:idaapi.cexpr_t, actx:ASTCtx) -> VarUseChain|None:
-	# FIXME
-	if expr.op == idaapi.cot_num:
+	lifter, snapshot_expr = annotate_expr(expr, actx)
+	if (vuc := lifter.get_var_use_chain(snapshot_expr)) is None:
 		return None
+	varid, uses = vuc
+	return VarUseChain(get_snapshot_var(varid), *(VarUse(offset, use_type) for offset, use_type in uses))
+
+
+class CTreeSnapshotBuilder:
+	"""
+	Takes snapshot of ctree, everything, that needs IDA, is resolved here
+	must be used in main thread, types of snapshot are kept in builder
+	ctree is walked without python recursion, so deeply nested ctrees do not hit recursion limit
+	with annotate_only types and call details are skipped, snapshot is good only for annotating exprs
+	"""
+	def __init__(self, func_ea:int, annotate_only=False):
+		self.annotate_only = annotate_only
+		self.snapshot = CTreeSnapshot(func_ea)
+		self.types : list[idaapi.tinfo_t] = []
+		self.objs : dict[int, tuple[int,bool,bool]] = {}
+
+	def build(self, body:idaapi.cinsn_t) -> tuple[CTreeSnapshot, list[idaapi.tinfo_t]]:
+		self.snapshot.int_type = self.add_type(utils.str2tif("int"))
+		self.snapshot.body = self.add_item(body, False)
+		return self.snapshot, self.types
+
+	def add_type(self, tif:idaapi.tinfo_t) -> int:
+		if tif is utils.UNKNOWN_TYPE:
+			return -1
+		self.types.append(tif)
+		return len(self.types) - 1
+
+	def get_obj(self, obj_ea:int) -> tuple[int,bool,bool]:
+		if (obj := self.objs.get(obj_ea)) is None:
+			obj = (obj_ea, utils.is_func_start(obj_ea), utils.is_func_import(obj_ea))
+			self.objs[obj_ea] = obj
+		return obj
+
+	def add_expr(self, expr:idaapi.cexpr_t) -> int:
+		return self.add_item(expr, True)
+
+	def add_item(self, item:Any, is_expr:bool) -> int:
+		"""
+		Adds expr or instr after all of its nested items, so operands are always before their exprs
+		returns index of item in snapshot
+		"""
+		# frames are [item, is_expr, nested items, indices of already added nested items]
+		stack = [[item, is_expr, self.get_nested(item, is_expr), []]]
+		while True:
+			item, is_expr, nested, added = stack[-1]
+			if len(added) < len(nested):
+				nested_item, nested_is_expr = nested[len(added)]
+				if nested_item is None:
+					added.append(-1)
+				else:
+					stack.append([nested_item, nested_is_expr, self.get_nested(nested_item, nested_is_expr), []])
+				continue
 
-	if (var := get_var(expr, actx)) is not None:
-		return VarUseChain(var)
-
-	if len(extract_vars(expr, actx)) != 1:
-		return None
-
-	expr = utils.strip_casts(expr)
-	if (var_helper := get_var_helper(expr, actx)) is not None:
-		return var_helper
-
-	op2use_type = {
-		idaapi.cot_ptr: VarUse.VAR_PTR,
-		idaapi.cot_memptr: VarUse.VAR_PTR,
-		idaapi.cot_memref: VarUse.VAR_REF,
-		idaapi.cot_ref: VarUse.VAR_REF,
-		idaapi.cot_idx: VarUse.VAR_PTR,
-		idaapi.cot_add: VarUse.VAR_ADD,
-		idaapi.cot_sub: VarUse.VAR_ADD,
-	}
-	use_type = op2use_type.get(expr.op)
-	if use_type is None:
-		return None
-
-	vuc = get_var_use_chain(expr.x, actx)
-	if vuc is None:
-		return None
-
-	var, use_chain = vuc.var, vuc.uses
-
-	if expr.op in [idaapi.cot_ptr, idaapi.cot_ref]:
-		offset = 0
-
-	elif expr.op in [idaapi.cot_memptr, idaapi.cot_memref]:
-		offset = expr.m
-
-	elif expr.op in [idaapi.cot_idx, idaapi.cot_add, idaapi.cot_sub]:
-		offset = utils.get_int(expr.y)
-		if offset is None:
-			return None
-		if expr.op == idaapi.cot_sub:
-			offset = -offset
-		if expr.x.type.is_ptr():
-			pointed = expr.x.type.get_pointed_object()
-			offset *= pointed.get_size()
-
-	# this should not happen at all, since expr op is check when use_type gets got
-	else:
-		raise Exception("Wut")
-
-	var_use = VarUse(offset, use_type)
-	use_chain.append(var_use)
-	return VarUseChain(var, *use_chain)
-
-
-def is_exit_node(node:Node) -> bool:
-	return len(node.children) == 0 and not node.is_return()
-
-def iterate_exit_nodes(node:Node):
-	if is_exit_node(node):
-		yield node
-		return
-
-	for child in node.iterate_children():
-		if is_exit_node(child):
-			yield child
-
-def chain_trees(*nodes:Node):
-	if len(nodes) < 2:
-		return
-
-	for i in range(len(nodes) - 1):
-		parent = nodes[i]
-		child = nodes[i + 1]
-		# must collect first, and then add new links
-		for exit in [e for e in iterate_exit_nodes(parent)]:
-			exit.children.add(child)
-			child.parents.add(exit)
-
-def chain_nodes(*nodes:Node):
-	if len(nodes) < 2:
-		return
-
-	for i in range(len(nodes) - 1):
-		parent = nodes[i]
-		child = nodes[i + 1]
-		parent.children.add(child)
-		child.parents.add(parent)
-
-
-class CTreeAnalyzer:
-	def __init__(self, cfunc:idaapi.cfunc_t):
-		self.cfunc = cfunc
-		self.actx = ASTCtx.from_cfunc(cfunc)
-
-	def lift_cfunc(self) -> TFG:
-		entry = self.lift_instr(self.cfunc.body)
-		return TFG(entry)
-
-	def lift_instr(self, cinstr) -> Node:
-		if cinstr.op == idaapi.cit_expr:
-			entry, _ = self.lift_cexpr(cinstr.cexpr)
-		elif cinstr.op == idaapi.cit_block:
-			instr_entries = [self.lift_instr(i) for i in cinstr.cblock]
-			entry = instr_entries[0]
-			chain_trees(*instr_entries)
-		elif cinstr.op == idaapi.cit_if:
-			entry, exit = self.lift_cexpr(cinstr.cif.expr)
-			ithen = self.lift_instr(cinstr.cif.ithen)
-			if cinstr.cif.ielse is not None:
-				ielse = self.lift_instr(cinstr.cif.ielse)
+			stack.pop()
+			if is_expr:
+				idx = self.make_expr(item, added)
 			else:
-				ielse = NOP_NODE.copy()
-			chain_nodes(exit, ithen)
-			chain_nodes(exit, ielse)
-		elif cinstr.op == idaapi.cit_for:
-			entry, init_end = self.lift_cexpr(cinstr.cfor.init)
-			expr_start, _ = self.lift_cexpr(cinstr.cfor.expr)
-			step_start, _ = self.lift_cexpr(cinstr.cfor.step)
-			cfor_entry = self.lift_instr(cinstr.cfor.body)
-			chain_trees(init_end, expr_start, cfor_entry, step_start)
-		elif cinstr.op == idaapi.cit_while:
-			entry, exit = self.lift_cexpr(cinstr.cwhile.expr)
-			cwhile_entry = self.lift_instr(cinstr.cwhile.body)
-			chain_nodes(exit, cwhile_entry)
-		elif cinstr.op == idaapi.cit_do:
-			sexpr_entry = self.lift_cexpr(cinstr.cdo.expr)[0]
-			entry = self.lift_instr(cinstr.cdo.body)
-			chain_trees(entry, sexpr_entry)
-		elif cinstr.op == idaapi.cit_return:
-			entry, exit = self.lift_cexpr(cinstr.creturn.expr)
-			exit.node_type = Node.RETURN
-		elif cinstr.op == idaapi.cit_switch:
-			# cinstr.cswitch.cases + cinstr.cswitch.expr
-			entry = NOP_NODE.copy()
-		elif cinstr.op in (idaapi.cit_asm, idaapi.cit_empty, idaapi.cit_goto, idaapi.cit_end, idaapi.cit_break, idaapi.cit_continue):
-			entry = NOP_NODE.copy()
+				idx = self.make_instr(item, added)
+			if len(stack) == 0:
+				return idx
+			stack[-1][3].append(idx)
+
+	def get_nested(self, item:Any, is_expr:bool) -> list[tuple[Any,bool]]:
+		""" nested items in order of adding them, None is for missing ones """
+		if is_expr:
+			nested = [(item.x, True), (item.y, True), (item.z, True)]
+			if item.op == idaapi.cot_call:
+				nested.extend((arg, True) for arg in item.a)
+			return nested
+
+		op = item.op
+		if op == idaapi.cit_expr:
+			return [(item.cexpr, True)]
+		elif op == idaapi.cit_block:
+			return [(i, False) for i in item.cblock]
+		elif op == idaapi.cit_if:
+			cif = item.cif
+			return [(cif.expr, True), (cif.ithen, False), (cif.ielse, False)]
+		elif op == idaapi.cit_for:
+			cfor = item.cfor
+			return [(cfor.init, True), (cfor.expr, True), (cfor.step, True), (cfor.body, False)]
+		elif op == idaapi.cit_while:
+			return [(item.cwhile.expr, True), (item.cwhile.body, False)]
+		elif op == idaapi.cit_do:
+			return [(item.cdo.expr, True), (item.cdo.body, False)]
+		elif op == idaapi.cit_return:
+			return [(item.creturn.expr, True)]
+		return []
+
+	def make_expr(self, expr:idaapi.cexpr_t, operands:list[int]) -> int:
+		op = ida2snapshot_op.get(expr.op, snapshot_lifter.cot_unknown)
+		x, y, z = operands[:3]
+		if op in snapshot_lifter.literal_type_operations and not self.annotate_only:
+			type_id = self.add_type(expr.type)
 		else:
-			entry = NOP_NODE.copy()
-			utils.log_err(f"unknown instr operand {cinstr.opname}")
+			type_id = -1
+
+		ea = expr.ea
+		if ea == idaapi.BADADDR:
+			ea = -1
+		extra = self.get_extra(expr, op, tuple(operands[3:]))
+		self.snapshot.exprs.append((op, ea, x, y, z, type_id, extra))
+		return len(self.snapshot.exprs) - 1
+
+	def make_instr(self, cinstr:idaapi.cinsn_t, nested:list[int]) -> int:
+		op = ida2snapshot_op.get(cinstr.op, snapshot_lifter.cit_unknown)
+		if op in (snapshot_lifter.cit_expr, snapshot_lifter.cit_return):
+			extra = nested[0]
+		elif op in (snapshot_lifter.cit_block, snapshot_lifter.cit_if, snapshot_lifter.cit_for, snapshot_lifter.cit_while, snapshot_lifter.cit_do):
+			extra = tuple(nested)
+		elif op == snapshot_lifter.cit_unknown:
+			extra = cinstr.opname
+		else:
+			extra = None
+
+		self.snapshot.instrs.append((op, cinstr.ea, extra))
+		return len(self.snapshot.instrs) - 1
+
+	def get_extra(self, expr:idaapi.cexpr_t, op:int, args:tuple[int, ...]):
+		if op == snapshot_lifter.cot_var:
+			return expr.v.idx
+		elif op == snapshot_lifter.cot_obj:
+			return self.get_obj(expr.obj_ea)
+		elif op == snapshot_lifter.cot_num:
+			return expr.n._value
+		elif op == snapshot_lifter.cot_sizeof:
+			return expr.x.type.get_size()
+		elif op == snapshot_lifter.cot_helper:
+			return expr.helper, expr.helper in segment_helpers
+		elif op == snapshot_lifter.cot_memptr:
+			return expr.m
+		elif op == snapshot_lifter.cot_memref:
+			return expr.m, expr.type.is_union()
+		elif op in (snapshot_lifter.cot_idx, snapshot_lifter.cot_add, snapshot_lifter.cot_sub):
+			# pointed object size for pointer arithmetics
+			ptr_size = None
+			if expr.x.type.is_ptr():
+				ptr_size = expr.x.type.get_pointed_object().get_size()
+			if op == snapshot_lifter.cot_idx:
+				return ptr_size, expr.y.type.is_integral()
+			return ptr_size
+		elif op == snapshot_lifter.cot_call:
+			return self.get_call(expr, args)
+		elif op == snapshot_lifter.cot_unknown:
+			return expr.opname
+		return None
 
-		return entry
+	def get_call(self, expr:idaapi.cexpr_t, args:tuple[int, ...]) -> tuple:
+		if self.annotate_only:
+			# only partial helpers make var use chains of calls
+			if expr.x.op == idaapi.cot_helper and get_helper_kind(expr.x.helper) == HELPER_PARTIAL:
+				return (CALL_HELPER, args, *self.get_helper_call(expr))
+			return (CALL_REGULAR, args)
 
-	def lift_cexpr(self, expr:idaapi.cexpr_t) -> tuple[Node,Node]:
-		"""
-		returns tuple (tree_start, tree_end)
-		tree_end holds type of final expr
-		tree_start can be the same as tree_end
-		"""
-		while expr.op == idaapi.cot_cast:
-			expr = expr.x
-
-		trees = []
-
-		def lift_reuse(expr:idaapi.cexpr_t) -> SExpr:
-			"""
-			get a tree and later reuse sexpr of end node
-			if start and end are the same, then reusing both of them and no start is return
-			if start and end are different, then add start to trees to chain later
-			"""
-			s,e = self.lift_cexpr(expr)
-			if s is not e:
-				e.remove_node()
-				trees.append(s)
-			return e.sexpr
-
-		def append_expr(expr:SExpr):
-			node = Node(Node.EXPR, expr)
-			trees.append(node)
-
-		def lift_append(expr:idaapi.cexpr_t) -> Node:
-			s, e = self.lift_cexpr(expr)
-			trees.append(s)
-			return e
-
-		if expr.op == idaapi.cot_asg:
-			target = lift_reuse(expr.x)
-			value = lift_reuse(expr.y)
-			type_expr = SExpr.create_assign(target, value)
-
-		elif is_known_call(expr, settings.MEMSET_FUNCS):
+		func_type = expr.x.type
+		if is_known_call(expr, settings.MEMSET_FUNCS):
 			arr_size = utils.get_int(expr.a[2])
 			if arr_size != -1:
 				arg0_type = utils.str2tif(f"char [{arr_size}]")
 			else:
-				arg0_type = expr.x.type.get_nth_arg(1)
-			arg_cast = Node(Node.TYPE_CAST, lift_reuse(expr.a[0]), arg0_type)
-			trees.append(arg_cast)
-			arg_cast = Node(Node.TYPE_CAST, lift_reuse(expr.a[1]), expr.x.type.get_nth_arg(1))
-			trees.append(arg_cast)
-			arg_cast = Node(Node.TYPE_CAST, lift_reuse(expr.a[2]), expr.x.type.get_nth_arg(2))
-			trees.append(arg_cast)
-			type_expr = SExpr.create_type_literal(expr.x.type.get_rettype())
-
-		elif expr.op == idaapi.cot_call and expr.x.op == idaapi.cot_helper:
-			helper = expr.x.helper
-			if helper in known_helpers or helper.startswith("_mm_") or helper.startswith("_m_") or helper.startswith("sys_"):
-				for i, arg in enumerate(expr.a):
-					arg_sexpr = lift_reuse(arg)
-					arg_cast = Node(Node.TYPE_CAST, arg_sexpr, expr.x.type.get_nth_arg(i))
-					trees.append(arg_cast)
-				type_expr = SExpr.create_type_literal(expr.x.type.get_rettype())
-
-			elif helper in helper2offset:
-				arg = lift_reuse(expr.a[0])
-				offset = helper2offset[helper]
-				size = helper2size[helper]
-				# when offseting from top
-				if offset < 0:
-					offset = expr.a[0].type.get_size() + offset
-				type_expr = SExpr.create_partial(arg, offset, size)
-
-			elif helper in combine_helpers:
-				arg0 = lift_reuse(expr.a[0])
-				arg1 = lift_reuse(expr.a[1])
-				type_expr = SExpr.create_combine(arg0, arg1)
-
-			elif helper in interlocked_asg_helpers:
-				# if cmp xchg, then more info can be gained from comparand
-				if len(expr.a) == 3:
-					lift_append(expr.a[2])
-
-				target = lift_reuse(expr.a[0])
-				target = SExpr.create_ptr(target, expr.a[0].ea)
-				value = lift_reuse(expr.a[1])
-				asg = SExpr.create_assign(target, value, expr.ea)
-				append_expr(asg)
-				type_expr = SExpr.create_type_literal(expr.type.get_rettype())
-
-			elif helper in interlocked_rv_helpers:
-				target = lift_reuse(expr.a[0])
-				target = SExpr.create_ptr(target, expr.a[0].ea)
-				if len(expr.a) > 1:
-					value = lift_reuse(expr.a[1])
-				else:
-					value = SExpr.create_type_literal(utils.str2tif("int"))
-				op = SExpr.create_rw_op(target, value, expr.ea)
-				append_expr(op)
-				type_expr = SExpr.create_type_literal(expr.type.get_rettype())
-
-			elif helper == "va_arg":
-				arg_sexpr = lift_reuse(expr.a[0])
-				arg_cast = Node(Node.TYPE_CAST, arg_sexpr, expr.x.type.get_nth_arg(0))
-				trees.append(arg_cast)
-				type_expr = SExpr.create_type_literal(expr.x.type.get_rettype())
-
-			# casts are skipped
-			elif helper in coerces:
-				type_expr = lift_reuse(expr.a[0])
-
-			elif helper == "ADJ":
-				arg = expr.a[0]
-				base, offset = utils.get_shifted_base(arg.type)
-				if base is None:
-					utils.log_err(f"failed to get shifted offset of type={arg.type} {utils.expr2str(expr)} in {idaapi.get_name(self.actx.addr)}")
-					type_expr = UNKNOWN_SEXPR
-				elif arg.op == idaapi.cot_var:
-					var = Var(utils.get_func_start(expr.ea), arg.v)
-					var_use = VarUse(offset, VarUse.VAR_ADD)
-					vuc = VarUseChain(var, var_use)
-					type_expr = SExpr.create_var_use_chain(vuc)
-				else:
-					sexpr = lift_reuse(arg)
-					i = SExpr.create_type_literal(utils.str2tif("int"))
-					type_expr = SExpr.create_binary_op(sexpr, i)
-
-			else:
-				utils.log_warn(f"failed to lift helper call {utils.expr2str(expr)} in {idaapi.get_name(self.actx.addr)}")
-				type_expr = UNKNOWN_SEXPR
-
-		elif expr.op == idaapi.cot_call and expr.x.op == idaapi.cot_obj and utils.is_func_import(expr.x.obj_ea):
+				arg0_type = func_type.get_nth_arg(1)
+			return (
+				CALL_MEMSET, args,
+				self.add_type(arg0_type),
+				self.add_type(func_type.get_nth_arg(1)),
+				self.add_type(func_type.get_nth_arg(2)),
+				self.add_type(func_type.get_rettype()),
+			)
+
+		if expr.x.op == idaapi.cot_helper:
+			return (CALL_HELPER, args, *self.get_helper_call(expr))
+
+		if expr.x.op == idaapi.cot_obj and self.get_obj(expr.x.obj_ea)[2]:
 			func_tif = idaapi.tinfo_t()
 			rv = idaapi.get_type(expr.x.obj_ea, func_tif, 0)
 			if not rv:
@@ -509,130 +414,70 @@ class CTreeAnalyzer:
 				retval_tif = func_tif.get_rettype()
 			else:
 				retval_tif = utils.UNKNOWN_TYPE
-			type_expr = SExpr.create_type_literal(retval_tif, expr.x.ea)
-
-			for arg_id, arg in enumerate(expr.a):
-				arg = utils.strip_casts(arg)
-				arg_sexpr = lift_reuse(arg)
-				arg_type = func_tif.get_nth_arg(arg_id)
-				type_cast = Node(Node.TYPE_CAST, arg_sexpr, arg_type)
-				trees.append(type_cast)
-
-		elif expr.op == idaapi.cot_call:
-			call_func = lift_reuse(expr.x)
-			for arg_id, arg in enumerate(expr.a):
-				arg = utils.strip_casts(arg)
-				arg_sexpr = lift_reuse(arg)
-				call_cast = Node(Node.CALL_CAST, arg_sexpr, arg_id, call_func)
-				trees.append(call_cast)
-			type_expr = SExpr.create_call(call_func)
-
-		# AST literals become type literals
-		elif expr.op in (idaapi.cot_num, idaapi.cot_fnum, idaapi.cot_str):
-			type_expr = SExpr.create_type_literal(expr.type)
-
-		elif expr.op == idaapi.cot_obj and (utils.is_func_start(expr.obj_ea) or utils.is_func_import(expr.obj_ea)):
-			type_expr = SExpr.create_function(expr.obj_ea)
-
-		elif (vuc := get_var_use_chain(expr, self.actx)) is not None:
-			type_expr = SExpr.create_var_use_chain(vuc)
-
-		# operations, that create type literal SExpr as result
-		elif expr.op in keep_type_operations:
-			if expr.x is not None:
-				lift_append(expr.x)
-			if expr.y is not None:
-				lift_append(expr.y)
-			type_expr = SExpr.create_type_literal(expr.type)
-
-		elif expr.op in int_rw_operations:
-			target = lift_reuse(expr.x)
-			value = SExpr.create_type_literal(utils.str2tif("int"))
-			type_expr = SExpr.create_rw_op(target, value)
-
-		# -expr and ~expr do not change type
-		elif expr.op in (idaapi.cot_neg, idaapi.cot_bnot, idaapi.cot_fneg):
-			type_expr = lift_reuse(expr.x)
-
-		elif expr.op == idaapi.cot_tern:
-			lift_append(expr.x)
-			x = lift_reuse(expr.y)
-			y = lift_reuse(expr.z)
-			type_expr = SExpr.create_tern(x, y)
-
-		elif expr.op in value_rw_operations:
-			target = lift_reuse(expr.x)
-			value = lift_reuse(expr.y)
-			type_expr = SExpr.create_rw_op(target, value)
-
-		elif expr.op == idaapi.cot_ref:
-			base = lift_reuse(expr.x)
-			type_expr = SExpr.create_ref(base)
-
-		elif expr.op == idaapi.cot_ptr:
-			base = lift_reuse(expr.x)
-			type_expr = SExpr.create_ptr(base)
-
-		elif expr.op in binary_operations:
-			x = lift_reuse(expr.x)
-			y = lift_reuse(expr.y)
-			type_expr = SExpr.create_binary_op(x, y)
-
-		elif expr.op == idaapi.cot_empty:
-			type_expr = UNKNOWN_SEXPR
-
-		elif expr.op == idaapi.cot_idx:
-			arr = lift_reuse(expr.x)
-			idx = lift_reuse(expr.y)
-			if expr.x.type.is_ptr() and expr.y.type.is_integral(): # pointer arithmetics
-				i = SExpr.create_type_literal(utils.str2tif("int"), expr.x.ea)
-				idx = SExpr.create_binary_op(idx, i, expr.x.ea)
-			add_expr = SExpr.create_binary_op(arr, idx, expr.x.ea)
-			type_expr = SExpr.create_ptr(add_expr)
-
-		elif expr.op == idaapi.cot_comma:
-			lift_append(expr.x)
-			type_expr = lift_reuse(expr.y)
-
-		elif expr.op == idaapi.cot_memptr:
-			mem = lift_reuse(expr.x)
-			type_expr = SExpr.create_ptr(mem, expr.m)
-
-		elif expr.op == idaapi.cot_memref:
-			sexpr = lift_reuse(expr.x)
-			if sexpr.is_type_literal():
-				type_expr = SExpr.create_type_literal(expr.type)
-
-			# selecting union's field
-			elif expr.type.is_union():
-				type_expr = sexpr
-
-			# expr.type.is_struct()
-			# selecting structure's field
-			else:
-				i = SExpr.create_type_literal(utils.str2tif("int"))
-				type_expr = SExpr.create_binary_op(sexpr, i)
+			arg_types = tuple(self.add_type(func_tif.get_nth_arg(i)) for i in range(len(args)))
+			return (CALL_IMPORT, args, self.add_type(retval_tif), arg_types)
 
-		elif expr.op == idaapi.cot_helper and expr.helper in segment_helpers:
-			type_expr = SExpr.create_type_literal(expr.type)
+		return (CALL_REGULAR, args)
 
-		# rogue stack reads
-		elif expr.op == idaapi.cot_helper and expr.helper.startswith("STACK[0x"):
-			type_expr = UNKNOWN_SEXPR
+	def get_helper_call(self, expr:idaapi.cexpr_t) -> tuple:
+		helper = expr.x.helper
+		func_type = expr.x.type
+		helper_kind = get_helper_kind(helper)
+		if helper_kind == HELPER_KNOWN:
+			arg_types = tuple(self.add_type(func_type.get_nth_arg(i)) for i in range(len(expr.a)))
+			return HELPER_KNOWN, arg_types, self.add_type(func_type.get_rettype())
 
-		elif expr.op == idaapi.cot_type:
-			type_expr = SExpr.create_type_literal(expr.type)
+		elif helper_kind == HELPER_PARTIAL:
+			offset = helper2offset[helper]
+			# when offseting from top
+			top_offset = offset
+			if offset < 0:
+				top_offset = expr.a[0].type.get_size() + offset
+			return HELPER_PARTIAL, offset, top_offset, helper2size[helper]
 
-		else:
-			utils.log_warn(f"failed to lift {expr.opname} {utils.expr2str(expr)} in {idaapi.get_name(self.actx.addr)}")
-			type_expr = UNKNOWN_SEXPR
-
-		addr = expr.ea
-		if addr == idaapi.BADADDR:
-			addr = -1
-		type_expr.addr = addr
-		type_node = Node(Node.EXPR, type_expr)
-		trees.append(type_node)
-		start = trees[0]
-		chain_trees(*trees)
-		return start, type_node
\ No newline at end of file
+		elif helper_kind in (HELPER_INTERLOCKED_ASG, HELPER_INTERLOCKED_RV):
+			return helper_kind, self.add_type(expr.type.get_rettype())
+
+		elif helper_kind == HELPER_VA_ARG:
+			return HELPER_VA_ARG, self.add_type(func_type.get_nth_arg(0)), self.add_type(func_type.get_rettype())
+
+		elif helper_kind in (HELPER_COMBINE, HELPER_COERCE):
+			return (helper_kind,)
+
+		elif helper_kind == HELPER_ADJ:
+			arg = expr.a[0]
+			base, offset = utils.get_shifted_base(arg.type)
+			if base is None:
+				return HELPER_ADJ, None, f"failed to get shifted offset of type={arg.type} {utils.expr2str(expr)} in {idaapi.get_name(self.snapshot.func_ea)}"
+			return HELPER_ADJ, offset, utils.get_func_start(expr.ea)
+
+		return HELPER_UNKNOWN, f"failed to lift helper call {utils.expr2str(expr)} in {idaapi.get_name(self.snapshot.func_ea)}"
+
+
+def take_snapshot(cfunc:idaapi.cfunc_t) -> tuple[CTreeSnapshot, list[idaapi.tinfo_t]]:
+	return CTreeSnapshotBuilder(cfunc.entry_ea).build(cfunc.body)
+
+def decode_lifted(result:tuple[tuple, list[tuple[int,str]]], types:list[idaapi.tinfo_t]) -> TFG:
+	""" TFG of result of lift_snapshot, messages of lifting are logged here """
+	payload, messages = result
+	for level, msg in messages:
+		utils.get_logger().log(level, msg)
+	return TFGDecoder(payload, types).decode()
+
+
+class CTreeAnalyzer:
+	"""
+	Lifts cfunc into shrunk compact TFG in main thread
+	lifting rules are in SnapshotLifter, so TFG is the same as the one from lifting workers
+	with only_vars lifting is partial, only instrs exprs, that mention these vars, are lifted
+	"""
+	def __init__(self, cfunc:idaapi.cfunc_t, only_vars:frozenset[Var]|None=None):
+		self.cfunc = cfunc
+		self.only_vars = only_vars
+
+	def lift_cfunc(self) -> TFG:
+		snapshot, types = take_snapshot(self.cfunc)
+		only_vars = None
+		if self.only_vars is not None:
+			only_vars = frozenset(var.varid for var in self.only_vars)
+		return decode_lifted(lift_snapshot(snapshot, only_vars), types)
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 import idaapi
+from collections import OrderedDict
+from typing import Callable, Iterable
 
 import pyphrank.settings as settings
 import pyphrank.utils as utils
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.decompilation_records import DecompilationRecords
 
 def should_skip_decompiling(func_ea:int) -> bool:
 	fname = idaapi.get_name(func_ea)
@@ -25,60 +29,202 @@ def should_skip_decompiling(func_ea:int) -> bool:
 	return False
 
 
+class CFuncCacheStats:
+	""" Counters of cfunc cache to tune its budget """
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.failed_hits = 0
+		self.evictions = 0
+
+	def __str__(self) -> str:
+		return f"hits {self.hits} misses {self.misses} failed hits {self.failed_hits} evictions {self.evictions}"
+
+
+# entry of call graph, it is not an address of any function
+CALL_GRAPH_ROOT = -1
+
+# ctree, lvars and their types take hundreds of bytes for every instruction
+CFUNC_BYTES_PER_CODE_BYTE = 128
+
+def estimate_cfunc_size(cfunc:idaapi.cfunc_t) -> int:
+	""" Rough size of cfunc in memory, ctree grows with function code """
+	pfn = idaapi.get_func(cfunc.entry_ea)
+	if pfn is None:
+		return CFUNC_BYTES_PER_CODE_BYTE
+	return idaapi.calc_func_size(pfn) * CFUNC_BYTES_PER_CODE_BYTE
+
+
 class CFunctionFactory:
+	"""
+	Decompiles functions and keeps cfuncs in LRU cache, that is bounded by settings
+	pinned functions are never evicted, failed decompilations are remembered separately
+	and, together with bugged ones, are saved into IDB for next sessions
+	"""
 	def __init__(self) -> None:
-		self.cached_cfuncs:dict[int, idaapi.cfunc_t] = {}
+		# least recently used cfuncs are first
+		self.cached_cfuncs : OrderedDict[int, idaapi.cfunc_t] = OrderedDict()
+		self.cached_sizes : dict[int, int] = {}
+		self.cached_bytes = 0
+		self.failed_decompilations : set[int] = set()
+		self.pinned : set[int] = set()
+		# functions, that were decompiled after their callees, so their callees are not walked again
+		# even if their cfuncs got evicted since then
+		self.decompiled_bottom_up : set[int] = set()
+		self.decompilation_records = DecompilationRecords()
+		self.stats = CFuncCacheStats()
 
 	def get_cfunc(self, func_ea:int) -> idaapi.cfunc_t|None:
 		cfunc = self.cached_cfuncs.get(func_ea)
-		if isinstance(cfunc, idaapi.cfunc_t):
+		if cfunc is not None:
+			self.cached_cfuncs.move_to_end(func_ea)
+			self.stats.hits += 1
 			return cfunc
 
-		if not settings.DECOMPILE_RECURSIVELY:
-			cfunc = utils.decompile_function(func_ea)
-			# -1 (instead of None) to cache failed decompilation
-			if cfunc is None:
-				cfunc = -1
-			self.cached_cfuncs[func_ea] = cfunc
-			if cfunc == -1:
-				return None
-			else:
-				return cfunc
+		if func_ea in self.failed_decompilations:
+			self.stats.failed_hits += 1
+			return None
 
-		decompilation_queue = [func_ea]
-		while len(decompilation_queue) != 0:
-			func_ea = decompilation_queue[-1]
-			new_functions_to_decompile = set()
-			for subcall in utils.get_func_calls_from(func_ea):
-				if subcall in self.cached_cfuncs:
+		if settings.DECOMPILE_RECURSIVELY and func_ea not in self.decompiled_bottom_up:
+			# function is decompiled last, but cap might stop decompilations before it
+			self.decompile_bottom_up([func_ea])
+			if (cfunc := self.cached_cfuncs.get(func_ea)) is not None or func_ea in self.failed_decompilations:
+				return cfunc
+		return self.decompile(func_ea)
+
+	def build_call_graph(self, func_eas:list[int], max_functions:int=0) -> tuple[CompactGraph, set[int]]:
+		"""
+		Graph of calls between functions and their callees, that are not decompiled yet
+		entry is CALL_GRAPH_ROOT, that calls every function from the list
+		with max_functions graph stops growing, when it has that many functions
+		returns graph and functions, whose callees did not fit into it
+		"""
+		added = set(func_eas)
+		truncated : set[int] = set()
+		def get_callees(func_ea:int) -> Iterable[int]:
+			if func_ea == CALL_GRAPH_ROOT:
+				return func_eas
+			# calls to the same function are a single edge
+			callees : dict[int, None] = {}
+			for callee in utils.get_func_calls_from(func_ea):
+				if callee in callees or self.is_cached(callee) or callee in self.decompiled_bottom_up:
 					continue
-				if subcall in decompilation_queue:
+				if callee not in added:
+					if max_functions > 0 and len(added) >= max_functions:
+						truncated.add(func_ea)
+						continue
+					added.add(callee)
+				callees[callee] = None
+			return callees
+		return CompactGraph.from_entry(CALL_GRAPH_ROOT, get_callees), truncated
+
+	def decompile_bottom_up(self, func_eas:list[int], max_decompilations:int|None=None, progress:Callable[[int, int], None]|None=None):
+		"""
+		Decompile functions and everything they call, callees before their callers
+		call graph is built once and condensed into SCCs, that are decompiled in reverse topological order
+		progress gets numbers of done and all functions to decompile
+		"""
+		if max_decompilations is None:
+			max_decompilations = settings.MAX_RECURSIVE_DECOMPILATIONS
+		func_eas = [func_ea for func_ea in func_eas if not self.is_cached(func_ea)]
+		if len(func_eas) == 0:
+			return
+
+		# requested functions are decompiled even if there are more of them, than the limit
+		max_functions = max(max_decompilations, len(func_eas)) if max_decompilations > 0 else 0
+		graph, truncated = self.build_call_graph(func_eas, max_functions)
+		if len(truncated) != 0:
+			utils.log_warn(f"recursive decompilation is limited to {max_decompilations} functions, callees of {len(truncated)} functions are skipped")
+
+		total = len(graph) - 1
+		done = 0
+		for component in graph.get_sccs():
+			for node_id in component:
+				func_ea = graph.nodes[node_id]
+				if func_ea == CALL_GRAPH_ROOT or self.is_cached(func_ea):
 					continue
-				new_functions_to_decompile.add(subcall)
-
-			if len(new_functions_to_decompile) == 0:
-				cfunc = utils.decompile_function(func_ea)
-				if cfunc is None: 
-					cfunc = -1
-				self.cached_cfuncs[func_ea] = cfunc
-				decompilation_queue.pop()
-			else:
-				decompilation_queue += list(new_functions_to_decompile)
-
-		cfunc = self.cached_cfuncs.get(func_ea)
-		if cfunc == -1:
-			cfunc = None
+				self.decompile(func_ea)
+				if func_ea not in truncated:
+					self.decompiled_bottom_up.add(func_ea)
+				done += 1
+				if progress is not None:
+					progress(done, total)
+
+	def decompile(self, func_ea:int) -> idaapi.cfunc_t|None:
+		self.stats.misses += 1
+		fingerprint = b''
+		reason = None
+		if settings.PERSISTENT_DECOMPILATION_RECORDS:
+			fingerprint = utils.get_func_fingerprint(func_ea)
+			reason = self.decompilation_records.load(func_ea, fingerprint)
+
+		if reason is not None and reason != utils.CFUNC_BUGGED:
+			utils.log_debug(f"skipping decompilation of {idaapi.get_name(func_ea)}, because of {reason}")
+			self.failed_decompilations.add(func_ea)
+			return None
+
+		known_bugged = reason is not None
+		cfunc, reason = utils.decompile_function(func_ea, settings.DECOMPILE_GENERATE_TEXT, known_bugged)
+		if settings.PERSISTENT_DECOMPILATION_RECORDS and reason != "":
+			self.decompilation_records.save(func_ea, fingerprint, reason)
+
+		if cfunc is None:
+			self.failed_decompilations.add(func_ea)
+			return None
+
+		self.set_cfunc(cfunc)
 		return cfunc
 
+	def is_cached(self, func_ea:int) -> bool:
+		return func_ea in self.cached_cfuncs or func_ea in self.failed_decompilations
+
 	def clear_cfunc(self, func_ea:int) -> None:
-		self.cached_cfuncs.pop(func_ea, None)
+		self.failed_decompilations.discard(func_ea)
+		if self.cached_cfuncs.pop(func_ea, None) is not None:
+			self.cached_bytes -= self.cached_sizes.pop(func_ea)
 
 	def set_cfunc(self, cfunc:idaapi.cfunc_t):
-		self.cached_cfuncs[cfunc.entry_ea] = cfunc
-
-	def decompile_all(self):
-		saved_decomp = settings.DECOMPILE_RECURSIVELY
-		settings.DECOMPILE_RECURSIVELY = True
-		for func_ea in utils.iterate_all_functions():
-			self.get_cfunc(func_ea)
-		settings.DECOMPILE_RECURSIVELY = saved_decomp
\ No newline at end of file
+		func_ea = cfunc.entry_ea
+		self.clear_cfunc(func_ea)
+		size = estimate_cfunc_size(cfunc)
+		self.cached_cfuncs[func_ea] = cfunc
+		self.cached_sizes[func_ea] = size
+		self.cached_bytes += size
+		self.evict()
+
+	def pin(self, func_ea:int):
+		""" Keep cfunc of function in cache until it is unpinned, e.g. while it is analyzed """
+		self.pinned.add(func_ea)
+
+	def unpin_all(self):
+		self.pinned.clear()
+		self.evict()
+
+	def is_over_budget(self, entries:int, cached_bytes:int) -> bool:
+		if settings.CFUNC_CACHE_MAX_ENTRIES > 0 and entries > settings.CFUNC_CACHE_MAX_ENTRIES:
+			return True
+		if settings.CFUNC_CACHE_MAX_BYTES > 0 and cached_bytes > settings.CFUNC_CACHE_MAX_BYTES:
+			return True
+		return False
+
+	def evict(self):
+		""" Drop least recently used cfuncs, that are not pinned, until cache fits into budget """
+		entries = len(self.cached_cfuncs)
+		cached_bytes = self.cached_bytes
+		evicted = []
+		for func_ea in self.cached_cfuncs:
+			if not self.is_over_budget(entries, cached_bytes):
+				break
+			if func_ea in self.pinned:
+				continue
+			evicted.append(func_ea)
+			entries -= 1
+			cached_bytes -= self.cached_sizes[func_ea]
+
+		for func_ea in evicted:
+			self.clear_cfunc(func_ea)
+		self.stats.evictions += len(evicted)
+
+	def decompile_all(self, progress:Callable[[int, int], None]|None=None):
+		self.decompile_bottom_up(list(utils.iterate_all_functions()), max_decompilations=0, progress=progress)
+		utils.log_info(f"decompiled all functions, {utils.DECOMPILATION_STATS}, cfunc cache {self.stats}")
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+from array import array
+from typing import Any, Callable, Iterable
+
+
+def pack_adjacency(adjacency:list[list[int]]) -> tuple[array,array]:
+	"""
+	packs list of per-node edge lists into CSR offset/target arrays
+	edges of node i are targets[offsets[i]:offsets[i+1]]
+	"""
+	offsets = array('i', [0])
+	targets = array('i')
+	for edges in adjacency:
+		targets.extend(edges)
+		offsets.append(len(targets))
+	return offsets, targets
+
+
+class CompactGraph:
+	"""
+	Immutable directed graph with dense integer node ids
+	nodes are stored in BFS order from entry, entry always has id 0
+	edges are stored in CSR-style offset/target arrays for both directions
+	"""
+	def __init__(self, nodes:list[Any], children:list[list[int]], node2id:dict[Any,int]|None=None):
+		if node2id is None:
+			node2id = {n:i for i, n in enumerate(nodes)}
+		self.nodes = nodes
+		self.node2id = node2id
+		self.child_offsets, self.child_targets = pack_adjacency(children)
+
+		parents : list[list[int]] = [[] for _ in range(len(nodes))]
+		for node_id, node_children in enumerate(children):
+			for child_id in node_children:
+				parents[child_id].append(node_id)
+		self.parent_offsets, self.parent_targets = pack_adjacency(parents)
+
+	@classmethod
+	def from_entry(cls, entry:Any, get_children:Callable[[Any], Iterable[Any]]) -> CompactGraph:
+		"""
+		builds graph of all nodes reachable from entry in linear time
+		"""
+		nodes = [entry]
+		node2id = {entry: 0}
+		children : list[list[int]] = []
+		# nodes list is the BFS queue itself, head is the current node id
+		head = 0
+		while head < len(nodes):
+			node_children = []
+			for child in get_children(nodes[head]):
+				child_id = node2id.get(child)
+				if child_id is None:
+					child_id = len(nodes)
+					node2id[child] = child_id
+					nodes.append(child)
+				node_children.append(child_id)
+			children.append(node_children)
+			head += 1
+		return cls(nodes, children, node2id)
+
+	@classmethod
+	def from_csr(cls, nodes:list[Any], offsets:array, targets:array) -> CompactGraph:
+		"""
+		builds graph from nodes in id order and child CSR arrays
+		e.g. ones that were previously saved
+		"""
+		if len(offsets) != len(nodes) + 1 or offsets[-1] != len(targets):
+			raise ValueError("CSR arrays do not match nodes")
+		children = [list(targets[offsets[i]:offsets[i + 1]]) for i in range(len(nodes))]
+		return cls(nodes, children)
+
+	def __len__(self) -> int:
+		return len(self.nodes)
+
+	def edges_count(self) -> int:
+		return len(self.child_targets)
+
+	@property
+	def entry(self) -> Any:
+		return self.nodes[0]
+
+	def get_id(self, node:Any) -> int:
+		return self.node2id[node]
+
+	def children(self, node_id:int) -> array:
+		return self.child_targets[self.child_offsets[node_id]:self.child_offsets[node_id + 1]]
+
+	def parents(self, node_id:int) -> array:
+		return self.parent_targets[self.parent_offsets[node_id]:self.parent_offsets[node_id + 1]]
+
+	def iterate_edges(self):
+		offsets = self.child_offsets
+		targets = self.child_targets
+		for node_id in range(len(self.nodes)):
+			for i in range(offsets[node_id], offsets[node_id + 1]):
+				yield node_id, targets[i]
+
+	def get_reduced_children(self, keep:set[int]) -> dict[int, list[int]]:
+		"""
+		for each kept node id collects kept node ids, that are reachable
+		from it through nodes, that are not kept
+		"""
+		reachable = self.get_removed_reachable(keep)
+		reduced : dict[int, list[int]] = {}
+		for node_id in keep:
+			# dict keeps first occurence order, while removing duplicates
+			node_children : dict[int, None] = {}
+			for child_id in self.children(node_id):
+				if child_id in keep:
+					node_children[child_id] = None
+				else:
+					node_children.update(reachable[child_id])
+			reduced[node_id] = list(node_children)
+		return reduced
+
+	def reduce(self, keep:set[int], new_entry:Callable[[], Any]) -> CompactGraph:
+		"""
+		graph of kept nodes, connected the same way as through removed ones
+		removed entry is shifted down to its only child or replaced with new_entry()
+		"""
+		reduced = self.get_reduced_children(keep | {0})
+		nodes = self.nodes
+		children = {nodes[i]: [nodes[c] for c in cs] for i, cs in reduced.items()}
+
+		entry = nodes[0]
+		if 0 not in keep:
+			entry_children = children.pop(entry)
+			if len(entry_children) == 1:
+				# shift entry by one node down
+				entry = entry_children[0]
+			else:
+				# replace entry
+				entry = new_entry()
+				children[entry] = entry_children
+
+		return CompactGraph.from_entry(entry, lambda n: children.get(n, ()))
+
+	def get_removed_reachable(self, keep:set[int]) -> dict[int, dict[int, None]]:
+		"""
+		for each node id, that is not kept, collects kept node ids, that are
+		reachable from it through nodes, that are not kept
+		computed once per strongly connected component of removed nodes
+		in reverse topological order, so graph is traversed only once
+		"""
+		offsets = self.child_offsets
+		targets = self.child_targets
+		is_kept = bytearray(len(self.nodes))
+		for node_id in keep:
+			is_kept[node_id] = 1
+
+		reachable : dict[int, dict[int, None]] = {}
+		# components, that are reachable from a component, are always done before it
+		for component in self.get_sccs(is_kept):
+			node_id = component[0]
+			if len(component) == 1 and offsets[node_id + 1] - offsets[node_id] == 1:
+				# single node with single child, result is shared instead of copied
+				child_id = targets[offsets[node_id]]
+				if is_kept[child_id]:
+					reachable[node_id] = {child_id: None}
+				else:
+					reachable[node_id] = reachable.get(child_id, {})
+				continue
+
+			component_reachable : dict[int, None] = {}
+			for member_id in component:
+				for i in range(offsets[member_id], offsets[member_id + 1]):
+					child_id = targets[i]
+					if is_kept[child_id]:
+						component_reachable[child_id] = None
+					elif (child_reachable := reachable.get(child_id)) is not None:
+						component_reachable.update(child_reachable)
+			for member_id in component:
+				reachable[member_id] = component_reachable
+		return reachable
+
+	def get_sccs(self, excluded:bytearray|None=None) -> list[list[int]]:
+		"""
+		strongly connected components in reverse topological order
+		found by iterative Tarjan, excluded node ids and edges to them are skipped
+		"""
+		offsets = self.child_offsets
+		targets = self.child_targets
+		nodes_count = len(self.nodes)
+		if excluded is None:
+			excluded = bytearray(nodes_count)
+		index = [-1] * nodes_count
+		lowlink = [0] * nodes_count
+		next_edge = list(offsets)
+		on_stack = bytearray(nodes_count)
+		scc_stack : list[int] = []
+		sccs : list[list[int]] = []
+		counter = 0
+
+		# work stack holds nodes, whose children are being visited
+		for root_id in range(nodes_count):
+			if excluded[root_id] or index[root_id] != -1:
+				continue
+
+			index[root_id] = lowlink[root_id] = counter
+			counter += 1
+			scc_stack.append(root_id)
+			on_stack[root_id] = 1
+			work = [root_id]
+			while len(work) != 0:
+				node_id = work[-1]
+				edge = next_edge[node_id]
+				if edge < offsets[node_id + 1]:
+					next_edge[node_id] = edge + 1
+					child_id = targets[edge]
+					if excluded[child_id]:
+						continue
+					if index[child_id] == -1:
+						index[child_id] = lowlink[child_id] = counter
+						counter += 1
+						scc_stack.append(child_id)
+						on_stack[child_id] = 1
+						work.append(child_id)
+					elif on_stack[child_id] and index[child_id] < lowlink[node_id]:
+						lowlink[node_id] = index[child_id]
+					continue
+
+				work.pop()
+				if len(work) != 0:
+					parent_id = work[-1]
+					if lowlink[node_id] < lowlink[parent_id]:
+						lowlink[parent_id] = lowlink[node_id]
+				if lowlink[node_id] != index[node_id]:
+					continue
+
+				component = []
+				while True:
+					member_id = scc_stack.pop()
+					on_stack[member_id] = 0
+					component.append(member_id)
+					if member_id == node_id:
+						break
+				sccs.append(component)
+		return sccs
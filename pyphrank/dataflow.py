@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import heapq
+from typing import Callable
+
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.graph_analysis import GraphAnalysis
+from pyphrank.type_flow_graph_parts import Var, SExpr, Node, UNKNOWN_SEXPR
+
+
+def iterate_bits(bits:int):
+	""" yields positions of set bits from the lowest one """
+	while bits != 0:
+		lowest = bits & -bits
+		yield lowest.bit_length() - 1
+		bits ^= lowest
+
+def solve_forward(graph:CompactGraph, analysis:GraphAnalysis, transfer:Callable[[int, int], int], entry_facts:int=0) -> list[int]:
+	"""
+	Solves forward may-problem, where facts are bitsets and facts of parents are joined by union
+	transfer gets node id with facts before node and returns facts after node, it must be monotone
+	components are solved in topological order, so only loops are iterated until fixpoint
+	returns facts before every node id
+	"""
+	nodes_count = len(graph)
+	facts_in = [0] * nodes_count
+	facts_out = [0] * nodes_count
+	rpo_index = analysis.rpo_index
+	scc_ids = analysis.scc_ids
+
+	def join(node_id:int) -> int:
+		facts = entry_facts if node_id == 0 else 0
+		for parent_id in graph.parents(node_id):
+			facts |= facts_out[parent_id]
+		return facts
+
+	for scc_id, component in enumerate(analysis.sccs):
+		if not analysis.is_loop(scc_id):
+			node_id = component[0]
+			facts = join(node_id)
+			facts_in[node_id] = facts
+			facts_out[node_id] = transfer(node_id, facts)
+			continue
+
+		# loop nodes are taken in reverse postorder, so most parents are done first
+		worklist = [(rpo_index[node_id], node_id) for node_id in component]
+		heapq.heapify(worklist)
+		queued = set(component)
+		while len(worklist) != 0:
+			_, node_id = heapq.heappop(worklist)
+			queued.discard(node_id)
+			facts = join(node_id)
+			facts_in[node_id] = facts
+			new_out = transfer(node_id, facts)
+			if new_out == facts_out[node_id]:
+				continue
+
+			facts_out[node_id] = new_out
+			for child_id in graph.children(node_id):
+				if scc_ids[child_id] != scc_id or child_id in queued:
+					continue
+				queued.add(child_id)
+				heapq.heappush(worklist, (rpo_index[child_id], child_id))
+	return facts_in
+
+def get_moved_var(node:Node) -> Var|None:
+	""" var, that node moves a value to, e.g. var = anything """
+	if not node.is_expr() or not node.sexpr.is_assign():
+		return None
+	return node.sexpr.target.var
+
+
+class ReachingDefinitions:
+	"""
+	Moves to vars, that may reach every node without var being moved to again
+	every move is a definition, bit of definition is its index in definitions
+	definitions are collected at once, facts are solved on first query, that needs them
+	"""
+	def __init__(self, graph:CompactGraph, analysis:GraphAnalysis):
+		self.graph = graph
+		self.analysis = analysis
+		self.definitions : list[int] = []
+		self.var_definitions : dict[Var, int] = {}
+		for node_id, node in enumerate(graph.nodes):
+			if (var := get_moved_var(node)) is None:
+				continue
+			bit = 1 << len(self.definitions)
+			self.definitions.append(node_id)
+			self.var_definitions[var] = self.var_definitions.get(var, 0) | bit
+		self._facts : list[int]|None = None
+
+	@property
+	def facts(self) -> list[int]:
+		""" Definitions, that may reach every node id """
+		if self._facts is None:
+			nodes = self.graph.nodes
+			gen = [0] * len(nodes)
+			kill = [0] * len(nodes)
+			for bit, node_id in enumerate(self.definitions):
+				gen[node_id] = 1 << bit
+				kill[node_id] = self.var_definitions[get_moved_var(nodes[node_id])] # type:ignore
+
+			def transfer(node_id:int, facts:int) -> int:
+				return gen[node_id] | (facts & ~kill[node_id])
+			self._facts = solve_forward(self.graph, self.analysis, transfer)
+		return self._facts
+
+	def get_var_definitions(self, var:Var) -> list[int]:
+		""" Node ids of all moves to var, wherever they reach """
+		return [self.definitions[i] for i in iterate_bits(self.var_definitions.get(var, 0))]
+
+	def get_definitions(self, node_id:int, var:Var|None=None) -> list[int]:
+		""" Node ids of moves, that may reach node, only moves to var if it is given """
+		facts = self.facts[node_id]
+		if var is not None:
+			facts &= self.var_definitions.get(var, 0)
+		return [self.definitions[i] for i in iterate_bits(facts)]
+
+
+class PointerSources:
+	"""
+	Sources of values, that vars may hold before every node, e.g. what var may point to
+	source is either value moved into var, that is not a plain var, e.g. &x, call or load,
+	or var itself, standing for its value at entry, e.g. for arguments
+	facts have a row of source bits for every var, plain var moves copy rows
+	"""
+	def __init__(self, graph:CompactGraph, analysis:GraphAnalysis):
+		self.var_rows : dict[Var, int] = {}
+		self.sources : list[SExpr|Var] = []
+		# vars can not be compared with sexprs, so they have their own ids
+		self.var_source_ids : dict[Var, int] = {}
+		self.sexpr_source_ids : dict[SExpr, int] = {}
+		# target row, value row or -1 and source id or -1 for every move node
+		moves : dict[int, tuple[int, int, int]] = {}
+		for node_id, node in enumerate(graph.nodes):
+			if (var := get_moved_var(node)) is None:
+				continue
+			target_row = self.get_var_row(var)
+			value = node.sexpr.value
+			value_row = source_id = -1
+			if (value_var := value.var) is not None:
+				value_row = self.get_var_row(value_var)
+			elif value is not UNKNOWN_SEXPR and not value.is_type_literal():
+				source_id = self.get_source_id(value)
+			moves[node_id] = (target_row, value_row, source_id)
+
+		row_size = len(self.sources)
+		row_mask = (1 << row_size) - 1
+		entry_facts = 0
+		for var, row in self.var_rows.items():
+			entry_facts |= 1 << (row * row_size + self.var_source_ids[var])
+
+		def transfer(node_id:int, facts:int) -> int:
+			move = moves.get(node_id)
+			if move is None:
+				return facts
+			target_row, value_row, source_id = move
+			if value_row != -1:
+				new_row = (facts >> (value_row * row_size)) & row_mask
+			elif source_id != -1:
+				new_row = 1 << source_id
+			else:
+				new_row = 0
+			target_shift = target_row * row_size
+			return (facts & ~(row_mask << target_shift)) | (new_row << target_shift)
+
+		self.row_size = row_size
+		self.row_mask = row_mask
+		self.facts = solve_forward(graph, analysis, transfer, entry_facts)
+
+	def get_var_row(self, var:Var) -> int:
+		row = self.var_rows.get(var)
+		if row is None:
+			row = len(self.var_rows)
+			self.var_rows[var] = row
+			self.get_source_id(var)
+		return row
+
+	def get_source_id(self, source:SExpr|Var) -> int:
+		source_ids = self.var_source_ids if isinstance(source, Var) else self.sexpr_source_ids
+		source_id = source_ids.get(source) # type:ignore
+		if source_id is None:
+			source_id = len(self.sources)
+			self.sources.append(source)
+			source_ids[source] = source_id # type:ignore
+		return source_id
+
+	def get_sources(self, node_id:int, var:Var) -> list[SExpr|Var]:
+		""" Values, that var may hold before node """
+		row = self.var_rows.get(var)
+		# never moved to, so holds its entry value everywhere
+		if row is None:
+			return [var]
+		facts = (self.facts[node_id] >> (row * self.row_size)) & self.row_mask
+		return [self.sources[i] for i in iterate_bits(facts)]
+
+	def may_hold(self, node_id:int, var:Var, source:SExpr|Var) -> bool:
+		""" Var may hold pointer from source before node """
+		row = self.var_rows.get(var)
+		if row is None:
+			return isinstance(source, Var) and source == var
+		if isinstance(source, Var):
+			source_id = self.var_source_ids.get(source)
+		else:
+			source_id = self.sexpr_source_ids.get(source)
+		if source_id is None:
+			return False
+		return (self.facts[node_id] >> (row * self.row_size + source_id)) & 1 == 1
+
+
+class TFGDataflow:
+	""" Dataflow analyses of TFG nodes, each is solved on first query """
+	def __init__(self, graph:CompactGraph, analysis:GraphAnalysis):
+		self.graph = graph
+		self.analysis = analysis
+		self._reaching_definitions : ReachingDefinitions|None = None
+		self._pointer_sources : PointerSources|None = None
+
+	@property
+	def reaching_definitions(self) -> ReachingDefinitions:
+		if self._reaching_definitions is None:
+			self._reaching_definitions = ReachingDefinitions(self.graph, self.analysis)
+		return self._reaching_definitions
+
+	@property
+	def pointer_sources(self) -> PointerSources:
+		if self._pointer_sources is None:
+			self._pointer_sources = PointerSources(self.graph, self.analysis)
+		return self._pointer_sources
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import marshal
+
+import idaapi
+
+import pyphrank.utils as utils
+
+
+class DecompilationRecords:
+	"""
+	Reasons, why functions failed to decompile or were bugged, saved in IDB netnode blobs
+	so next sessions skip failing functions and decompile bugged ones once
+	record is used only if function was not changed since saving
+	"""
+	NETNODE_NAME = "$ phrank.decompilation"
+	BLOB_TAG = 'D'
+
+	def __init__(self):
+		self._netnode : idaapi.netnode|None = None
+
+	@property
+	def netnode(self) -> idaapi.netnode:
+		# created on first use, because database might not be open yet
+		if self._netnode is None:
+			self._netnode = idaapi.netnode(self.NETNODE_NAME, 0, True)
+		return self._netnode
+
+	def load(self, func_ea:int, fingerprint:bytes) -> str|None:
+		data = self.netnode.getblob(func_ea, self.BLOB_TAG)
+		if data is None:
+			return None
+
+		try:
+			saved_fingerprint, reason = marshal.loads(data)
+		except (ValueError, EOFError, TypeError):
+			saved_fingerprint = reason = None
+
+		if saved_fingerprint != fingerprint or not isinstance(reason, str):
+			self.remove(func_ea)
+			return None
+		return reason
+
+	def save(self, func_ea:int, fingerprint:bytes, reason:str):
+		self.netnode.setblob(marshal.dumps((fingerprint, reason)), func_ea, self.BLOB_TAG)
+
+	def remove(self, func_ea:int):
+		self.netnode.delblob(func_ea, self.BLOB_TAG)
+
+	def clear(self):
+		self.netnode.kill()
+		self._netnode = None
@@ -6,28 +6,102 @@ import pyphrank.utils as utils
 
 from pyphrank.ast_analyzer import CTreeAnalyzer, TFG
 from pyphrank.cfunction_factory import CFunctionFactory
-from pyphrank.type_flow_graph_parts import Node, UNKNOWN_SEXPR
+from pyphrank.type_flow_graph_parts import Node, Var, UNKNOWN_SEXPR
 
 def get_funcname(func_ea: int) -> str:
 	return idaapi.get_name(func_ea)
 
 
+class FuncTypes:
+	"""
+	Prototype of function and types of its lvars
+	prototype and argument types are got in one pass, lvar types need cfunc, so they are got on first request
+	"""
+	__slots__ = "tinfo", "arg_types", "lvar_types", "args_count"
+
+	def __init__(self, tinfo:idaapi.tinfo_t, arg_types:list[idaapi.tinfo_t]|None):
+		self.tinfo = tinfo
+		# None if function has no details
+		self.arg_types = arg_types
+		# None until got from cfunc, failed decompilations are not cached here
+		self.lvar_types : list[idaapi.tinfo_t]|None = None
+		self.args_count = -1
+
+
+class LvarTypesModifier(idaapi.user_lvar_modifier_t):
+	""" Sets types of lvars in user lvar settings, like modify_user_lvar_info with MLI_TYPE does for one lvar """
+	def __init__(self, lvars_info:list[idaapi.lvar_saved_info_t]):
+		idaapi.user_lvar_modifier_t.__init__(self)
+		self.lvars_info = lvars_info
+
+	def modify_lvars(self, lvinf:idaapi.lvar_uservec_t) -> bool:
+		for info in self.lvars_info:
+			for saved_info in lvinf.lvvec:
+				if saved_info.ll == info.ll:
+					saved_info.type = info.type
+					break
+			else:
+				lvinf.lvvec.push_back(info)
+		return True
+
+
 class FunctionManager:
 	def __init__(self, cfunc_factory=None):
 		if cfunc_factory is None:
 			cfunc_factory = CFunctionFactory()
 		self.func_factory = cfunc_factory
+		self.func_types : dict[int, FuncTypes] = {}
+
+	def get_func_types(self, func_ea:int) -> FuncTypes:
+		func_types = self.func_types.get(func_ea)
+		if func_types is None:
+			func_types = self.calc_func_types(func_ea)
+			self.func_types[func_ea] = func_types
+		return func_types
+
+	def calc_func_types(self, func_ea:int) -> FuncTypes:
+		tif = self.calc_func_tinfo(func_ea)
+		func_details = idaapi.func_type_data_t()
+		if tif is utils.UNKNOWN_TYPE or not tif.get_func_details(func_details):
+			return FuncTypes(tif, None)
+
+		# XXX do not refactor this into one liner,
+		# XXX because ida will lose arg type somewhere along the way
+		arg_types = []
+		for i in range(len(func_details)):
+			arg_types.append(func_details[i].type.copy())
+		return FuncTypes(tif, arg_types)
+
+	def get_lvar_types(self, func_ea:int) -> list[idaapi.tinfo_t]:
+		func_types = self.get_func_types(func_ea)
+		if func_types.lvar_types is not None:
+			return func_types.lvar_types
+
+		# failure is not cached, cfunc factory remembers it, while cfunc is not cleared
+		cfunc = self.get_cfunc(func_ea)
+		if cfunc is None:
+			return []
+
+		func_types.lvar_types = [lvar.type().copy() for lvar in cfunc.lvars]
+		func_types.args_count = len(cfunc.arguments)
+		return func_types.lvar_types
+
+	def invalidate_func_types(self, func_ea:int):
+		self.func_types.pop(func_ea, None)
 
-	def get_tfg(self, func_ea:int) -> TFG:
+	def clear_func_types(self):
+		self.func_types.clear()
+
+	def get_tfg(self, func_ea:int, only_vars:frozenset[Var]|None=None) -> TFG:
 		if not utils.is_func_start(func_ea):
 			utils.log_warn(f"{hex(func_ea)} is not a function")
 
 		cfunc = self.get_cfunc(func_ea)
 		if cfunc is None:
 			nop_node = Node(Node.EXPR, UNKNOWN_SEXPR)
-			analysis = TFG(nop_node)
+			analysis = TFG.from_children(nop_node, {})
 		else:
-			analysis = CTreeAnalyzer(cfunc).lift_cfunc()
+			analysis = CTreeAnalyzer(cfunc, only_vars).lift_cfunc()
 		return analysis
 
 	def get_cfunc(self, func_ea:int) -> idaapi.cfunc_t|None:
@@ -46,10 +120,15 @@ class FunctionManager:
 		return func_details
 
 	def get_args_count(self, func_ea:int) -> int:
-		cfunc = self.get_cfunc(func_ea)
-		if cfunc is None:
-			return 0
-		return len(cfunc.arguments)
+		self.get_lvar_types(func_ea)
+		func_types = self.get_func_types(func_ea)
+		if func_types.args_count != -1:
+			return func_types.args_count
+
+		# decompilation failed, prototype is the best guess
+		if func_types.arg_types is not None:
+			return len(func_types.arg_types)
+		return 0
 
 	def get_cfunc_lvar_type(self, func_ea:int, var_id:int) -> idaapi.tinfo_t:
 		func_tif = self.get_func_tinfo(func_ea)
@@ -66,40 +145,48 @@ class FunctionManager:
 		if arg_type is not utils.UNKNOWN_TYPE:
 			return arg_type
 
-		cfunc = self.get_cfunc(func_ea)
-		if cfunc is None:
+		lvar_types = self.get_lvar_types(func_ea)
+		if len(lvar_types) == 0:
 			utils.log_warn(f"failed to get variable type, because of decompilation failure in {get_funcname(func_ea)}")
 			return utils.UNKNOWN_TYPE
 
-		if len(cfunc.lvars) <= var_id:
+		if len(lvar_types) <= var_id:
 			print("ERROR:", "var id is too big.")
 			return utils.UNKNOWN_TYPE
 
-		var = cfunc.lvars[var_id]
-		arg_type = var.type().copy()
+		arg_type = lvar_types[var_id].copy()
 		if not utils.is_tif_correct(arg_type):
 			arg_type = utils.UNKNOWN_TYPE
 		return arg_type
 
 	def set_lvar_tinfo(self, func_ea:int, var_id:int, var_type:idaapi.tinfo_t) -> bool:
+		return self.set_lvar_tinfos(func_ea, {var_id: var_type})
+
+	def set_lvar_tinfos(self, func_ea:int, lvar_types:dict[int, idaapi.tinfo_t]) -> bool:
+		""" Change types of several lvars of function in a single modification of user lvar settings """
 		cfunc = self.get_cfunc(func_ea)
 		if cfunc is None:
 			utils.log_err(f"failed to change variable type in {get_funcname(func_ea)}, because of decompilation failure")
 			return False
 
-		if var_id >= len(cfunc.lvars):
-			utils.log_err(f"failed to change variable type in {get_funcname(func_ea)}, because var id is too big")
-			return False
+		lvars_info = []
+		for var_id, var_type in lvar_types.items():
+			if var_id >= len(cfunc.lvars):
+				utils.log_err(f"failed to change variable type in {get_funcname(func_ea)}, because var id is too big")
+				continue
 
-		var = cfunc.lvars[var_id]
-		# var.set_user_type()
-		# var.set_final_lvar_type(var_type)
+			var = cfunc.lvars[var_id]
+			info = idaapi.lvar_saved_info_t()
+			info.ll = var
+			# only type is set, so names are left as they are
+			info.type = var_type
+			lvars_info.append(info)
+
+		if len(lvars_info) == 0:
+			return False
 
-		info = idaapi.lvar_saved_info_t()
-		info.ll = var
-		info.type = var_type
-		info.name = var.name
-		rv = idaapi.modify_user_lvar_info(func_ea, idaapi.MLI_TYPE, info)
+		rv = idaapi.modify_user_lvars(func_ea, LvarTypesModifier(lvars_info))
+		self.invalidate_func_types(func_ea)
 		if not rv:
 			utils.log_err(f"failed to change variable type in {get_funcname(func_ea)}, because of idaapi failure")
 		return rv
@@ -111,16 +198,14 @@ class FunctionManager:
 		return cfunc.lvars[lvar_id]
 
 	def get_arg_type(self, func_ea:int, arg_id:int) -> idaapi.tinfo_t:
-		# XXX do not refactor this into one liner, 
-		# XXX because ida will lose arg type somewhere along the way
-		fdet = self.get_func_details(func_ea)
-		if fdet is None:
+		arg_types = self.get_func_types(func_ea).arg_types
+		if arg_types is None:
 			utils.log_warn(f"failed to get func details in {get_funcname(func_ea)}")
 			return utils.UNKNOWN_TYPE
 
-		if len(fdet) <= arg_id:
+		if len(arg_types) <= arg_id:
 			return utils.UNKNOWN_TYPE
-		return fdet[arg_id].type.copy()
+		return arg_types[arg_id].copy()
 
 	def set_arg_type(self, func_ea:int, arg_id:int, arg_type:idaapi.tinfo_t):
 		if isinstance(arg_type, str):
@@ -141,8 +226,16 @@ class FunctionManager:
 		assert rv, "Failed to apply new tinfo to function"
 
 		self.func_factory.clear_cfunc(func_ea)
+		self.invalidate_func_types(func_ea)
 
 	def get_func_tinfo(self, func_ea:int) -> idaapi.tinfo_t:
+		tif = self.get_func_types(func_ea).tinfo
+		# callers might change returned tinfo
+		if tif is utils.UNKNOWN_TYPE:
+			return tif
+		return tif.copy()
+
+	def calc_func_tinfo(self, func_ea:int) -> idaapi.tinfo_t:
 		tif = idaapi.tinfo_t()
 		if idaapi.get_tinfo(tif, func_ea) and tif.is_correct():
 			return tif
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+from pyphrank.compact_graph import CompactGraph
+
+
+class GraphAnalysis:
+	"""
+	Orders and structure of CompactGraph, every one is computed on first access
+	nodes are referred by their ids in graph, entry has id 0 and reaches every node
+	"""
+	def __init__(self, graph:CompactGraph):
+		self.graph = graph
+		self._rpo : list[int]|None = None
+		self._rpo_index : list[int]|None = None
+		self._sccs : list[list[int]]|None = None
+		self._scc_ids : list[int]|None = None
+		self._idom : list[int]|None = None
+		self._dom_intervals : tuple[list[int],list[int]]|None = None
+		self._depth : list[int]|None = None
+
+	@property
+	def rpo(self) -> list[int]:
+		""" Node ids in reverse postorder of DFS from entry, parents go before children except for back edges """
+		if self._rpo is None:
+			graph = self.graph
+			offsets = graph.child_offsets
+			targets = graph.child_targets
+			next_edge = list(offsets)
+			visited = bytearray(len(graph))
+			visited[0] = 1
+			postorder = []
+			stack = [0]
+			while len(stack) != 0:
+				node_id = stack[-1]
+				edge = next_edge[node_id]
+				if edge < offsets[node_id + 1]:
+					next_edge[node_id] = edge + 1
+					child_id = targets[edge]
+					if not visited[child_id]:
+						visited[child_id] = 1
+						stack.append(child_id)
+					continue
+				stack.pop()
+				postorder.append(node_id)
+			postorder.reverse()
+			self._rpo = postorder
+		return self._rpo
+
+	@property
+	def rpo_index(self) -> list[int]:
+		""" Position of every node id in reverse postorder """
+		if self._rpo_index is None:
+			rpo_index = [0] * len(self.graph)
+			for i, node_id in enumerate(self.rpo):
+				rpo_index[node_id] = i
+			self._rpo_index = rpo_index
+		return self._rpo_index
+
+	@property
+	def sccs(self) -> list[list[int]]:
+		""" Strongly connected components in topological order, component of entry is first """
+		if self._sccs is None:
+			sccs = self.graph.get_sccs()
+			sccs.reverse()
+			self._sccs = sccs
+		return self._sccs
+
+	@property
+	def scc_ids(self) -> list[int]:
+		""" Index of component in sccs for every node id """
+		if self._scc_ids is None:
+			scc_ids = [0] * len(self.graph)
+			for scc_id, component in enumerate(self.sccs):
+				for node_id in component:
+					scc_ids[node_id] = scc_id
+			self._scc_ids = scc_ids
+		return self._scc_ids
+
+	def is_loop(self, scc_id:int) -> bool:
+		component = self.sccs[scc_id]
+		if len(component) > 1:
+			return True
+		node_id = component[0]
+		return node_id in self.graph.children(node_id)
+
+	@property
+	def idom(self) -> list[int]:
+		"""
+		Immediate dominator of every node id, entry is its own dominator
+		computed by Cooper, Harvey and Kennedy iterations over reverse postorder
+		"""
+		if self._idom is None:
+			graph = self.graph
+			rpo = self.rpo
+			rpo_index = self.rpo_index
+			idom = [-1] * len(graph)
+			idom[0] = 0
+
+			def intersect(a:int, b:int) -> int:
+				while a != b:
+					while rpo_index[a] > rpo_index[b]:
+						a = idom[a]
+					while rpo_index[b] > rpo_index[a]:
+						b = idom[b]
+				return a
+
+			changed = True
+			while changed:
+				changed = False
+				for node_id in rpo[1:]:
+					new_idom = -1
+					for parent_id in graph.parents(node_id):
+						if idom[parent_id] == -1:
+							continue
+						if new_idom == -1:
+							new_idom = parent_id
+						else:
+							new_idom = intersect(parent_id, new_idom)
+					if idom[node_id] != new_idom:
+						idom[node_id] = new_idom
+						changed = True
+			self._idom = idom
+		return self._idom
+
+	def dominates(self, dominator_id:int, node_id:int) -> bool:
+		""" Every path from entry to node goes through dominator, node dominates itself """
+		if self._dom_intervals is None:
+			self._dom_intervals = self.get_dom_intervals()
+		enter, leave = self._dom_intervals
+		return enter[dominator_id] <= enter[node_id] and leave[node_id] <= leave[dominator_id]
+
+	def get_dom_intervals(self) -> tuple[list[int],list[int]]:
+		""" DFS enter and leave times in dominator tree, dominated nodes are nested in dominator interval """
+		idom = self.idom
+		nodes_count = len(self.graph)
+		dom_children : list[list[int]] = [[] for _ in range(nodes_count)]
+		for node_id in range(1, nodes_count):
+			dom_children[idom[node_id]].append(node_id)
+
+		enter = [0] * nodes_count
+		leave = [0] * nodes_count
+		time = 0
+		stack = [(0, False)]
+		while len(stack) != 0:
+			node_id, is_leaving = stack.pop()
+			if is_leaving:
+				leave[node_id] = time
+			else:
+				enter[node_id] = time
+				stack.append((node_id, True))
+				stack.extend((child_id, False) for child_id in dom_children[node_id])
+			time += 1
+		return enter, leave
+
+	@property
+	def depth(self) -> list[int]:
+		"""
+		Number of nodes on the longest path from every node id to a leaf
+		loops are counted as a single node, so depth is finite
+		"""
+		if self._depth is None:
+			graph = self.graph
+			scc_ids = self.scc_ids
+			sccs = self.sccs
+			scc_depth = [1] * len(sccs)
+			# children components are after parents in topological order
+			for scc_id in range(len(sccs) - 1, -1, -1):
+				depth = 1
+				for node_id in sccs[scc_id]:
+					for child_id in graph.children(node_id):
+						child_scc = scc_ids[child_id]
+						if child_scc != scc_id and scc_depth[child_scc] + 1 > depth:
+							depth = scc_depth[child_scc] + 1
+				scc_depth[scc_id] = depth
+			self._depth = [scc_depth[scc_id] for scc_id in scc_ids]
+		return self._depth
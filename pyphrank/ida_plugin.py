@@ -9,6 +9,7 @@ import pyphrank.settings as settings
 from pyphrank.type_flow_graph_parts import Var, ASTCtx
 from pyphrank.ast_analyzer import extract_vars
 from pyphrank.type_analyzer import TypeAnalyzer
+from pyphrank.idb_hooks import FuncAttrsHooks, FuncTypesHooks
 
 
 
@@ -56,9 +57,9 @@ class PluginActionHandler(idaapi.action_handler_t):
 			)
 			return 1
 
-		# updating caches
+		# updating caches, TFG is lifted again only if function changed since lifting
+		self.plugin.type_analyzer.refresh_tfg(func_ea)
 		self.plugin.type_analyzer.func_manager.func_factory.set_cfunc(cfunc)
-		self.plugin.type_analyzer.get_tfg(func_ea, nocache=True)
 
 		citem = hx_view.item
 
@@ -105,11 +106,11 @@ class PluginActionHandler(idaapi.action_handler_t):
 
 class TFGPrinter(PluginActionHandler):
 	def print_var_tfg(self, var:Var):
-		tfg = self._get_analyzer().get_all_var_uses(var, nocache=True)
+		tfg = self._get_analyzer().get_all_var_uses(var)
 		tfg.print(f"TypeFlowGraph for {var}")
 
 	def activate_function(self, func_ea:int):
-		tfg = self._get_analyzer().get_tfg(func_ea, nocache=True)
+		tfg = self._get_analyzer().get_tfg(func_ea)
 		tfg.print(f"TypeFlowGraph for {idaapi.get_name(func_ea)}")
 		return 0
 
@@ -225,6 +226,8 @@ class IDAPlugin(idaapi.plugin_t):
 		self.actions: list[PluginActionHandler] = []
 		self.type_analyzer = TypeAnalyzer()
 		self.should_apply_analysis = True
+		self.idb_hooks = FuncAttrsHooks()
+		self.func_types_hooks = FuncTypesHooks(self.type_analyzer.func_manager)
 
 	@classmethod
 	def get_instance(cls):
@@ -248,10 +251,19 @@ class IDAPlugin(idaapi.plugin_t):
 		for action in self.actions:
 			action.register()
 
+		self.idb_hooks.hook()
+		self.func_types_hooks.hook()
 		return idaapi.PLUGIN_KEEP
 
 	def run(self, arg):
 		return
 
 	def term(self):
+		# database is closing, its vars and functions are no longer needed
+		Var.clear_interned()
+		self.idb_hooks.unhook()
+		self.func_types_hooks.unhook()
+		utils.FUNC_ATTRS.clear()
+		# lifting workers must not outlive IDA
+		self.type_analyzer.lifting_pipeline.shutdown()
 		return
\ No newline at end of file
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import idaapi
+
+import pyphrank.utils as utils
+from pyphrank.function_manager import FunctionManager
+
+
+class FuncAttrsHooks(idaapi.IDB_Hooks):
+	"""
+	Keeps table of function attributes fresh
+	changed functions are dropped from it and get their attributes again on next request
+	"""
+	def drop_func(self, addr:int):
+		func_ea = utils.get_func_start(addr)
+		if func_ea != idaapi.BADADDR:
+			utils.FUNC_ATTRS.invalidate(func_ea)
+
+	def func_added(self, pfn):
+		utils.FUNC_ATTRS.invalidate_range(pfn.start_ea, pfn.end_ea)
+		return 0
+
+	def deleting_func(self, pfn):
+		utils.FUNC_ATTRS.invalidate(pfn.start_ea)
+		return 0
+
+	def set_func_start(self, pfn, new_start):
+		utils.FUNC_ATTRS.invalidate(pfn.start_ea)
+		utils.FUNC_ATTRS.invalidate(new_start)
+		return 0
+
+	def set_func_end(self, pfn, new_end):
+		utils.FUNC_ATTRS.invalidate(pfn.start_ea)
+		return 0
+
+	def func_updated(self, pfn):
+		utils.FUNC_ATTRS.invalidate(pfn.start_ea)
+		return 0
+
+	# imports are function starts, if their types are functions
+	def ti_changed(self, ea, type, fnames):
+		utils.FUNC_ATTRS.invalidate(ea)
+		return 0
+
+	def make_code(self, insn):
+		# address might have been requested before it became code
+		utils.FUNC_ATTRS.invalidate(insn.ea)
+		self.drop_func(insn.ea)
+		return 0
+
+	def byte_patched(self, ea, old_value):
+		self.drop_func(ea)
+		return 0
+
+	def destroyed_items(self, ea1, ea2, will_disable_range):
+		self.drop_func(ea1)
+		return 0
+
+	# imports are found by segment names
+	def segm_added(self, s):
+		utils.FUNC_ATTRS.clear()
+		return 0
+
+	def segm_deleted(self, start_ea, end_ea, flags):
+		utils.FUNC_ATTRS.clear()
+		return 0
+
+	def segm_name_changed(self, s, name):
+		utils.FUNC_ATTRS.clear()
+		return 0
+
+
+class FuncTypesHooks(idaapi.IDB_Hooks):
+	""" Drops cached prototypes and lvar types of functions, when they change outside of analysis """
+	def __init__(self, func_manager:FunctionManager):
+		idaapi.IDB_Hooks.__init__(self)
+		self.func_manager = func_manager
+
+	def ti_changed(self, ea, type, fnames):
+		self.func_manager.invalidate_func_types(ea)
+		return 0
+
+	def func_updated(self, pfn):
+		self.func_manager.invalidate_func_types(pfn.start_ea)
+		return 0
+
+	def deleting_func(self, pfn):
+		self.func_manager.invalidate_func_types(pfn.start_ea)
+		return 0
+
+	def set_func_start(self, pfn, new_start):
+		self.func_manager.invalidate_func_types(pfn.start_ea)
+		self.func_manager.invalidate_func_types(new_start)
+		return 0
+
+	# types of lvars might refer to changed local types, arguments differ between IDA versions
+	def local_types_changed(self, *args):
+		self.func_manager.clear_func_types()
+		return 0
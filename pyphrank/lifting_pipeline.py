@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from typing import Iterable, Iterator
+
+import idaapi
+
+import pyphrank.utils as utils
+import pyphrank.settings as settings
+from pyphrank.snapshot_lifter import CTreeSnapshot, lift_snapshot
+from pyphrank.ast_analyzer import take_snapshot, decode_lifted
+from pyphrank.type_flow_graph import TFG
+
+
+def get_worker_python() -> str|None:
+	""" Python interpreter for worker processes, IDA itself can not be one """
+	if settings.LIFTING_PYTHON is not None:
+		return settings.LIFTING_PYTHON
+
+	if os.path.basename(sys.executable).lower().startswith("python"):
+		return sys.executable
+
+	if os.name == "nt":
+		python = os.path.join(sys.exec_prefix, "python.exe")
+	else:
+		python = os.path.join(sys.exec_prefix, "bin", f"python{sys.version_info.major}.{sys.version_info.minor}")
+	if not os.path.exists(python):
+		return None
+	return python
+
+
+class LiftingPipeline:
+	"""
+	Lifts cfuncs in two stages: ctree snapshots are taken in main thread
+	and lifted into TFGs in worker processes, while main thread keeps decompiling
+	"""
+	def __init__(self, workers:int|None=None):
+		if workers is None:
+			workers = settings.LIFTING_WORKERS
+		self.workers = workers
+		self.executor : ProcessPoolExecutor|None = None
+
+	def get_executor(self) -> ProcessPoolExecutor|None:
+		if self.executor is not None or self.workers <= 0:
+			return self.executor
+
+		python = get_worker_python()
+		if python is None:
+			utils.log_warn("failed to find python for lifting workers, lifting in main thread")
+			self.workers = 0
+			return None
+
+		# forking IDA is not an option
+		ctx = multiprocessing.get_context("spawn")
+		ctx.set_executable(python)
+		self.executor = ProcessPoolExecutor(self.workers, mp_context=ctx)
+		return self.executor
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+	def lift(self, cfuncs:Iterable[idaapi.cfunc_t]) -> Iterator[tuple[int,TFG]]:
+		"""
+		Yields (func_ea, shrunk compact TFG) in order of lifting completion
+		functions, that snapshot can not be taken of, are skipped
+		"""
+		executor = self.get_executor()
+		# snapshots waiting for workers are limited, so decompiling does not run far ahead of lifting
+		max_pending = self.workers * 4
+		pending : dict[Future, tuple[CTreeSnapshot, list[idaapi.tinfo_t]]] = {}
+		for cfunc in cfuncs:
+			try:
+				snapshot, types = take_snapshot(cfunc)
+			except Exception as e:
+				utils.log_err(f"failed to take snapshot of {idaapi.get_name(cfunc.entry_ea)} {e}, skipping it")
+				continue
+
+			if executor is None:
+				yield snapshot.func_ea, decode_lifted(lift_snapshot(snapshot), types)
+				continue
+
+			pending[executor.submit(lift_snapshot, snapshot)] = (snapshot, types)
+			if len(pending) >= max_pending:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			else:
+				done = {f for f in pending if f.done()}
+			for future in done:
+				yield self.finish(future, *pending.pop(future))
+
+		for future in as_completed(list(pending)):
+			yield self.finish(future, *pending.pop(future))
+
+	def finish(self, future:Future, snapshot:CTreeSnapshot, types:list[idaapi.tinfo_t]) -> tuple[int,TFG]:
+		try:
+			result = future.result()
+		except Exception as e:
+			utils.log_err(f"lifting worker failed on {hex(snapshot.func_ea)} {e}, lifting in main thread")
+			result = lift_snapshot(snapshot)
+		return snapshot.func_ea, decode_lifted(result, types)
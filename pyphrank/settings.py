@@ -6,6 +6,37 @@ SHOULD_SET_VTABLE_TYPES = True
 # due to MUCH more decompilations (some might be unnecessary)
 DECOMPILE_RECURSIVELY = False
 
+# limit of functions decompiled for a single recursive decompilation, 0 means no limit
+MAX_RECURSIVE_DECOMPILATIONS = 1000
+
+# generate pseudocode text of every decompiled function, like showing it in IDA does
+# analysis needs only ctree, text is useful only to measure its cost in debug log
+DECOMPILE_GENERATE_TEXT = False
+
+# limits of decompiled functions cache, least recently used ones are dropped first
+# bytes are estimated from functions sizes, 0 means no limit
+CFUNC_CACHE_MAX_ENTRIES = 2048
+CFUNC_CACHE_MAX_BYTES = 0
+
+# save failed and bugged decompilations into IDB, so next sessions do not repeat them
+# saved record is dropped when function bytes, prototype or lvars change
+PERSISTENT_DECOMPILATION_RECORDS = False
+
+# save lifted TFGs into IDB, so they are not lifted again after restart
+# saved TFG is dropped when function bytes, prototype or lvars change
+PERSISTENT_TFG_CACHE = False
+
+# when looking for uses of a var lift only instructions with it instead of whole functions
+# full TFGs are still lifted, when analysis needs them, e.g. for return types
+PARTIAL_LIFTING = False
+
+# number of worker processes for lifting many functions at once
+# 0 lifts everything in main thread
+LIFTING_WORKERS = 0
+
+# python interpreter for lifting workers, found near IDA's python if None
+LIFTING_PYTHON = None
+
 # when decompiling skip functions, that start with these prefixes
 FUNCTION_PREFIXES_DECOMPILATION_SKIP_LIST = {
 	"nlohmann::",
@@ -0,0 +1,1038 @@
+"""
+Lifting of ctree snapshots into serialized TFGs
+snapshots are plain data copies of ctrees, with everything IDA specific
+already resolved, so lifting does not need IDA and can run in worker processes
+these are the only lifting rules, CTreeAnalyzer lifts snapshots in main thread
+"""
+
+from __future__ import annotations
+
+import logging
+from collections import deque
+from typing import Any, Generator
+
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.tfg_payload import *
+
+
+# ctree op codes of snapshots, names are the same as in IDA
+# values are translated by name, so they do not depend on IDA version
+cot_empty = 0
+cot_comma = 1
+cot_asg = 2
+cot_asgbor = 3
+cot_asgxor = 4
+cot_asgband = 5
+cot_asgadd = 6
+cot_asgsub = 7
+cot_asgmul = 8
+cot_asgsshr = 9
+cot_asgushr = 10
+cot_asgshl = 11
+cot_asgsdiv = 12
+cot_asgudiv = 13
+cot_asgsmod = 14
+cot_asgumod = 15
+cot_tern = 16
+cot_lor = 17
+cot_land = 18
+cot_bor = 19
+cot_xor = 20
+cot_band = 21
+cot_eq = 22
+cot_ne = 23
+cot_sge = 24
+cot_uge = 25
+cot_sle = 26
+cot_ule = 27
+cot_sgt = 28
+cot_ugt = 29
+cot_slt = 30
+cot_ult = 31
+cot_sshr = 32
+cot_ushr = 33
+cot_shl = 34
+cot_add = 35
+cot_sub = 36
+cot_mul = 37
+cot_sdiv = 38
+cot_udiv = 39
+cot_smod = 40
+cot_umod = 41
+cot_fadd = 42
+cot_fsub = 43
+cot_fmul = 44
+cot_fdiv = 45
+cot_fneg = 46
+cot_neg = 47
+cot_cast = 48
+cot_lnot = 49
+cot_bnot = 50
+cot_ptr = 51
+cot_ref = 52
+cot_postinc = 53
+cot_postdec = 54
+cot_preinc = 55
+cot_predec = 56
+cot_call = 57
+cot_idx = 58
+cot_memref = 59
+cot_memptr = 60
+cot_num = 61
+cot_fnum = 62
+cot_str = 63
+cot_obj = 64
+cot_var = 65
+cot_insn = 66
+cot_sizeof = 67
+cot_helper = 68
+cot_type = 69
+cit_empty = 70
+cit_block = 71
+cit_expr = 72
+cit_if = 73
+cit_for = 74
+cit_while = 75
+cit_do = 76
+cit_switch = 77
+cit_break = 78
+cit_continue = 79
+cit_return = 80
+cit_goto = 81
+cit_asm = 82
+cit_end = 83
+# ops, that are not known to snapshots, their names are saved instead
+cot_unknown = -1
+cit_unknown = -2
+
+CTREE_OPS = {name: op for name, op in globals().items() if name.startswith(("cot_", "cit_")) and op >= 0}
+OP_NAMES = {op: name for name, op in CTREE_OPS.items()}
+
+bool_operations = {
+	cot_uge, cot_sge,
+	cot_sgt, cot_eq, cot_ne, cot_slt,
+	cot_land, cot_sle, cot_ult,
+	cot_ule, cot_lor, cot_ugt,
+}
+
+binary_operations = {
+	cot_mul, cot_sub, cot_bor, cot_band,
+	cot_sshr, cot_ushr, cot_shl, cot_add,
+	cot_sdiv, cot_udiv, cot_smod, cot_umod,
+	cot_xor,
+}
+
+fbinary_operations = {
+	cot_fadd, cot_fdiv, cot_fmul, cot_fsub,
+}
+
+unary_operations = {cot_lnot, cot_sizeof}
+
+keep_type_operations = bool_operations | fbinary_operations | unary_operations
+
+int_rw_operations = {
+	cot_postdec, cot_predec, cot_preinc,
+	cot_postinc,
+}
+
+value_rw_operations = {
+	cot_asgadd, cot_asgband, cot_asgbor,
+	cot_asgmul, cot_asgsdiv, cot_asgshl,
+	cot_asgsmod, cot_asgsshr, cot_asgsub,
+	cot_asgudiv, cot_asgumod, cot_asgushr,
+	cot_asgxor,
+}
+
+# ops, whose literal type is saved in snapshot
+literal_type_operations = keep_type_operations | {
+	cot_num, cot_fnum, cot_str, cot_memref, cot_helper, cot_type,
+}
+
+nop_instructions = {
+	cit_switch, cit_asm, cit_empty, cit_goto, cit_end, cit_break, cit_continue,
+}
+
+op2use_type = {
+	cot_ptr: VAR_PTR,
+	cot_memptr: VAR_PTR,
+	cot_memref: VAR_REF,
+	cot_ref: VAR_REF,
+	cot_idx: VAR_PTR,
+	cot_add: VAR_ADD,
+	cot_sub: VAR_ADD,
+}
+
+# kinds of calls, decided when taking snapshot
+CALL_REGULAR = 0
+CALL_MEMSET = 1
+CALL_IMPORT = 2
+CALL_HELPER = 3
+
+# kinds of helper calls
+HELPER_KNOWN = 0
+HELPER_PARTIAL = 1
+HELPER_COMBINE = 2
+HELPER_INTERLOCKED_ASG = 3
+HELPER_INTERLOCKED_RV = 4
+HELPER_VA_ARG = 5
+HELPER_COERCE = 6
+HELPER_ADJ = 7
+HELPER_UNKNOWN = 8
+
+# lifting of ctree item, that yields steps of nested items and gets their results back
+Steps = Generator[Any, Any, Any]
+
+
+def run_steps(steps:Steps) -> Any:
+	"""
+	Runs steps and their nested steps without python recursion, nested steps are kept on a stack
+	so deeply nested ctrees, e.g. long comma chains, do not hit recursion limit
+	"""
+	stack = [steps]
+	result = None
+	while len(stack) != 0:
+		try:
+			nested = stack[-1].send(result)
+		except StopIteration as stop:
+			stack.pop()
+			result = stop.value
+			continue
+		stack.append(nested)
+		result = None
+	return result
+
+
+def is_typeful(node_type:int, sexpr_op:int, is_explicit_call:bool, is_var:bool) -> bool:
+	"""
+	Typeful node is a node, that can affect types, the rest is removed when shrinking TFGs
+	is_var is for var use chains without uses
+	"""
+	if node_type == NODE_CALL_CAST and sexpr_op == SEXPR_LITERAL:
+		return False
+
+	elif node_type == NODE_EXPR:
+		if is_explicit_call:
+			return False
+		if sexpr_op == SEXPR_UNKNOWN:
+			return False
+		if sexpr_op == SEXPR_LITERAL:
+			return False
+		if is_var:
+			return False
+
+	if node_type == NODE_TYPE_CAST and sexpr_op == SEXPR_LITERAL:
+		return False
+
+	return True
+
+
+class CTreeSnapshot:
+	"""
+	Plain data copy of cfunc ctree, expressions and instructions refer to each other by index
+	expr is (op, ea, x, y, z, type_id, extra), instr is (op, ea, extra)
+	extra depends on op, e.g. var index for cot_var or call details for cot_call
+	types are referred by ids, types themselves stay in process, that took snapshot
+	"""
+	def __init__(self, func_ea:int):
+		self.func_ea = func_ea
+		self.exprs : list[tuple] = []
+		self.instrs : list[tuple] = []
+		self.body = -1
+		# id of "int" type, that is used by some lifting rules
+		self.int_type = -1
+
+
+class SnapshotLifter:
+	"""
+	Lifts snapshot into payload of shrunk TFG, that TFGDecoder can read
+	nodes are ints, sexprs are entries of hash-consing table, just like in payload
+	with only_vars lifting is partial, only instrs exprs, that mention these vars, are lifted
+	and everything else is left as control flow skeleton of nops and returns
+	var uses of only_vars in partial TFG are the same as in full one
+	"""
+	UNKNOWN = -1
+
+	def __init__(self, snapshot:CTreeSnapshot, only_vars:frozenset|None=None):
+		self.snapshot = snapshot
+		# vars are identified the same way as varid of Var
+		self.only_vars = only_vars
+		self.exprs = snapshot.exprs
+		self.instrs = snapshot.instrs
+		self.messages : list[tuple[int,str]] = []
+
+		self.vars : list[Any] = []
+		self.var_ids : dict[Any, int] = {}
+		self.vucs : list[tuple] = []
+		self.vuc_ids : dict[tuple, int] = {}
+		self.sexprs : list[tuple] = []
+		self.sexpr_ids : dict[tuple, int] = {}
+
+		self.node_types : list[int] = []
+		self.node_sexprs : list[int] = []
+		self.node_ys : list[tuple[int,Any]] = []
+		self.node_zs : list[tuple[int,Any]] = []
+		# sexprs are shared, so addresses of exprs are kept in nodes
+		self.node_addrs : list[int] = []
+		self.children : list[set[int]] = []
+		self.parents : list[set[int]] = []
+
+		# vars and var use chains of exprs by expr index
+		self.expr_vars : list[frozenset] = []
+		self.expr_vucs : list[tuple|None] = []
+		self.annotate_exprs()
+
+	def log(self, level:int, msg:str):
+		self.messages.append((level, msg))
+
+	def lift(self) -> tuple:
+		entry, _ = self.lift_instr(self.snapshot.body)
+		dependencies = self.extract_dependencies(entry)
+		return self.make_payload(self.shrink(entry), dependencies)
+
+	def extract_dependencies(self, entry:int) -> set[int]:
+		""" Addresses of functions and global vars, that are mentioned in nodes reachable from entry """
+		visited_nodes = {entry}
+		queue = deque([entry])
+		stack = []
+		while len(queue) != 0:
+			node = queue.popleft()
+			stack.append(self.node_sexprs[node])
+			ztag, z = self.node_zs[node]
+			if ztag == OPERAND_SEXPR:
+				stack.append(z)
+			for child in self.children[node]:
+				if child not in visited_nodes:
+					visited_nodes.add(child)
+					queue.append(child)
+
+		dependencies = set()
+		visited = set()
+		while len(stack) != 0:
+			sexpr = stack.pop()
+			if sexpr == self.UNKNOWN or sexpr in visited:
+				continue
+			visited.add(sexpr)
+
+			op, xtag, x, ytag, y = self.sexprs[sexpr]
+			if op == SEXPR_FUNCTION:
+				dependencies.add(x)
+			elif xtag == OPERAND_VUC:
+				varid = self.vars[self.vucs[x][0]]
+				if isinstance(varid, int):
+					dependencies.add(varid)
+			for tag, value in ((xtag, x), (ytag, y)):
+				if tag == OPERAND_SEXPR:
+					stack.append(value)
+		dependencies.discard(self.snapshot.func_ea)
+		return dependencies
+
+	# sexprs
+
+	def make(self, op:int, x:tuple[int,Any], y:tuple[int,Any]=(OPERAND_NONE, None)) -> int:
+		sexpr = (op, *x, *y)
+		# type literals are never shared, same as SExpr
+		if op != SEXPR_LITERAL and (sexpr_id := self.sexpr_ids.get(sexpr)) is not None:
+			return sexpr_id
+
+		sexpr_id = len(self.sexprs)
+		self.sexprs.append(sexpr)
+		if op != SEXPR_LITERAL:
+			self.sexpr_ids[sexpr] = sexpr_id
+		return sexpr_id
+
+	def sexpr_op(self, sexpr:int) -> int:
+		if sexpr == self.UNKNOWN:
+			return SEXPR_UNKNOWN
+		return self.sexprs[sexpr][0]
+
+	def operand(self, sexpr:int) -> tuple[int,Any]:
+		if sexpr == self.UNKNOWN:
+			return OPERAND_UNKNOWN_SEXPR, None
+		return OPERAND_SEXPR, sexpr
+
+	def type_operand(self, type_id:int) -> tuple[int,Any]:
+		if type_id == -1:
+			return OPERAND_UNKNOWN_TYPE, None
+		return OPERAND_TIF, type_id
+
+	def create_literal(self, type_id:int) -> int:
+		return self.make(SEXPR_LITERAL, self.type_operand(type_id))
+
+	def create_var_use_chain(self, vuc:tuple) -> int:
+		varid, uses = vuc
+		if (var_id := self.var_ids.get(varid)) is None:
+			var_id = len(self.vars)
+			self.vars.append(varid)
+			self.var_ids[varid] = var_id
+
+		key = (var_id, tuple(v for use in uses for v in use))
+		if (vuc_id := self.vuc_ids.get(key)) is None:
+			vuc_id = len(self.vucs)
+			self.vucs.append(key)
+			self.vuc_ids[key] = vuc_id
+		return self.make(SEXPR_VAR_USE_CHAIN, (OPERAND_VUC, vuc_id))
+
+	def create(self, op:int, x:int, y:int|None=None) -> int:
+		""" sexpr with sexpr operands """
+		y_operand = (OPERAND_NONE, None) if y is None else self.operand(y)
+		return self.make(op, self.operand(x), y_operand)
+
+	def create_ptr(self, base:int, offset=0) -> int:
+		return self.make(SEXPR_PTR, self.operand(base), (OPERAND_VALUE, offset))
+
+	# nodes
+
+	def new_node(self, node_type:int, sexpr:int, y:tuple[int,Any]=(OPERAND_NONE, None), z:tuple[int,Any]=(OPERAND_NONE, None), addr=-1) -> int:
+		node = len(self.node_types)
+		self.node_types.append(node_type)
+		self.node_sexprs.append(sexpr)
+		self.node_ys.append(y)
+		self.node_zs.append(z)
+		self.node_addrs.append(addr)
+		self.children.append(set())
+		self.parents.append(set())
+		return node
+
+	def nop_node(self) -> int:
+		return self.new_node(NODE_EXPR, self.UNKNOWN)
+
+	def chain_nodes(self, parent:int, child:int):
+		self.children[parent].add(child)
+		self.parents[child].add(parent)
+
+	def remove_node(self, node:int):
+		parents = self.parents[node]
+		children = self.children[node]
+		for parent in parents:
+			self.children[parent].remove(node)
+		for child in children:
+			self.parents[child].remove(node)
+		for parent in parents:
+			for child in children:
+				self.chain_nodes(parent, child)
+
+	def chain_fragments(self, *fragments:tuple[int, list[int]]) -> list[int]:
+		"""
+		fragment is a tuple (entry, exits), where exits are its leaf nodes, that are not returns
+		links exits of each fragment to entry of the next one and returns exits of the chain
+		chain has no exits, if some fragment has no exits, because next ones are unreachable
+		"""
+		exits = fragments[0][1]
+		for i in range(len(fragments) - 1):
+			child = fragments[i + 1][0]
+			for exit in fragments[i][1]:
+				self.chain_nodes(exit, child)
+			if len(exits) != 0:
+				exits = fragments[i + 1][1]
+		return exits
+
+	# expressions
+
+	def strip_casts(self, expr:int) -> int:
+		while self.exprs[expr][0] == cot_cast:
+			expr = self.exprs[expr][2]
+		return expr
+
+	def expr_addr(self, expr:int) -> int:
+		""" address of node, that expr is lifted into """
+		return self.exprs[self.strip_casts(expr)][1]
+
+	def get_int(self, expr:int) -> int|None:
+		expr = self.strip_casts(expr)
+		op, _, x, _, _, _, extra = self.exprs[expr]
+		if op == cot_ref and self.exprs[x][0] == cot_obj:
+			return self.exprs[x][6][0]
+		if op == cot_obj:
+			return extra[0]
+		if op == cot_num or op == cot_sizeof:
+			return extra
+		return None
+
+	def get_var(self, expr:int) -> Any:
+		op, _, _, _, _, _, extra = self.exprs[self.strip_casts(expr)]
+		if op == cot_var:
+			return (self.snapshot.func_ea, extra)
+		if op == cot_obj and not extra[1]:
+			return extra[0]
+		return None
+
+	def extract_vars(self, expr:int) -> frozenset:
+		return self.expr_vars[expr]
+
+	def get_var_helper(self, expr:int) -> tuple|None:
+		op, _, _, _, _, _, extra = self.exprs[expr]
+		if op != cot_call or extra[0] != CALL_HELPER or len(extra[1]) != 1:
+			return None
+		if extra[2] != HELPER_PARTIAL:
+			return None
+		if (var := self.get_var(extra[1][0])) is None:
+			return None
+		return (var, ((extra[3], VAR_HELPER),))
+
+	def get_var_use_chain(self, expr:int) -> tuple|None:
+		return self.expr_vucs[expr]
+
+	def annotate_exprs(self):
+		"""
+		vars and var use chains of every expr in a single bottom-up pass
+		operands are taken into snapshot before their expr, so they are annotated first
+		"""
+		no_vars : frozenset = frozenset()
+		expr_vars = self.expr_vars
+		expr_vucs = self.expr_vucs
+		func_ea = self.snapshot.func_ea
+		# sets and chains of single vars are shared
+		var_annotations : dict[Any, tuple[frozenset, tuple]] = {}
+		for expr, (op, _, x, y, z, _, extra) in enumerate(self.exprs):
+			# casts are transparent
+			if op == cot_cast:
+				expr_vars.append(expr_vars[x])
+				expr_vucs.append(expr_vucs[x])
+				continue
+
+			if op == cot_var:
+				var = (func_ea, extra)
+			elif op == cot_obj and not extra[1]:
+				var = extra[0]
+			else:
+				var = None
+
+			if var is not None:
+				if (annotation := var_annotations.get(var)) is None:
+					annotation = (frozenset((var,)), (var, ()))
+					var_annotations[var] = annotation
+				expr_vars.append(annotation[0])
+				expr_vucs.append(annotation[1])
+				continue
+
+			vars = no_vars if x == -1 else expr_vars[x]
+			for operand in (y, z, *extra[1]) if op == cot_call else (y, z):
+				if operand == -1:
+					continue
+				operand_vars = expr_vars[operand]
+				if len(operand_vars) == 0 or operand_vars is vars:
+					continue
+				vars = operand_vars if len(vars) == 0 else vars | operand_vars
+			expr_vars.append(vars)
+
+			if len(vars) != 1 or op == cot_num:
+				vuc = None
+			elif op == cot_call:
+				vuc = self.get_var_helper(expr)
+			elif (use_type := op2use_type.get(op)) is not None and (x_vuc := expr_vucs[x]) is not None:
+				vuc = self.extend_var_use_chain(expr, x_vuc, use_type)
+			else:
+				vuc = None
+			expr_vucs.append(vuc)
+
+	def extend_var_use_chain(self, expr:int, vuc:tuple, use_type:int) -> tuple|None:
+		op, _, _, y, _, _, extra = self.exprs[expr]
+		if op in (cot_ptr, cot_ref):
+			offset = 0
+		elif op == cot_memptr:
+			offset = extra
+		elif op == cot_memref:
+			offset = extra[0]
+		else:
+			offset = self.get_int(y)
+			if offset is None:
+				return None
+			if op == cot_sub:
+				offset = -offset
+			# pointed object size, if x is pointer
+			ptr_size = extra[0] if op == cot_idx else extra
+			if ptr_size is not None:
+				offset *= ptr_size
+
+		return (vuc[0], vuc[1] + ((offset, use_type),))
+
+	def lift_cexpr(self, expr:int) -> tuple[int,int]:
+		"""
+		returns tuple (tree_start, tree_end)
+		tree_end holds type of final expr
+		tree_start can be the same as tree_end
+		"""
+		return run_steps(self.lift_cexpr_steps(expr))
+
+	def lift_cexpr_steps(self, expr:int) -> Steps:
+		expr = self.strip_casts(expr)
+		expr_tuple = self.exprs[expr]
+		op = expr_tuple[0]
+		trees : list[tuple[int, list[int]]] = []
+		if op in op2use_type and (vuc := self.get_var_use_chain(expr)) is not None:
+			type_expr = self.create_var_use_chain(vuc)
+		else:
+			lifter = op2lifter.get(op, SnapshotLifter.lift_unknown)
+			type_expr = yield from self.complete(lifter(self, expr_tuple, trees))
+
+		type_node = self.new_node(NODE_EXPR, type_expr, addr=expr_tuple[1])
+		self.append_node(trees, type_node)
+		start = trees[0][0]
+		self.chain_fragments(*trees)
+		return start, type_node
+
+	def complete(self, lifted:int|Steps) -> Steps:
+		""" lifters, that do not lift operands, return sexpr right away instead of steps """
+		if isinstance(lifted, int):
+			return lifted
+		return (yield from lifted)
+
+	def lift_reuse(self, trees:list, expr:int) -> Steps:
+		"""
+		get a tree and later reuse sexpr of end node
+		if start and end are the same, then reusing both of them and no start is return
+		if start and end are different, then add start to trees to chain later
+		"""
+		s, e = yield self.lift_cexpr_steps(expr)
+		if s != e:
+			# previous node becomes exit of the tree
+			exits = list(self.parents[e])
+			self.remove_node(e)
+			trees.append((s, exits))
+		return self.node_sexprs[e]
+
+	def append_node(self, trees:list, node:int):
+		trees.append((node, [node]))
+
+	def append_expr(self, trees:list, sexpr:int, addr=-1):
+		self.append_node(trees, self.new_node(NODE_EXPR, sexpr, addr=addr))
+
+	def lift_append(self, trees:list, expr:int) -> Steps:
+		s, e = yield self.lift_cexpr_steps(expr)
+		trees.append((s, [e]))
+		return e
+
+	def append_type_cast(self, trees:list, sexpr:int, type_id:int, addr=-1):
+		self.append_node(trees, self.new_node(NODE_TYPE_CAST, sexpr, self.type_operand(type_id), addr=addr))
+
+	# expression lifters, every one appends trees of subexpressions and returns sexpr of expr
+	# expr is a tuple of snapshot
+	# lifters of operands are steps, others return sexpr right away
+
+	def lift_asg(self, expr:tuple, trees:list) -> Steps:
+		target = yield from self.lift_reuse(trees, expr[2])
+		value = yield from self.lift_reuse(trees, expr[3])
+		return self.create(SEXPR_ASSIGN, target, value)
+
+	def lift_call(self, expr:tuple, trees:list) -> Steps:
+		call_kind = expr[6][0]
+		if call_kind == CALL_MEMSET:
+			_, args, arg0_type, arg1_type, arg2_type, ret_type = expr[6]
+			for arg, arg_type in zip(args, (arg0_type, arg1_type, arg2_type)):
+				self.append_type_cast(trees, (yield from self.lift_reuse(trees, arg)), arg_type, self.expr_addr(arg))
+			return self.create_literal(ret_type)
+
+		if call_kind == CALL_HELPER:
+			return (yield from self.complete(helper_kind2lifter[expr[6][2]](self, expr, trees)))
+
+		if call_kind == CALL_IMPORT:
+			_, args, ret_type, arg_types = expr[6]
+			type_expr = self.create_literal(ret_type)
+			for arg, arg_type in zip(args, arg_types):
+				arg_sexpr = yield from self.lift_reuse(trees, self.strip_casts(arg))
+				self.append_type_cast(trees, arg_sexpr, arg_type, self.expr_addr(arg))
+			return type_expr
+
+		call_func = yield from self.lift_reuse(trees, expr[2])
+		for arg_id, arg in enumerate(expr[6][1]):
+			arg_sexpr = yield from self.lift_reuse(trees, self.strip_casts(arg))
+			call_cast = self.new_node(NODE_CALL_CAST, arg_sexpr, (OPERAND_VALUE, arg_id), self.operand(call_func), self.expr_addr(arg))
+			self.append_node(trees, call_cast)
+		return self.create(SEXPR_CALL, call_func)
+
+	def lift_known_helper(self, expr:tuple, trees:list) -> Steps:
+		_, args, _, arg_types, ret_type = expr[6]
+		for arg, arg_type in zip(args, arg_types):
+			self.append_type_cast(trees, (yield from self.lift_reuse(trees, arg)), arg_type, self.expr_addr(arg))
+		return self.create_literal(ret_type)
+
+	def lift_partial_helper(self, expr:tuple, trees:list) -> Steps:
+		_, args, _, _, offset, size = expr[6]
+		arg = yield from self.lift_reuse(trees, args[0])
+		return self.make(SEXPR_PARTIAL, self.operand(arg), (OPERAND_VALUE, (offset, size)))
+
+	def lift_combine_helper(self, expr:tuple, trees:list) -> Steps:
+		args = expr[6][1]
+		arg0 = yield from self.lift_reuse(trees, args[0])
+		arg1 = yield from self.lift_reuse(trees, args[1])
+		return self.create(SEXPR_COMBINE, arg0, arg1)
+
+	def lift_interlocked_asg_helper(self, expr:tuple, trees:list) -> Steps:
+		_, args, _, ret_type = expr[6]
+		# if cmp xchg, then more info can be gained from comparand
+		if len(args) == 3:
+			yield from self.lift_append(trees, args[2])
+
+		target = yield from self.lift_reuse(trees, args[0])
+		target = self.create_ptr(target)
+		value = yield from self.lift_reuse(trees, args[1])
+		self.append_expr(trees, self.create(SEXPR_ASSIGN, target, value), expr[1])
+		return self.create_literal(ret_type)
+
+	def lift_interlocked_rv_helper(self, expr:tuple, trees:list) -> Steps:
+		_, args, _, ret_type = expr[6]
+		target = yield from self.lift_reuse(trees, args[0])
+		target = self.create_ptr(target)
+		if len(args) > 1:
+			value = yield from self.lift_reuse(trees, args[1])
+		else:
+			value = self.create_literal(self.snapshot.int_type)
+		self.append_expr(trees, self.create(SEXPR_RW_OP, target, value), expr[1])
+		return self.create_literal(ret_type)
+
+	def lift_va_arg_helper(self, expr:tuple, trees:list) -> Steps:
+		_, args, _, arg0_type, ret_type = expr[6]
+		self.append_type_cast(trees, (yield from self.lift_reuse(trees, args[0])), arg0_type, self.expr_addr(args[0]))
+		return self.create_literal(ret_type)
+
+	# casts are skipped
+	def lift_coerce_helper(self, expr:tuple, trees:list) -> Steps:
+		return (yield from self.lift_reuse(trees, expr[6][1][0]))
+
+	def lift_adj_helper(self, expr:tuple, trees:list) -> Steps:
+		_, args, _, offset, adj_info = expr[6]
+		arg = args[0]
+		if offset is None:
+			self.log(logging.ERROR, adj_info)
+			return self.UNKNOWN
+
+		if self.exprs[arg][0] == cot_var:
+			vuc = ((adj_info, self.exprs[arg][6]), ((offset, VAR_ADD),))
+			return self.create_var_use_chain(vuc)
+
+		sexpr = yield from self.lift_reuse(trees, arg)
+		i = self.create_literal(self.snapshot.int_type)
+		return self.create(SEXPR_BINARY_OP, sexpr, i)
+
+	def lift_unknown_helper(self, expr:tuple, trees:list) -> int:
+		self.log(logging.WARNING, expr[6][3])
+		return self.UNKNOWN
+
+	# AST literals become type literals
+	def lift_literal(self, expr:tuple, trees:list) -> int:
+		return self.create_literal(expr[5])
+
+	def lift_obj(self, expr:tuple, trees:list) -> int:
+		obj_ea, is_func_start, is_func_import = expr[6]
+		if is_func_start or is_func_import:
+			return self.make(SEXPR_FUNCTION, (OPERAND_VALUE, obj_ea))
+		return self.create_var_use_chain((obj_ea, ()))
+
+	def lift_var(self, expr:tuple, trees:list) -> int:
+		return self.create_var_use_chain(((self.snapshot.func_ea, expr[6]), ()))
+
+	# operations, that create type literal SExpr as result
+	def lift_keep_type(self, expr:tuple, trees:list) -> Steps:
+		_, _, x, y, _, type_id, _ = expr
+		if x != -1:
+			yield from self.lift_append(trees, x)
+		if y != -1:
+			yield from self.lift_append(trees, y)
+		return self.create_literal(type_id)
+
+	def lift_int_rw(self, expr:tuple, trees:list) -> Steps:
+		target = yield from self.lift_reuse(trees, expr[2])
+		value = self.create_literal(self.snapshot.int_type)
+		return self.create(SEXPR_RW_OP, target, value)
+
+	# -expr and ~expr do not change type
+	def lift_keep_operand(self, expr:tuple, trees:list) -> Steps:
+		return (yield from self.lift_reuse(trees, expr[2]))
+
+	def lift_tern(self, expr:tuple, trees:list) -> Steps:
+		_, _, x, y, z, _, _ = expr
+		yield from self.lift_append(trees, x)
+		tern_x = yield from self.lift_reuse(trees, y)
+		tern_y = yield from self.lift_reuse(trees, z)
+		return self.create(SEXPR_TERN, tern_x, tern_y)
+
+	def lift_value_rw(self, expr:tuple, trees:list) -> Steps:
+		target = yield from self.lift_reuse(trees, expr[2])
+		value = yield from self.lift_reuse(trees, expr[3])
+		return self.create(SEXPR_RW_OP, target, value)
+
+	def lift_ref(self, expr:tuple, trees:list) -> Steps:
+		return self.create(SEXPR_REF, (yield from self.lift_reuse(trees, expr[2])))
+
+	def lift_ptr(self, expr:tuple, trees:list) -> Steps:
+		return self.create_ptr((yield from self.lift_reuse(trees, expr[2])))
+
+	def lift_binary(self, expr:tuple, trees:list) -> Steps:
+		bin_x = yield from self.lift_reuse(trees, expr[2])
+		bin_y = yield from self.lift_reuse(trees, expr[3])
+		return self.create(SEXPR_BINARY_OP, bin_x, bin_y)
+
+	def lift_empty(self, expr:tuple, trees:list) -> int:
+		return self.UNKNOWN
+
+	def lift_idx(self, expr:tuple, trees:list) -> Steps:
+		_, _, x, y, _, _, extra = expr
+		arr = yield from self.lift_reuse(trees, x)
+		idx = yield from self.lift_reuse(trees, y)
+		ptr_size, y_integral = extra
+		if ptr_size is not None and y_integral: # pointer arithmetics
+			i = self.create_literal(self.snapshot.int_type)
+			idx = self.create(SEXPR_BINARY_OP, idx, i)
+		add_expr = self.create(SEXPR_BINARY_OP, arr, idx)
+		return self.create_ptr(add_expr)
+
+	def lift_comma(self, expr:tuple, trees:list) -> Steps:
+		yield from self.lift_append(trees, expr[2])
+		return (yield from self.lift_reuse(trees, expr[3]))
+
+	def lift_memptr(self, expr:tuple, trees:list) -> Steps:
+		return self.create_ptr((yield from self.lift_reuse(trees, expr[2])), expr[6])
+
+	def lift_memref(self, expr:tuple, trees:list) -> Steps:
+		sexpr = yield from self.lift_reuse(trees, expr[2])
+		if self.sexpr_op(sexpr) == SEXPR_LITERAL:
+			return self.create_literal(expr[5])
+
+		# selecting union's field
+		if expr[6][1]:
+			return sexpr
+
+		# selecting structure's field
+		i = self.create_literal(self.snapshot.int_type)
+		return self.create(SEXPR_BINARY_OP, sexpr, i)
+
+	def lift_helper(self, expr:tuple, trees:list) -> int:
+		helper, is_segment = expr[6]
+		if is_segment:
+			return self.create_literal(expr[5])
+
+		# rogue stack reads
+		if helper.startswith("STACK[0x"):
+			return self.UNKNOWN
+
+		return self.lift_unknown(expr, trees)
+
+	def lift_type(self, expr:tuple, trees:list) -> int:
+		return self.create_literal(expr[5])
+
+	def lift_unknown(self, expr:tuple, trees:list) -> int:
+		op, ea, _, _, _, _, extra = expr
+		opname = extra if op == cot_unknown else OP_NAMES.get(op)
+		self.log(logging.WARNING, f"failed to lift {opname} at {hex(ea)} in {hex(self.snapshot.func_ea)}")
+		return self.UNKNOWN
+
+	def lift_instr(self, instr:int) -> tuple[int, list[int]]:
+		"""
+		returns tuple (entry, exits)
+		exits are kept while lifting, so chaining instructions does not traverse them again
+		"""
+		return run_steps(self.lift_instr_steps(instr))
+
+	def lift_instr_cexpr_steps(self, expr:int) -> Steps:
+		""" steps of lifting expr of instr, partial lifts replace exprs without vars of interest with nop """
+		if self.only_vars is not None and self.expr_vars[expr].isdisjoint(self.only_vars):
+			nop = self.nop_node()
+			return nop, nop
+		return (yield self.lift_cexpr_steps(expr))
+
+	def lift_instr_steps(self, instr:int) -> Steps:
+		""" steps of lift_instr, nested instrs and exprs are lifted by yielding their steps """
+		op, _, extra = self.instrs[instr]
+		if op == cit_expr:
+			entry, exit = yield from self.lift_instr_cexpr_steps(extra)
+			exits = [exit]
+		elif op == cit_block:
+			instrs = []
+			for i in extra:
+				instrs.append((yield self.lift_instr_steps(i)))
+			entry = instrs[0][0]
+			exits = self.chain_fragments(*instrs)
+		elif op == cit_if:
+			cond, ithen, ielse = extra
+			entry, exit = yield from self.lift_instr_cexpr_steps(cond)
+			then_entry, then_exits = yield self.lift_instr_steps(ithen)
+			if ielse != -1:
+				else_entry, else_exits = yield self.lift_instr_steps(ielse)
+			else:
+				else_entry = self.nop_node()
+				else_exits = [else_entry]
+			self.chain_nodes(exit, then_entry)
+			self.chain_nodes(exit, else_entry)
+			exits = then_exits + else_exits
+		elif op == cit_for:
+			init, cond, step, body = extra
+			entry, init_end = yield from self.lift_instr_cexpr_steps(init)
+			expr_start, expr_end = yield from self.lift_instr_cexpr_steps(cond)
+			step_start, step_end = yield from self.lift_instr_cexpr_steps(step)
+			body_fragment = yield self.lift_instr_steps(body)
+			exits = self.chain_fragments((entry, [init_end]), (expr_start, [expr_end]), body_fragment, (step_start, [step_end]))
+		elif op == cit_while:
+			cond, body = extra
+			entry, exit = yield from self.lift_instr_cexpr_steps(cond)
+			body_entry, exits = yield self.lift_instr_steps(body)
+			self.chain_nodes(exit, body_entry)
+		elif op == cit_do:
+			cond, body = extra
+			sexpr_entry, sexpr_exit = yield from self.lift_instr_cexpr_steps(cond)
+			body_fragment = yield self.lift_instr_steps(body)
+			entry = body_fragment[0]
+			exits = self.chain_fragments(body_fragment, (sexpr_entry, [sexpr_exit]))
+		elif op == cit_return:
+			entry, exit = yield from self.lift_instr_cexpr_steps(extra)
+			self.node_types[exit] = NODE_RETURN
+			exits = []
+		elif op in nop_instructions:
+			entry = self.nop_node()
+			exits = [entry]
+		else:
+			entry = self.nop_node()
+			exits = [entry]
+			opname = extra if op == cit_unknown else OP_NAMES.get(op)
+			self.log(logging.ERROR, f"unknown instr operand {opname}")
+		return entry, exits
+
+	# shrinking
+
+	def is_typeful_node(self, node:int) -> bool:
+		sexpr = self.node_sexprs[node]
+		sexpr_op = self.sexpr_op(sexpr)
+		is_explicit_call = False
+		is_var = False
+		if sexpr_op == SEXPR_CALL:
+			_, xtag, x, _, _ = self.sexprs[sexpr]
+			is_explicit_call = xtag == OPERAND_SEXPR and self.sexpr_op(x) == SEXPR_FUNCTION
+		elif sexpr_op == SEXPR_VAR_USE_CHAIN:
+			_, _, x, _, _ = self.sexprs[sexpr]
+			is_var = len(self.vucs[x][1]) == 0
+		return is_typeful(self.node_types[node], sexpr_op, is_explicit_call, is_var)
+
+	def shrink(self, entry:int) -> CompactGraph:
+		graph = CompactGraph.from_entry(entry, lambda n: self.children[n])
+		nodes_before, edges_before = len(graph), graph.edges_count()
+		graph = self.shrink_graph(graph)
+		self.log(logging.DEBUG, f"shrunk TFG of {hex(self.snapshot.func_ea)} nodes {nodes_before}->{len(graph)} edges {edges_before}->{graph.edges_count()}")
+		return graph
+
+	def shrink_graph(self, graph:CompactGraph) -> CompactGraph:
+		keep = {i for i, n in enumerate(graph.nodes) if self.is_typeful_node(n)}
+		return graph.reduce(keep, self.nop_node)
+
+	def make_payload(self, graph:CompactGraph, dependencies:set[int]) -> tuple:
+		""" Payload with only sexprs, var use chains and vars, that are used by graph nodes """
+		used_sexprs = [False] * len(self.sexprs)
+		for node in graph.nodes:
+			for tag, value in ((OPERAND_SEXPR, self.node_sexprs[node]), self.node_zs[node]):
+				if tag == OPERAND_SEXPR and value != self.UNKNOWN:
+					used_sexprs[value] = True
+
+		# operands are always before sexprs, that use them
+		used_vucs = [False] * len(self.vucs)
+		for sexpr_id in range(len(self.sexprs) - 1, -1, -1):
+			if not used_sexprs[sexpr_id]:
+				continue
+			_, xtag, x, ytag, y = self.sexprs[sexpr_id]
+			for tag, value in ((xtag, x), (ytag, y)):
+				if tag == OPERAND_SEXPR:
+					used_sexprs[value] = True
+				elif tag == OPERAND_VUC:
+					used_vucs[value] = True
+
+		vuc_ids = {}
+		var_ids = {}
+		vars = []
+		vucs = []
+		for vuc_id, is_used in enumerate(used_vucs):
+			if not is_used:
+				continue
+			var_id, uses = self.vucs[vuc_id]
+			if var_id not in var_ids:
+				var_ids[var_id] = len(vars)
+				vars.append(self.vars[var_id])
+			vuc_ids[vuc_id] = len(vucs)
+			vucs.append((var_ids[var_id], uses))
+
+		sexpr_ids = {}
+		def remap(tag:int, value:Any) -> tuple[int,Any]:
+			if tag == OPERAND_SEXPR:
+				if value == self.UNKNOWN:
+					return OPERAND_UNKNOWN_SEXPR, None
+				return tag, sexpr_ids[value]
+			if tag == OPERAND_VUC:
+				return tag, vuc_ids[value]
+			return tag, value
+
+		sexprs = []
+		for sexpr_id, is_used in enumerate(used_sexprs):
+			if not is_used:
+				continue
+			op, xtag, x, ytag, y = self.sexprs[sexpr_id]
+			sexpr_ids[sexpr_id] = len(sexprs)
+			sexprs.append((op, *remap(xtag, x), *remap(ytag, y)))
+
+		nodes = []
+		for node in graph.nodes:
+			nodes.append((
+				self.node_types[node],
+				*remap(OPERAND_SEXPR, self.node_sexprs[node]),
+				*remap(*self.node_ys[node]),
+				*remap(*self.node_zs[node]),
+				self.node_addrs[node],
+			))
+
+		return (
+			FORMAT_VERSION,
+			b'',
+			vars,
+			vucs,
+			None,
+			sexprs,
+			nodes,
+			graph.child_offsets.tobytes(),
+			graph.child_targets.tobytes(),
+			tuple(dependencies),
+			b'',
+		)
+
+
+# handlers of expr ops, ops of var use chains are tried as var use chains first
+op2lifter = {
+	cot_asg: SnapshotLifter.lift_asg,
+	cot_call: SnapshotLifter.lift_call,
+	cot_num: SnapshotLifter.lift_literal,
+	cot_fnum: SnapshotLifter.lift_literal,
+	cot_str: SnapshotLifter.lift_literal,
+	cot_obj: SnapshotLifter.lift_obj,
+	cot_var: SnapshotLifter.lift_var,
+	cot_neg: SnapshotLifter.lift_keep_operand,
+	cot_bnot: SnapshotLifter.lift_keep_operand,
+	cot_fneg: SnapshotLifter.lift_keep_operand,
+	cot_tern: SnapshotLifter.lift_tern,
+	cot_ref: SnapshotLifter.lift_ref,
+	cot_ptr: SnapshotLifter.lift_ptr,
+	cot_empty: SnapshotLifter.lift_empty,
+	cot_idx: SnapshotLifter.lift_idx,
+	cot_comma: SnapshotLifter.lift_comma,
+	cot_memptr: SnapshotLifter.lift_memptr,
+	cot_memref: SnapshotLifter.lift_memref,
+	cot_helper: SnapshotLifter.lift_helper,
+	cot_type: SnapshotLifter.lift_type,
+}
+op2lifter.update({op: SnapshotLifter.lift_keep_type for op in keep_type_operations})
+op2lifter.update({op: SnapshotLifter.lift_int_rw for op in int_rw_operations})
+op2lifter.update({op: SnapshotLifter.lift_value_rw for op in value_rw_operations})
+op2lifter.update({op: SnapshotLifter.lift_binary for op in binary_operations})
+
+# handlers of helper calls by helper kind, that was decided when taking snapshot
+helper_kind2lifter = {
+	HELPER_KNOWN: SnapshotLifter.lift_known_helper,
+	HELPER_PARTIAL: SnapshotLifter.lift_partial_helper,
+	HELPER_COMBINE: SnapshotLifter.lift_combine_helper,
+	HELPER_INTERLOCKED_ASG: SnapshotLifter.lift_interlocked_asg_helper,
+	HELPER_INTERLOCKED_RV: SnapshotLifter.lift_interlocked_rv_helper,
+	HELPER_VA_ARG: SnapshotLifter.lift_va_arg_helper,
+	HELPER_COERCE: SnapshotLifter.lift_coerce_helper,
+	HELPER_ADJ: SnapshotLifter.lift_adj_helper,
+	HELPER_UNKNOWN: SnapshotLifter.lift_unknown_helper,
+}
+
+
+def lift_snapshot(snapshot:CTreeSnapshot, only_vars:frozenset|None=None) -> tuple[tuple, list[tuple[int,str]]]:
+	""" Lifts snapshot into TFG payload, returns payload and log messages. Runs in worker processes """
+	lifter = SnapshotLifter(snapshot, only_vars)
+	payload = lifter.lift()
+	return payload, lifter.messages
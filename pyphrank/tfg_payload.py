@@ -0,0 +1,42 @@
+"""
+Layout of serialized TFGs, shared by TFG storage and snapshot lifter
+does not import IDA modules, so can be used in worker processes
+"""
+
+# must be increased on any change of payload layout
+FORMAT_VERSION = 3
+
+# tags of serialized sexpr and node operands
+OPERAND_NONE = 0
+OPERAND_VALUE = 1
+OPERAND_SEXPR = 2
+OPERAND_VUC = 3
+OPERAND_TIF = 4
+OPERAND_UNKNOWN_SEXPR = 5
+OPERAND_UNKNOWN_TYPE = 6
+
+# copies of Node, SExpr and VarUse constants, must be equal to originals
+NODE_RETURN = 0
+NODE_EXPR = 1
+NODE_CALL_CAST = 2
+NODE_TYPE_CAST = 3
+
+SEXPR_UNKNOWN = -1
+SEXPR_LITERAL = 0
+SEXPR_VAR_USE_CHAIN = 1
+SEXPR_FUNCTION = 2
+SEXPR_BOOL_OP = 3
+SEXPR_CALL = 4
+SEXPR_ASSIGN = 5
+SEXPR_BINARY_OP = 6
+SEXPR_RW_OP = 7
+SEXPR_REF = 8
+SEXPR_PTR = 9
+SEXPR_TERN = 10
+SEXPR_PARTIAL = 11
+SEXPR_COMBINE = 12
+
+VAR_ADD = 0
+VAR_PTR = 1
+VAR_HELPER = 2
+VAR_REF = 3
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import marshal
+import zlib
+from array import array
+from typing import Any
+
+import idaapi
+
+import pyphrank.utils as utils
+from pyphrank.type_flow_graph import TFG
+from pyphrank.type_flow_graph_parts import Var, VarUse, VarUseChain, SExpr, Node, UNKNOWN_SEXPR, COMPACTED_EDGES
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.tfg_payload import *
+
+
+class TFGEncoder:
+	"""
+	Flattens TFG into tables of plain values, shared objects are stored once
+	sexprs are stored after their operands, so they can be created in order
+	"""
+	def __init__(self):
+		self.vars : list[Any] = []
+		self.var2id : dict[Var, int] = {}
+		self.vucs : list[tuple] = []
+		self.vuc2id : dict[VarUseChain, int] = {}
+		self.tifs : list[tuple[bytes,bytes]] = []
+		self.tif2id : dict[int, int] = {}
+		self.sexprs : list[tuple] = []
+		self.sexpr2id : dict[int, int] = {}
+
+	def encode(self, tfg:TFG, fingerprint:bytes) -> bytes:
+		graph = tfg.graph
+		nodes = [self.encode_node(node) for node in graph.nodes]
+		payload = (
+			FORMAT_VERSION,
+			fingerprint,
+			self.vars,
+			self.vucs,
+			self.tifs,
+			self.sexprs,
+			nodes,
+			graph.child_offsets.tobytes(),
+			graph.child_targets.tobytes(),
+			tuple(tfg.dependencies),
+			utils.get_types_fingerprint(tfg.dependencies),
+		)
+		return zlib.compress(marshal.dumps(payload, 4))
+
+	def encode_node(self, node:Node) -> tuple:
+		return (
+			node.node_type,
+			*self.encode_operand(node.sexpr),
+			*self.encode_operand(node.y),
+			*self.encode_operand(node.z),
+			node.addr,
+		)
+
+	def encode_operand(self, operand:Any) -> tuple[int,Any]:
+		if operand is None:
+			return OPERAND_NONE, None
+		if operand is UNKNOWN_SEXPR:
+			return OPERAND_UNKNOWN_SEXPR, None
+		if operand is utils.UNKNOWN_TYPE:
+			return OPERAND_UNKNOWN_TYPE, None
+		if isinstance(operand, SExpr):
+			return OPERAND_SEXPR, self.encode_sexpr(operand)
+		if isinstance(operand, VarUseChain):
+			return OPERAND_VUC, self.encode_vuc(operand)
+		if isinstance(operand, idaapi.tinfo_t):
+			return OPERAND_TIF, self.encode_tif(operand)
+		if isinstance(operand, (int, tuple)):
+			return OPERAND_VALUE, operand
+		raise TypeError(f"cant serialize {type(operand)}")
+
+	def encode_sexpr(self, sexpr:SExpr) -> int:
+		# type literals are not hash-consed, so identity is used
+		sexpr_id = self.sexpr2id.get(id(sexpr))
+		if sexpr_id is not None:
+			return sexpr_id
+
+		x = self.encode_operand(sexpr.x)
+		y = self.encode_operand(sexpr.y)
+		sexpr_id = len(self.sexprs)
+		self.sexprs.append((sexpr.op, *x, *y))
+		self.sexpr2id[id(sexpr)] = sexpr_id
+		return sexpr_id
+
+	def encode_vuc(self, vuc:VarUseChain) -> int:
+		vuc_id = self.vuc2id.get(vuc)
+		if vuc_id is not None:
+			return vuc_id
+
+		var_id = self.var2id.get(vuc.var)
+		if var_id is None:
+			var_id = len(self.vars)
+			self.vars.append(vuc.var.varid)
+			self.var2id[vuc.var] = var_id
+
+		uses = tuple(v for use in vuc.uses for v in (use.offset, use.use_type))
+		vuc_id = len(self.vucs)
+		self.vucs.append((var_id, uses))
+		self.vuc2id[vuc] = vuc_id
+		return vuc_id
+
+	def encode_tif(self, tif:idaapi.tinfo_t) -> int:
+		tif_id = self.tif2id.get(id(tif))
+		if tif_id is not None:
+			return tif_id
+
+		serialized = utils.serialize_tif(tif)
+		if serialized is None:
+			raise TypeError(f"failed to serialize {tif}")
+		tif_id = len(self.tifs)
+		self.tifs.append(serialized)
+		self.tif2id[id(tif)] = tif_id
+		return tif_id
+
+
+class TFGDecoder:
+	"""
+	Creates TFG from flattened tables
+	types are either serialized in payload or given as already existing objects
+	"""
+	def __init__(self, payload:tuple, types:list[idaapi.tinfo_t]|None=None):
+		_, _, varids, vucs, tifs, sexprs, nodes, offsets, targets, dependencies, _ = payload
+		self.dependencies = frozenset(dependencies)
+		self.vars = [Var(*v) if isinstance(v, tuple) else Var(v) for v in varids]
+		self.vucs : list[VarUseChain] = []
+		for var_id, uses in vucs:
+			uses = [VarUse(uses[i], uses[i + 1]) for i in range(0, len(uses), 2)]
+			self.vucs.append(VarUseChain(self.vars[var_id], *uses))
+
+		self.tifs : list[idaapi.tinfo_t] = []
+		if types is not None:
+			self.tifs = types
+			tifs = ()
+		for type_str, fields in tifs:
+			tif = utils.deserialize_tif(type_str, fields)
+			if tif is utils.UNKNOWN_TYPE:
+				# type got deleted or changed since saving
+				raise ValueError("failed to deserialize type")
+			self.tifs.append(tif)
+
+		self.sexprs : list[SExpr] = []
+		for op, xtag, x, ytag, y in sexprs:
+			x = self.decode_operand(xtag, x)
+			y = self.decode_operand(ytag, y)
+			self.sexprs.append(SExpr.make(op, x, y))
+
+		self.nodes : list[Node] = []
+		for node_type, stag, s, ytag, y, ztag, z, addr in nodes:
+			node = Node(node_type, self.decode_operand(stag, s), self.decode_operand(ytag, y), self.decode_operand(ztag, z), addr)
+			# loaded graphs are compact from the start
+			node.children = COMPACTED_EDGES
+			node.parents = COMPACTED_EDGES
+			self.nodes.append(node)
+
+		self.child_offsets = array('i')
+		self.child_offsets.frombytes(offsets)
+		self.child_targets = array('i')
+		self.child_targets.frombytes(targets)
+
+	def decode_operand(self, tag:int, value:Any) -> Any:
+		if tag == OPERAND_NONE:
+			return None
+		elif tag == OPERAND_VALUE:
+			return value
+		elif tag == OPERAND_SEXPR:
+			return self.sexprs[value]
+		elif tag == OPERAND_VUC:
+			return self.vucs[value]
+		elif tag == OPERAND_TIF:
+			return self.tifs[value]
+		elif tag == OPERAND_UNKNOWN_SEXPR:
+			return UNKNOWN_SEXPR
+		elif tag == OPERAND_UNKNOWN_TYPE:
+			return utils.UNKNOWN_TYPE
+		raise ValueError(f"bad operand tag {tag}")
+
+	def decode(self) -> TFG:
+		graph = CompactGraph.from_csr(self.nodes, self.child_offsets, self.child_targets)
+		tfg = TFG(graph.entry)
+		tfg.set_graph(graph)
+		tfg.dependencies = self.dependencies
+		return tfg
+
+
+def serialize_tfg(tfg:TFG, fingerprint:bytes) -> bytes:
+	return TFGEncoder().encode(tfg, fingerprint)
+
+def deserialize_tfg(data:bytes, fingerprint:bytes) -> TFG|None:
+	"""
+	Restore TFG from data, if it was saved with the same format and fingerprint
+	and types of its dependencies did not change since saving
+	"""
+	try:
+		payload = marshal.loads(zlib.decompress(data))
+	except (zlib.error, ValueError, EOFError, TypeError):
+		return None
+
+	if payload[0] != FORMAT_VERSION or payload[1] != fingerprint:
+		return None
+	if payload[10] != utils.get_types_fingerprint(payload[9]):
+		return None
+	try:
+		return TFGDecoder(payload).decode()
+	except ValueError as e:
+		utils.log_debug(f"failed to restore saved TFG {e}")
+		return None
+
+
+class TFGStorage:
+	"""
+	TFGs of functions saved in IDB netnode blobs, so they survive restarts
+	saved TFG is used only if function was not changed since saving
+	"""
+	NETNODE_NAME = "$ phrank.tfg"
+	BLOB_TAG = 'T'
+
+	def __init__(self):
+		self._netnode : idaapi.netnode|None = None
+
+	@property
+	def netnode(self) -> idaapi.netnode:
+		# created on first use, because database might not be open yet
+		if self._netnode is None:
+			self._netnode = idaapi.netnode(self.NETNODE_NAME, 0, True)
+		return self._netnode
+
+	def load(self, func_ea:int, fingerprint:bytes) -> TFG|None:
+		data = self.netnode.getblob(func_ea, self.BLOB_TAG)
+		if data is None:
+			return None
+
+		tfg = deserialize_tfg(data, fingerprint)
+		if tfg is None:
+			self.remove(func_ea)
+		return tfg
+
+	def save(self, func_ea:int, tfg:TFG, fingerprint:bytes):
+		try:
+			data = serialize_tfg(tfg, fingerprint)
+		except TypeError as e:
+			utils.log_warn(f"failed to save TFG of {idaapi.get_name(func_ea)} {e}")
+			return
+		self.netnode.setblob(data, func_ea, self.BLOB_TAG)
+
+	def remove(self, func_ea:int):
+		self.netnode.delblob(func_ea, self.BLOB_TAG)
+
+	def clear(self):
+		self.netnode.kill()
+		self._netnode = None
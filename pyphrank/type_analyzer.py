@@ -1,63 +1,89 @@
 from __future__ import annotations
 
+from typing import Iterable
+
 import idc
 import idaapi
 
 from pyphrank.function_manager import FunctionManager
 from pyphrank.type_flow_graph_parts import Var, SExpr, VarUseChain, Node, UNKNOWN_SEXPR, NOP_NODE
 from pyphrank.containers.structure import Structure
-from pyphrank.ast_analyzer import TFG, chain_nodes
+from pyphrank.ast_analyzer import TFG
+from pyphrank.type_flow_graph import TFGProjection
+from pyphrank.tfg_storage import TFGStorage
+from pyphrank.lifting_pipeline import LiftingPipeline
+from pyphrank.snapshot_lifter import is_typeful
 from pyphrank.analysis_state import AnalysisState
 from pyphrank.container_manager import ContainerManager
 from pyphrank.type_constructors.type_constructor_interface import ITypeConstructor
 from pyphrank.type_constructors.vtable_constructor import VtableConstructor
 from pyphrank.type_constructors.struct_constructor import StructConstructor
 import pyphrank.utils as utils
+import pyphrank.settings as settings
 
 
 def is_typeful_node(node:Node) -> bool:
 	""" Typeful node is a node, that can affect types """
-
 	sexpr = node.sexpr
-	if node.is_call_cast() and sexpr.is_type_literal():
-		return False
+	return is_typeful(node.node_type, sexpr.op, sexpr.is_explicit_call(), sexpr.is_var())
 
-	elif node.is_expr():
-		if sexpr.is_explicit_call():
-			return False
-		if sexpr is UNKNOWN_SEXPR:
-			return False
-		if sexpr.is_type_literal():
-			return False
-		if sexpr.is_var():
-			return False
-
-	if node.is_type_cast() and sexpr.is_type_literal():
-		return False
-
-	return True
-
-def shrink_tfg(aa:TFG):
-	bad_nodes = {n for n in aa.entry.iterate_children() if not is_typeful_node(n)}
-	for node in bad_nodes:
-		node.remove_node()
-
-	entry = aa.entry
-	if not is_typeful_node(entry):
-		if len(entry.children) == 1:
-			# shift entry by one node down
-			new_entry = entry.children.pop()
-			new_entry.parents.clear()
-		else:
-			# replace entry
-			new_entry = NOP_NODE.copy()
-			for child in entry.children:
-				new_entry.children.add(child)
-				child.parents.remove(entry)
-				child.parents.add(new_entry)
-			entry.children.clear()
-
-		aa.entry = new_entry
+def get_var_use_nodes(node:Node, var:Var) -> list[Node]:
+	""" Chain of nodes to replace node with var in var uses graph, unchanged node is reused """
+	sexpr = node.sexpr
+	if sexpr.is_var_use(var):
+		return [node]
+
+	if node.is_expr() and sexpr.is_assign():
+		# writing into var or moving to var is OK
+		if sexpr.target.is_var_use(var):
+			return [node]
+
+		if sexpr.value.is_var_use(var):
+			# moving from var is OK
+			if sexpr.value.is_var(var):
+				return [node]
+
+			# otherwise var read is OK, no need to know where this is read
+			return [Node(Node.EXPR, sexpr.value, addr=node.addr)]
+
+	new_nodes = []
+	for vuc in sexpr.extract_var_use_chains():
+		if vuc.var != var:
+			continue
+		new_node = Node(Node.EXPR, SExpr.create_var_use_chain(vuc), addr=node.addr)
+		new_nodes.append(new_node)
+	return new_nodes
+
+class ShrinkStats:
+	""" Node and edge counts of TFG before and after shrinking """
+	def __init__(self, nodes_before:int, edges_before:int, nodes_after:int, edges_after:int):
+		self.nodes_before = nodes_before
+		self.edges_before = edges_before
+		self.nodes_after = nodes_after
+		self.edges_after = edges_after
+
+	def __str__(self) -> str:
+		return f"nodes {self.nodes_before}->{self.nodes_after} edges {self.edges_before}->{self.edges_after}"
+
+def shrink_compact_tfg(aa:TFG):
+	graph = aa.graph
+	keep = {i for i, n in enumerate(graph.nodes) if is_typeful_node(n)}
+	aa.set_graph(graph.reduce(keep, NOP_NODE.copy))
+
+def shrink_tfg(aa:TFG) -> ShrinkStats:
+	"""
+	Remove nodes, that can not affect types, connecting their parents to their children
+	done in one sweep over graph instead of removing nodes one by one, result is compact
+	"""
+	is_compact = aa.is_compact()
+	graph = aa.graph
+	nodes_before, edges_before = len(graph), graph.edges_count()
+	shrink_compact_tfg(aa)
+	if not is_compact:
+		# nodes are owned by this TFG, so their stale edges sets are released
+		aa.compact()
+	graph = aa.graph
+	return ShrinkStats(nodes_before, edges_before, len(graph), graph.edges_count())
 
 
 class TypeAnalyzer:
@@ -65,6 +91,15 @@ class TypeAnalyzer:
 		self.func_manager = FunctionManager()
 		self.container_manager = ContainerManager()
 		self.tfg_cache : dict[int,TFG ]= {}
+		self.var_uses_cache : dict[int, dict[Var, TFG]] = {}
+		self.tfg_storage = TFGStorage()
+		# fingerprints of functions at the time of lifting their cached TFGs
+		self.tfg_fingerprints : dict[int, bytes] = {}
+		# functions and global vars to functions, whose cached TFGs depend on their types
+		self.tfg_dependents : dict[int, set[int]] = {}
+		# reverse of tfg_dependents, includes dependencies of partial TFGs, whose var uses are cached
+		self.tfg_dependencies : dict[int, set[int]] = {}
+		self.lifting_pipeline = LiftingPipeline()
 
 		self.state = AnalysisState()
 
@@ -73,38 +108,156 @@ class TypeAnalyzer:
 			StructConstructor(self),
 		]
 
-	def cache_tfg(self, addr:int, analysis:TFG):
+	def cache_tfg(self, addr:int, analysis:TFG, fingerprint:bytes):
+		self.uncache_tfg(addr)
 		self.tfg_cache[addr] = analysis
+		self.tfg_fingerprints[addr] = fingerprint
+		self.add_tfg_dependencies(addr, analysis.dependencies)
+
+	def cache_partial_tfg(self, addr:int, analysis:TFG, fingerprint:bytes):
+		"""
+		Partial TFG itself is not cached, only var uses got from it are
+		they are dropped together with full TFG, so dependencies and fingerprint are kept the same way
+		"""
+		if self.tfg_fingerprints.get(addr, fingerprint) != fingerprint:
+			self.uncache_tfg(addr)
+		self.tfg_fingerprints[addr] = fingerprint
+		self.add_tfg_dependencies(addr, analysis.dependencies)
+
+	def add_tfg_dependencies(self, addr:int, dependencies:Iterable[int]):
+		addr_dependencies = self.tfg_dependencies.setdefault(addr, set())
+		for dependency in dependencies:
+			addr_dependencies.add(dependency)
+			self.tfg_dependents.setdefault(dependency, set()).add(addr)
+
+	def uncache_tfg(self, addr:int):
+		self.var_uses_cache.pop(addr, None)
+		self.tfg_fingerprints.pop(addr, None)
+		self.tfg_cache.pop(addr, None)
+		for dependency in self.tfg_dependencies.pop(addr, ()):
+			dependents = self.tfg_dependents.get(dependency)
+			if dependents is None:
+				continue
+			dependents.discard(addr)
+			if len(dependents) == 0:
+				self.tfg_dependents.pop(dependency)
+
+	def invalidate_tfg(self, func_ea:int):
+		""" Drop TFG of function from all caches, so it gets lifted again from new ctree """
+		self.uncache_tfg(func_ea)
+		self.func_manager.func_factory.clear_cfunc(func_ea)
+		self.func_manager.invalidate_func_types(func_ea)
+		if settings.PERSISTENT_TFG_CACHE:
+			self.tfg_storage.remove(func_ea)
+
+	def invalidate_dependents(self, ea:int):
+		""" Drop TFGs, that were lifted using type of function or global var at ea """
+		for func_ea in list(self.tfg_dependents.get(ea, ())):
+			self.invalidate_tfg(func_ea)
+
+	def refresh_tfg(self, func_ea:int):
+		""" Drop cached TFG of function and its dependents, if function changed since lifting """
+		fingerprint = self.tfg_fingerprints.get(func_ea)
+		if fingerprint is None or fingerprint == utils.get_func_fingerprint(func_ea):
+			return
+
+		self.invalidate_tfg(func_ea)
+		self.invalidate_dependents(func_ea)
 
 	def get_tfg(self, func_ea:int, nocache=False) -> TFG:
-		if (cached := self.tfg_cache.get(func_ea)) is None or nocache:
+		if (cached := self.tfg_cache.get(func_ea)) is not None and not nocache:
+			return cached
+
+		# fingerprint is taken before decompilation, so later changes are noticed
+		fingerprint = utils.get_func_fingerprint(func_ea)
+		aa = None
+		if settings.PERSISTENT_TFG_CACHE and not nocache:
+			aa = self.tfg_storage.load(func_ea, fingerprint)
+
+		if aa is None:
+			# lifted TFG is already shrunk
 			aa = self.func_manager.get_tfg(func_ea)
-			shrink_tfg(aa)
-			self.tfg_cache[func_ea] = aa
-		else:
-			aa = cached
+			if settings.PERSISTENT_TFG_CACHE:
+				self.tfg_storage.save(func_ea, aa, fingerprint)
 
+		self.cache_tfg(func_ea, aa, fingerprint)
 		return aa
 
+	def lift_functions(self, func_eas:Iterable[int]):
+		"""
+		Lift functions, that are not cached yet
+		with lifting workers enabled ctrees are lifted in parallel, while next functions get decompiled
+		"""
+		missing = []
+		fingerprints : dict[int, bytes] = {}
+		for func_ea in func_eas:
+			if func_ea in self.tfg_cache:
+				continue
+			fingerprint = utils.get_func_fingerprint(func_ea)
+			if settings.PERSISTENT_TFG_CACHE and (aa := self.tfg_storage.load(func_ea, fingerprint)) is not None:
+				self.cache_tfg(func_ea, aa, fingerprint)
+				continue
+			fingerprints[func_ea] = fingerprint
+			missing.append(func_ea)
+
+		if settings.LIFTING_WORKERS <= 0:
+			for func_ea in missing:
+				self.get_tfg(func_ea)
+			return
+
+		failed = []
+		def iterate_cfuncs():
+			for func_ea in missing:
+				if (cfunc := self.func_manager.get_cfunc(func_ea)) is None:
+					failed.append(func_ea)
+				else:
+					yield cfunc
+
+		for func_ea, aa in self.lifting_pipeline.lift(iterate_cfuncs()):
+			fingerprint = fingerprints[func_ea]
+			self.cache_tfg(func_ea, aa, fingerprint)
+			if settings.PERSISTENT_TFG_CACHE:
+				self.tfg_storage.save(func_ea, aa, fingerprint)
+
+		# failed decompilations are handled as usual
+		for func_ea in failed:
+			self.get_tfg(func_ea)
+
 	def get_db_var_type(self, var:Var) -> idaapi.tinfo_t:
 		if var.is_local():
 			return self.func_manager.get_cfunc_lvar_type(var.func_ea, var.lvar_id)
 		else:
 			return utils.addr2tif(var.obj_ea)
 
-	def set_db_var_type(self, var:Var, var_type:idaapi.tinfo_t):
+	def set_db_lvar_types(self, func_ea:int, lvar_types:dict[int, idaapi.tinfo_t]) -> bool:
+		"""
+		Set types of lvars of function at once, so function and its dependents are invalidated once
+		returns True, if IDB was changed
+		"""
+		args_count = self.func_manager.get_args_count(func_ea)
+		rv = self.func_manager.set_lvar_tinfos(func_ea, lvar_types)
+		self.invalidate_tfg(func_ea)
+		# callers are lifted with function prototype
+		if any(lvar_id < args_count for lvar_id in lvar_types):
+			self.invalidate_dependents(func_ea)
+		return rv
+
+	def set_db_var_type(self, var:Var, var_type:idaapi.tinfo_t) -> bool:
 		if var.is_local():
-			self.func_manager.set_lvar_tinfo(var.func_ea, var.lvar_id, var_type)
-		else:
-			rv = idc.SetType(var.obj_ea, str(var_type) + ';')
-			if rv == 0:
-				utils.log_warn(f"setting {hex(var.obj_ea)} to {var_type} failed")
+			return self.set_db_lvar_types(var.func_ea, {var.lvar_id: var_type})
+
+		rv = idc.SetType(var.obj_ea, str(var_type) + ';')
+		if rv == 0:
+			utils.log_warn(f"setting {hex(var.obj_ea)} to {var_type} failed")
+		self.invalidate_dependents(var.obj_ea)
+		return rv != 0
 
 	def skip_analysis(self):
 		# delete new temporarily created types
 		self.container_manager.delete_containers()
 
 		self.state.clear()
+		self.func_manager.func_factory.unpin_all()
 
 	def apply_analysis(self):
 		touched_functions = set()
@@ -112,14 +265,15 @@ class TypeAnalyzer:
 			touched_functions.update(var.get_functions())
 
 		new_xrefs = []
+		self.lift_functions(touched_functions)
 		for func_ea in touched_functions:
 			func_aa = self.get_tfg(func_ea)
-			for func_call in func_aa.iterate_implicit_calls():
-				frm = func_call.addr
-				if frm == idaapi.BADADDR:
+			for call_node in func_aa.iterate_implicit_calls():
+				frm = call_node.addr
+				if frm == -1:
 					continue
 
-				call_ea = self.get_call_address(func_call.function)
+				call_ea = self.get_call_address(call_node.sexpr.function)
 				if call_ea == -1:
 					continue
 
@@ -130,11 +284,22 @@ class TypeAnalyzer:
 			if not rv:
 				utils.log_warn(f"failed to add code reference from {hex(frm)} to {hex(to)}")
 
+		# lvars are grouped by functions, so every function is changed once
+		func_lvar_types : dict[int, dict[int, idaapi.tinfo_t]] = {}
+		db_writes = 0
 		for var, new_type_tif in self.state.vars.items():
 			if new_type_tif is utils.UNKNOWN_TYPE:
 				continue
 
-			self.set_db_var_type(var, new_type_tif)
+			if var.is_local():
+				func_lvar_types.setdefault(var.func_ea, {})[var.lvar_id] = new_type_tif
+			elif self.set_db_var_type(var, new_type_tif):
+				db_writes += 1
+
+		for func_ea, lvar_types in func_lvar_types.items():
+			if self.set_db_lvar_types(func_ea, lvar_types):
+				db_writes += 1
+		utils.log_info(f"applied new types with {db_writes} IDB writes")
 
 		for struct in self.container_manager.new_types.values():
 			offsets = [o for o in struct.member_offsets()]
@@ -144,6 +309,7 @@ class TypeAnalyzer:
 				utils.log_err(f"{struct.name} has only one member at offset 0, most likely this is analysis error")
 
 		self.state.clear()
+		self.func_manager.func_factory.unpin_all()
 		# new types are already created, simply skip them without deleting
 		self.container_manager.clear()
 
@@ -158,6 +324,9 @@ class TypeAnalyzer:
 			return var_tinfo
 
 		self.state.vars[var] = utils.UNKNOWN_TYPE # to break recursion
+		# lvars of analyzed functions are read and changed until analysis is applied
+		if var.is_local():
+			self.func_manager.func_factory.pin(var.func_ea)
 
 		var_uses = self.get_all_var_uses(var)
 		if var_uses.uses_len(var) == 0:
@@ -248,7 +417,7 @@ class TypeAnalyzer:
 		elif sexpr.is_type_literal():
 			return sexpr.literal_tinfo
 
-		utils.log_warn(f"unknown sexpr value={sexpr} in {idaapi.get_name(sexpr.func_ea)}")
+		utils.log_warn(f"unknown sexpr value={sexpr}")
 		return utils.UNKNOWN_TYPE
 
 	def propagate_var(self, var:Var):
@@ -292,58 +461,57 @@ class TypeAnalyzer:
 				f"because variable has different type {current_type}"
 			)
 
-	def get_func_var_uses(self, func_ea:int, var:Var, nocache=False) -> TFG:
-		aa = self.get_tfg(func_ea, nocache=nocache).copy()
-		node_replacements : dict[Node, list[Node]] = {}
-		for node in aa.iterate_nodes():
-			sexpr = node.sexpr
-			if var not in sexpr.extract_vars():
-				node_replacements[node] = [NOP_NODE.copy()]
-				continue
-
-			if sexpr.is_var_use(var):
-				continue
-
-			if node.is_expr() and sexpr.is_assign():
-				# writing into var or moving to var is OK
-				if sexpr.target.is_var_use(var):
-					continue
-
-				if sexpr.value.is_var_use(var):
-					# moving from var is OK
-					if sexpr.value.is_var(var):
-						continue
-
-					# otherwise var read is OK, no need to know where this is read
-					new_node = Node(Node.EXPR, sexpr.value)
-					node_replacements[node] = [new_node]
-					continue
+	def get_var_tfg(self, func_ea:int, var:Var, nocache=False) -> TFG:
+		"""
+		TFG with all uses of var in function, full TFG is used if it is already lifted or saved
+		otherwise only instrs with var are lifted, full TFG gets lifted once it is needed
+		"""
+		if not settings.PARTIAL_LIFTING or nocache or func_ea in self.tfg_cache:
+			return self.get_tfg(func_ea, nocache=nocache)
+
+		fingerprint = utils.get_func_fingerprint(func_ea)
+		if settings.PERSISTENT_TFG_CACHE and (aa := self.tfg_storage.load(func_ea, fingerprint)) is not None:
+			self.cache_tfg(func_ea, aa, fingerprint)
+			return aa
+
+		# var uses are got from shrunk TFG, as if it was a full one
+		aa = self.func_manager.get_tfg(func_ea, only_vars=frozenset((var,)))
+		self.cache_partial_tfg(func_ea, aa, fingerprint)
+		return aa
 
-			new_nodes = []
-			for vuc in sexpr.extract_var_use_chains():
-				if vuc.var != var:
-					continue
-				new_node = Node(Node.EXPR, SExpr.create_var_use_chain(vuc))
-				new_nodes.append(new_node)
-			chain_nodes(*new_nodes)
-			node_replacements[node] = new_nodes
-
-		for node, new_nodes in node_replacements.items():
-			first = new_nodes[0]
-			for parent in node.parents:
-				parent.children.remove(node)
-				parent.children.add(first)
-				first.parents.add(parent)
-
-			last = new_nodes[-1]
-			for child in node.children:
-				child.parents.remove(node)
-				child.parents.add(last)
-				last.children.add(child)
-
-		if aa.entry in node_replacements:
-			aa.entry = node_replacements[aa.entry][0]
+	def get_func_var_uses(self, func_ea:int, var:Var, nocache=False) -> TFG:
+		if nocache:
+			self.var_uses_cache.pop(func_ea, None)
+		func_var_uses = self.var_uses_cache.get(func_ea, {})
+		if (cached := func_var_uses.get(var)) is not None:
+			return cached
+
+		tfg = self.get_var_tfg(func_ea, var, nocache=nocache)
+		func_var_uses = self.var_uses_cache.setdefault(func_ea, {})
+
+		graph = tfg.graph
+		# only nodes with var are kept, everything else would become nop and get shrinked
+		node_replacements : dict[int, list[Node]] = {}
+		for node in tfg.get_var_nodes(var):
+			node_replacements[graph.get_id(node)] = get_var_use_nodes(node, var)
+
+		if 0 not in node_replacements:
+			node_replacements[0] = [NOP_NODE.copy()]
+
+		children : dict[Node, list[Node]] = {}
+		for new_nodes in node_replacements.values():
+			for i in range(len(new_nodes) - 1):
+				children[new_nodes[i]] = [new_nodes[i + 1]]
+
+		# connect kept nodes, that are reachable from one another through removed nodes
+		reduced = graph.get_reduced_children(set(node_replacements.keys()))
+		for node_id, child_ids in reduced.items():
+			last = node_replacements[node_id][-1]
+			children[last] = [node_replacements[child_id][0] for child_id in child_ids]
+
+		aa = TFGProjection(tfg, node_replacements[0][0], children)
 		shrink_tfg(aa)
+		func_var_uses[var] = aa
 		return aa
 
 	def get_all_var_uses(self, var:Var, nocache=False) -> TFG:
@@ -352,12 +520,19 @@ class TypeAnalyzer:
 			func_ea = funcs.pop()
 			return self.get_func_var_uses(func_ea, var, nocache=nocache)
 
+		# partial lifts of single instrs are cheaper, than full lifts even in parallel
+		if not nocache and not settings.PARTIAL_LIFTING:
+			self.lift_functions(funcs)
+
 		new_entry = NOP_NODE.copy()
+		children : dict[Node, list[Node]] = {new_entry: []}
 		for func_ea in funcs:
 			va = self.get_func_var_uses(func_ea, var, nocache=nocache)
-			new_entry.children.add(va.entry)
-			va.entry.parents.add(new_entry)
-		return TFG(new_entry)
+			children[new_entry].append(va.entry)
+			nodes = va.graph.nodes
+			for node_id, child_id in va.graph.iterate_edges():
+				children.setdefault(nodes[node_id], []).append(nodes[child_id])
+		return TFG.from_children(new_entry, children)
 
 	def analyze_by_heuristics(self, var:Var) -> idaapi.tinfo_t:
 		original_var_tinfo = self.get_db_var_type(var)
@@ -392,7 +567,7 @@ class TypeAnalyzer:
 				return True
 
 			# single read or move from var is unknown
-			if node.is_expr() and sexpr.is_assign() and var not in sexpr.target.extract_vars():
+			if node.is_expr() and sexpr.is_assign() and not sexpr.target.mentions(var):
 				return True
 
 			# single read or move from var is unknown
@@ -673,6 +848,8 @@ class TypeAnalyzer:
 
 	def is_var_possible_ptr(self, var:Var, var_uses:TFG) -> bool:
 		for node in var_uses.iterate_nodes():
+			if not node.sexpr.mentions(var):
+				continue
 			for vuc in node.sexpr.extract_var_use_chains():
 				if vuc.var != var:
 					continue
@@ -1,35 +1,98 @@
 from __future__ import annotations
 
-import idaapi
-
-from pyphrank.type_flow_graph_parts import SExpr, ASTCtx, Var, VarUseChain, Node
+from collections import deque
 
+import idaapi
 
-def extract_implicit_calls(sexpr:SExpr):
-	if sexpr.is_implicit_call():
-		yield sexpr
+from pyphrank.type_flow_graph_parts import SExpr, ASTCtx, Var, VarUseChain, Node, COMPACTED_EDGES
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.graph_analysis import GraphAnalysis
+from pyphrank.dataflow import TFGDataflow
 
 
-def extract_var_reads(sexpr:SExpr, var:Var):
-	if sexpr.is_var_use(var):
+def extract_reads(sexpr:SExpr):
+	""" yields var use chain sexprs of all variables read in sexpr """
+	if sexpr.is_var_use():
 		yield sexpr
 
 	if sexpr.is_assign():
 		# dont add target var_use_chain to reads, because it is write
 		# if its not var_use_chain, then it gets added to reads there
 		if not sexpr.target.is_var_use_chain():
-			yield from extract_var_reads(sexpr.target, var)
+			yield from extract_reads(sexpr.target)
 
 		# var_use_chain value IS a read though
-		yield from extract_var_reads(sexpr.value, var)
+		yield from extract_reads(sexpr.value)
 
 	if sexpr.is_binary_op():
-		yield from extract_var_reads(sexpr.x, var)
-		yield from extract_var_reads(sexpr.y, var)
+		yield from extract_reads(sexpr.x)
+		yield from extract_reads(sexpr.y)
 
 	if sexpr.is_bool_op():
-		yield from extract_var_reads(sexpr.x, var)
-		yield from extract_var_reads(sexpr.y, var)
+		yield from extract_reads(sexpr.x)
+		yield from extract_reads(sexpr.y)
+
+def extract_var_reads(sexpr:SExpr, var:Var):
+	for read in extract_reads(sexpr):
+		if read.var_use_chain.var == var:
+			yield read
+
+
+class TFGIndex:
+	"""
+	Nodes of TFG bucketed by kind and var lookups for common queries
+	built in single pass over nodes, so queries cost size of their result
+	"""
+	def __init__(self, nodes:list[Node]):
+		self.expr_nodes : list[Node] = []
+		self.return_nodes : list[Node] = []
+		self.call_cast_nodes : list[Node] = []
+		self.type_cast_nodes : list[Node] = []
+		self.assign_nodes : list[Node] = []
+		for node in nodes:
+			if node.is_expr():
+				self.expr_nodes.append(node)
+				if node.sexpr.is_assign():
+					self.assign_nodes.append(node)
+			elif node.is_return():
+				self.return_nodes.append(node)
+			elif node.is_call_cast():
+				self.call_cast_nodes.append(node)
+			elif node.is_type_cast():
+				self.type_cast_nodes.append(node)
+
+		# nodes, because addresses of calls are kept in nodes
+		self.implicit_calls : list[Node] = []
+		self.var_reads : dict[Var, list[SExpr]] = {}
+		self.var_casts : dict[Var, int] = {}
+		for node in self.expr_nodes + self.return_nodes:
+			self.add_node(node)
+
+		for node in self.call_cast_nodes + self.type_cast_nodes:
+			sexpr = node.sexpr
+			# direct var use chain casts are casts, not reads
+			if (vuc := sexpr.var_use_chain) is not None:
+				self.var_casts[vuc.var] = self.var_casts.get(vuc.var, 0) + 1
+			self.add_node(node, reads=vuc is None)
+
+		self.moves_from : dict[Var, list[SExpr]] = {}
+		self.var_writes : dict[Var, list[SExpr]] = {}
+		for node in self.assign_nodes:
+			asg = node.sexpr
+			if (var := asg.value.var) is not None:
+				self.moves_from.setdefault(var, []).append(asg.target)
+			vuc = asg.target.var_use_chain
+			if vuc is not None and len(vuc) != 0:
+				self.var_writes.setdefault(vuc.var, []).append(asg)
+
+	def add_node(self, node:Node, reads=True):
+		sexpr = node.sexpr
+		if sexpr.is_implicit_call():
+			self.implicit_calls.append(node)
+		if not reads:
+			return
+		for read in extract_reads(sexpr):
+			self.var_reads.setdefault(read.var_use_chain.var, []).append(read)
 
 
 class TFGView(idaapi.GraphViewer):
@@ -45,141 +108,251 @@ class TFGView(idaapi.GraphViewer):
 
 class TFG:
 	def __init__(self, entry:Node):
-		self.entry = entry
+		self._entry = entry
+		self._graph : CompactGraph|None = None
+		self._index : TFGIndex|None = None
+		self._analysis : GraphAnalysis|None = None
+		self._dataflow : TFGDataflow|None = None
+		self._var_nodes : dict[Var, list[Node]]|None = None
+		self._is_compact = False
+		# functions and global vars, whose types were used in lifting
+		self.dependencies : frozenset[int] = frozenset()
+
+	@classmethod
+	def from_children(cls, entry:Node, children:dict[Node, list[Node]]) -> TFG:
+		""" Create compact TFG with edges from mapping instead of node sets """
+		tfg = cls(entry)
+		tfg.set_graph(CompactGraph.from_entry(entry, lambda n: children.get(n, ())))
+		return tfg
+
+	@property
+	def entry(self) -> Node:
+		return self._entry
+
+	@entry.setter
+	def entry(self, entry:Node):
+		assert not self._is_compact, "compacted TFG can not be modified"
+		self._entry = entry
+		self.invalidate()
+
+	@property
+	def graph(self) -> CompactGraph:
+		""" Node ids and edges in CSR arrays, built on first access """
+		if self._graph is None:
+			self._graph = CompactGraph.from_entry(self._entry, lambda n: n.children)
+		return self._graph
+
+	@property
+	def index(self) -> TFGIndex:
+		""" Node buckets and var lookups, built on first query """
+		if self._index is None:
+			self._index = TFGIndex(self.graph.nodes)
+		return self._index
+
+	@property
+	def analysis(self) -> GraphAnalysis:
+		""" Reverse postorder, loops, dominators and depth of nodes, each built on first query """
+		if self._analysis is None:
+			self._analysis = GraphAnalysis(self.graph)
+		return self._analysis
+
+	@property
+	def dataflow(self) -> TFGDataflow:
+		""" Reaching definitions and pointer sources of nodes, each solved on first query """
+		if self._dataflow is None:
+			self._dataflow = TFGDataflow(self.graph, self.analysis)
+		return self._dataflow
+
+	def get_var_nodes(self, var:Var) -> list[Node]:
+		""" Nodes, that mention var anywhere in their sexpr. Occurrences of all vars are indexed on first call """
+		if self._var_nodes is None:
+			var_nodes : dict[Var, list[Node]] = {}
+			for node in self.graph.nodes:
+				for node_var in node.sexpr.extract_vars():
+					var_nodes.setdefault(node_var, []).append(node)
+			self._var_nodes = var_nodes
+		return self._var_nodes.get(var, [])
+
+	def invalidate(self):
+		""" Drop everything computed from nodes, must be called after modifying nodes or edges """
+		self._index = None
+		self._analysis = None
+		self._dataflow = None
+		self._var_nodes = None
+		if not self._is_compact:
+			self._graph = None
+
+	def set_graph(self, graph:CompactGraph):
+		"""
+		Replace nodes and edges of TFG with graph, only per-node edge sets of nodes are released
+		the same way as in compact, because edges of nodes are in graph now
+		"""
+		self.invalidate()
+		for node in graph.nodes:
+			node.children = COMPACTED_EDGES
+			node.parents = COMPACTED_EDGES
+		self._entry = graph.entry
+		self._graph = graph
+		self._is_compact = True
+
+	def remove_node(self, node:Node):
+		""" Remove node, connecting its parents directly to its children """
+		assert not self._is_compact, "compacted TFG can not be modified"
+		node.remove_node()
+		self.invalidate()
+
+	def is_compact(self) -> bool:
+		return self._is_compact
+
+	def compact(self):
+		"""
+		Switch to compact storage, where edges exist only in CSR arrays
+		per-node edge sets are released, so nodes can no longer be modified
+		"""
+		graph = self.graph
+		for node in graph.nodes:
+			node.children = COMPACTED_EDGES
+			node.parents = COMPACTED_EDGES
+		self._is_compact = True
 
 	def copy(self) -> TFG:
-		node2new : dict[Node,Node] = {}
-		for node in self.iterate_nodes():
-			new_node = node.copy()
-			node2new[node] = new_node
-
-		for node in self.iterate_nodes():
-			new_node = node2new[node]
-			for child in node.children:
-				new_child = node2new[child]
-				new_child.parents.add(new_node)
-				new_node.children.add(new_child)
+		graph = self.graph
+		new_nodes = [node.copy() for node in graph.nodes]
+		for node_id, child_id in graph.iterate_edges():
+			new_node = new_nodes[node_id]
+			new_child = new_nodes[child_id]
+			new_child.parents.add(new_node)
+			new_node.children.add(new_child)
 
-		new_entry = node2new[self.entry]
-		return TFG(new_entry)
+		return TFG(new_nodes[0])
 
 	def print(self, graph_title:str = "no title"):
 		gv = TFGView(graph_title)
-		node2id = {}
-		for node in self.iterate_nodes():
-			node2id[node] = gv.AddNode(str(node))
-
-		for node in self.iterate_nodes():
-			child_id = node2id[node]
-			for parent in node.parents:
-				parent_id = node2id[parent]
-				gv.AddEdge(parent_id, child_id)
+		graph = self.graph
+		# added in reverse postorder, so viewer ids follow the flow
+		node_ids = [0] * len(graph)
+		for node_id in self.analysis.rpo:
+			node_ids[node_id] = gv.AddNode(str(graph.nodes[node_id]))
+		for node_id, child_id in graph.iterate_edges():
+			gv.AddEdge(node_ids[node_id], node_ids[child_id])
 
 		gv.Show()
 
 	def iterate_nodes(self):
-		yield self.entry
-		yield from self.entry.iterate_children()
+		yield from self.graph.nodes
+
+	def iterate_rpo_nodes(self):
+		nodes = self.graph.nodes
+		for node_id in self.analysis.rpo:
+			yield nodes[node_id]
+
+	def iterate_children(self, node:Node):
+		""" Nodes reachable from node in BFS order, edges are taken from compact graph, so it works for any TFG """
+		graph = self.graph
+		node_id = graph.get_id(node)
+		visited = {node_id}
+		queue = deque(graph.children(node_id))
+		visited.update(queue)
+		while len(queue) != 0:
+			node_id = queue.popleft()
+			yield graph.nodes[node_id]
+
+			for child_id in graph.children(node_id):
+				if child_id in visited:
+					continue
+				visited.add(child_id)
+				queue.append(child_id)
+
+	def max_depth(self, node:Node|None=None) -> int:
+		""" Number of nodes on the longest path from node (entry by default) to a leaf, loops are counted once """
+		node_id = 0 if node is None else self.graph.get_id(node)
+		return self.analysis.depth[node_id]
+
+	def print_nodes(self):
+		""" Print nodes in DFS order from entry, with nesting by depth of first visit """
+		graph = self.graph
+		visited = {0}
+		stack = [(0, 0)]
+		while len(stack) != 0:
+			node_id, lvl = stack.pop()
+			children = graph.children(node_id)
+			print(f"{lvl * ' '}node {str(graph.nodes[node_id])} children_len={len(children)}")
+			for child_id in reversed(children):
+				if child_id in visited:
+					continue
+				visited.add(child_id)
+				stack.append((child_id, lvl + 1))
 
 	def iterate_sexpr_nodes(self):
-		for node in self.iterate_nodes():
-			if node.is_expr():
-				yield node
+		yield from self.index.expr_nodes
 
 	def iterate_sexprs(self):
-		for node in self.iterate_sexpr_nodes():
+		for node in self.index.expr_nodes:
 			yield node.sexpr
 
 	def iterate_return_nodes(self):
-		for node in self.iterate_nodes():
-			if node.is_return():
-				yield node
+		yield from self.index.return_nodes
 
 	def iterate_return_sexprs(self):
-		for node in self.iterate_return_nodes():
+		for node in self.index.return_nodes:
 			yield node.sexpr
 
 	def iterate_call_cast_nodes(self):
-		for node in self.iterate_nodes():
-			if node.is_call_cast():
-				yield node
+		yield from self.index.call_cast_nodes
 
 	def iterate_call_cast_sexprs(self):
-		for node in self.iterate_call_cast_nodes():
+		for node in self.index.call_cast_nodes:
 			yield node.sexpr
 
 	def iterate_type_cast_nodes(self):
-		for node in self.iterate_nodes():
-			if node.is_type_cast():
-				yield node
+		yield from self.index.type_cast_nodes
 
 	def iterate_type_cast_sexprs(self):
-		for node in self.iterate_type_cast_nodes():
+		for node in self.index.type_cast_nodes:
 			yield node.sexpr
 
 	def iterate_implicit_calls(self):
-		for c in self.iterate_sexprs():
-			yield from extract_implicit_calls(c)
-
-		for r in self.iterate_return_sexprs():
-			yield from extract_implicit_calls(r)
-
-		for c in self.iterate_call_cast_sexprs():
-			yield from extract_implicit_calls(c)
-
-		for t in self.iterate_type_cast_sexprs():
-			yield from extract_implicit_calls(t)
+		yield from self.index.implicit_calls
 
 	def iterate_assign_nodes(self):
-		for node in self.iterate_sexpr_nodes():
-			if node.sexpr.is_assign():
-				yield node
+		yield from self.index.assign_nodes
 
 	def iterate_assign_sexprs(self):
-		for node in self.iterate_assign_nodes():
+		for node in self.index.assign_nodes:
 			yield node.sexpr
 
 	def iterate_var_reads(self, var:Var):
-		for s in self.iterate_sexprs():
-			yield from extract_var_reads(s, var)
-
-		for r in self.iterate_return_sexprs():
-			yield from extract_var_reads(r, var)
-
-		for c in self.iterate_call_cast_sexprs():
-			# direct var use chain casts are casts, not reads
-			if not c.is_var_use_chain():
-				yield from extract_var_reads(c, var)
-
-		for t in self.iterate_type_cast_sexprs():
-			# direct var use chain casts are casts, not reads
-			if not t.is_var_use_chain():
-				yield from extract_var_reads(t, var)
+		yield from self.index.var_reads.get(var, ())
 
 	def casts_len(self, var:Var):
-		casts1 = [c for c in self.iterate_call_cast_sexprs() if c.is_var_use(var)]
-		casts2 = [c for c in self.iterate_type_cast_sexprs() if c.is_var_use(var)]
-		return len(casts1) + len(casts2)
+		return self.index.var_casts.get(var, 0)
 
 	def uses_len(self, var:Var):
-		writes = [w for w in self.iterate_var_writes(var)]
-		reads = [r for r in self.iterate_var_reads(var)]
-		return len(writes) + len(reads) + self.casts_len(var)
+		index = self.index
+		writes = index.var_writes.get(var, ())
+		reads = index.var_reads.get(var, ())
+		return len(writes) + len(reads) + index.var_casts.get(var, 0)
 
 	def iterate_moves_to(self, var:Var):
-		for asg in self.iterate_assign_sexprs():
-			if asg.target.is_var(var):
-				yield asg.value
+		# moves are definitions of cached reaching definitions, facts are not solved for this
+		nodes = self.graph.nodes
+		for node_id in self.dataflow.reaching_definitions.get_var_definitions(var):
+			yield nodes[node_id].sexpr.value
 
 	def iterate_moves_from(self, var:Var):
-		for asg in self.iterate_assign_sexprs():
-			if asg.value.is_var(var):
-				yield asg.target
+		yield from self.index.moves_from.get(var, ())
 
 	def iterate_var_writes(self, var:Var):
-		for asg in self.iterate_assign_sexprs():
-			vuc = asg.target.var_use_chain
-			if vuc is None or len(vuc) == 0 or vuc.var != var:
-				continue
-
-			yield asg
\ No newline at end of file
+		yield from self.index.var_writes.get(var, ())
+
+
+class TFGProjection(TFG):
+	"""
+	Filtered and rewritten view of another TFG
+	unchanged nodes are shared with base TFG instead of being copied
+	and edges exist only in projection graph, so base TFG is never modified
+	"""
+	def __init__(self, base:TFG, entry:Node, children:dict[Node, list[Node]]):
+		super().__init__(entry)
+		self.base = base
+		self.set_graph(CompactGraph.from_entry(entry, lambda n: children.get(n, ())))
@@ -1,8 +1,11 @@
 from __future__ import annotations
 from typing import Any
+from weakref import WeakValueDictionary
 
 import idaapi
 import pyphrank.utils as utils
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.graph_analysis import GraphAnalysis
 
 
 class ASTCtx:
@@ -19,24 +22,51 @@ class ASTCtx:
 
 
 class Var:
-	def __init__(self, *varid:int) -> None:
-		self.varid : int|tuple[int,...] = 0
+	__slots__ = ("varid", "_hash")
+
+	# vars are interned per session, so equal vars are usually the same object
+	_interned : dict[int, Var] = {}
+
+	def __new__(cls, *varid:int) -> Var:
+		# packing identifier into single int, globals are even, locals are odd
 		if len(varid) == 1:  # global
-			self.varid = varid[0]
+			key = varid[0] << 1
 		elif len(varid) == 2:
-			self.varid = tuple(varid)
+			key = (((varid[0] << 32) | varid[1]) << 1) | 1
 		else:
 			raise ValueError("Invalid length of variable identifier")
 
+		var = cls._interned.get(key)
+		if var is not None:
+			return var
+
+		var = super().__new__(cls)
+		var.varid = varid[0] if len(varid) == 1 else tuple(varid)
+		var._hash = hash(var.varid)
+		cls._interned[key] = var
+		return var
+
+	@classmethod
+	def clear_interned(cls):
+		cls._interned.clear()
+
+	def __reduce__(self):
+		if self.is_local():
+			return (Var, self.varid)
+		return (Var, (self.varid,))
+
 	def __eq__(self, __value:object) -> bool:
+		if self is __value:
+			return True
 		if __value is None:
 			return False
 		if not isinstance(__value, Var):
 			raise NotImplementedError(f"bad type {type(__value)}")
+		# vars from before interned table got cleared
 		return self.varid == __value.varid
 
 	def __hash__(self) -> int:
-		return hash(self.varid)
+		return self._hash
 
 	@property
 	def func_ea(self) -> int:
@@ -89,9 +119,35 @@ class VarUse:
 	def is_add(self): return self.use_type == self.VAR_ADD
 	def is_ref(self): return self.use_type == self.VAR_REF
 
-	def __init__(self, offset:int, use_type:int):
-		self.offset = offset
-		self.use_type = use_type
+	__slots__ = ("offset", "use_type", "_hash")
+
+	# few distinct uses exist, so they are shared by all chains
+	_interned : dict[tuple[int,int], VarUse] = {}
+
+	def __new__(cls, offset:int, use_type:int) -> VarUse:
+		key = (offset, use_type)
+		if (use := cls._interned.get(key)) is not None:
+			return use
+
+		use = super().__new__(cls)
+		use.offset = offset
+		use.use_type = use_type
+		use._hash = hash(key)
+		cls._interned[key] = use
+		return use
+
+	def __reduce__(self):
+		return (VarUse, (self.offset, self.use_type))
+
+	def __eq__(self, __value:object) -> bool:
+		if self is __value:
+			return True
+		if not isinstance(__value, VarUse):
+			return False
+		return self.offset == __value.offset and self.use_type == __value.use_type
+
+	def __hash__(self) -> int:
+		return self._hash
 
 	def do_transform(self, tif:idaapi.tinfo_t|utils.ShiftedStruct):
 		if self.is_add():
@@ -191,9 +247,35 @@ class VarUse:
 
 
 class VarUseChain:
-	def __init__(self, var:Var, *uses:VarUse):
-		self.var = var
-		self.uses = list(uses)
+	__slots__ = ("var", "uses", "_hash", "__weakref__")
+
+	# hash-consing table, structurally equal chains are the same object
+	_interned : WeakValueDictionary[tuple, VarUseChain] = WeakValueDictionary()
+
+	def __new__(cls, var:Var, *uses:VarUse) -> VarUseChain:
+		key = (var, uses)
+		if (vuc := cls._interned.get(key)) is not None:
+			return vuc
+
+		vuc = super().__new__(cls)
+		vuc.var = var
+		vuc.uses = uses
+		vuc._hash = hash(key)
+		cls._interned[key] = vuc
+		return vuc
+
+	def __reduce__(self):
+		return (VarUseChain, (self.var, *self.uses))
+
+	def __eq__(self, __value:object) -> bool:
+		if self is __value:
+			return True
+		if not isinstance(__value, VarUseChain):
+			return False
+		return self.var == __value.var and self.uses == __value.uses
+
+	def __hash__(self) -> int:
+		return self._hash
 
 	def uses_str(self) -> str:
 		return "->".join(str(u) for u in self.uses)
@@ -260,6 +342,11 @@ class SExpr:
 	def is_partial(self): return self.op == self.TYPE_PARTIAL
 	def is_combine(self): return self.op == self.TYPE_COMBINE
 
+	__slots__ = ("op", "_x", "_y", "_key", "_hash", "_var_use_chains", "_vars", "__weakref__")
+
+	# hash-consing table, structurally equal sexprs are the same object
+	_interned : WeakValueDictionary[tuple, SExpr] = WeakValueDictionary()
+
 	def is_var_use(self, var:Var|None=None) -> bool:
 		if self.var_use_chain is None:
 			return False
@@ -320,13 +407,48 @@ class SExpr:
 			return False
 		return not self.function.is_function()
 
-	def __init__(self, t:int, addr=-1) -> None:
+	def __init__(self, t:int) -> None:
 		self.op = t
-		if addr == idaapi.BADADDR:
-			addr = -1
-		self.addr = addr
 		self._x:Any = None
 		self._y:Any = None
+		# sexprs without key are not shared and are equal only to themselves
+		self._key : tuple|None = None
+		self._hash = id(self)
+		self._var_use_chains : frozenset[VarUseChain]|None = None
+		self._vars : frozenset[Var]|None = None
+
+	@classmethod
+	def make(cls, op:int, x:Any, y:Any=None) -> SExpr:
+		"""
+		Get sexpr with given structure, creating it if it does not exist yet
+		sexprs are shared between exprs, so addresses of exprs are kept in nodes
+		"""
+		# type literals are never shared, because types are not hashable
+		if op == cls.TYPE_LITERAL:
+			key = None
+		else:
+			key = (op, x, y)
+			if (obj := cls._interned.get(key)) is not None:
+				return obj
+
+		obj = cls(op)
+		obj._x = x
+		obj._y = y
+		if key is not None:
+			obj._key = key
+			obj._hash = hash(key)
+			cls._interned[key] = obj
+		return obj
+
+	def __eq__(self, __value:object) -> bool:
+		if self is __value:
+			return True
+		if not isinstance(__value, SExpr) or self._key is None:
+			return False
+		return self._key == __value._key
+
+	def __hash__(self) -> int:
+		return self._hash
 
 	def __str__(self) -> str:
 		if self.is_type_literal():
@@ -348,111 +470,92 @@ class SExpr:
 		else:
 			return ""
 
-	def extract_var_use_chains(self) -> set[VarUseChain]:
-		rv = set()
+	def extract_var_use_chains(self) -> frozenset[VarUseChain]:
+		""" Var use chains anywhere in sexpr, computed once, because sexprs are not changed after lifting """
+		if self._var_use_chains is not None:
+			return self._var_use_chains
+
 		if isinstance(self._x, VarUseChain):
-			rv.add(self._x)
+			x_vucs = frozenset((self._x,))
 		elif isinstance(self._x, SExpr):
-			rv.update(self._x.extract_var_use_chains())
+			x_vucs = self._x.extract_var_use_chains()
+		else:
+			x_vucs = frozenset()
+
 		if isinstance(self._y, SExpr):
-			rv.update(self._y.extract_var_use_chains())
+			y_vucs = self._y.extract_var_use_chains()
+		else:
+			y_vucs = frozenset()
+
+		# reusing child set instead of copying it, when possible
+		if len(y_vucs) == 0:
+			rv = x_vucs
+		elif len(x_vucs) == 0:
+			rv = y_vucs
+		else:
+			rv = x_vucs | y_vucs
+		self._var_use_chains = rv
 		return rv
 
-	def extract_vars(self) -> set[Var]:
-		return {vuc.var for vuc in self.extract_var_use_chains()}
+	def extract_vars(self) -> frozenset[Var]:
+		if self._vars is None:
+			self._vars = frozenset(vuc.var for vuc in self.extract_var_use_chains())
+		return self._vars
 
-	@classmethod
-	def create_var_use_chain(cls, vuc:VarUseChain, addr=-1):
-		obj = cls(cls.TYPE_VAR_USE_CHAIN, addr=addr)
-		obj._x = vuc
-		return obj
+	def mentions(self, var:Var) -> bool:
+		return var in self.extract_vars()
 
 	@classmethod
-	def create_function(cls, call_ea:int, addr=-1):
-		obj = cls(cls.TYPE_FUNCTION, addr=addr)
-		obj._x = call_ea
-		return obj
+	def create_var_use_chain(cls, vuc:VarUseChain):
+		return cls.make(cls.TYPE_VAR_USE_CHAIN, vuc)
 
 	@classmethod
-	def create_call(cls, function:SExpr, addr=-1):
-		obj = cls(cls.TYPE_CALL, addr=addr)
-		obj._x = function
-		return obj
+	def create_function(cls, call_ea:int):
+		return cls.make(cls.TYPE_FUNCTION, call_ea)
 
 	@classmethod
-	def create_bool_op(cls, x:SExpr, y:SExpr, addr=-1):
-		obj = cls(cls.TYPE_BOOL_OP, addr=addr)
-		obj._x = x
-		obj._y = y
-		return obj
+	def create_call(cls, function:SExpr):
+		return cls.make(cls.TYPE_CALL, function)
 
 	@classmethod
-	def create_binary_op(cls, x:SExpr, y:SExpr, addr=-1):
-		obj = cls(cls.TYPE_BINARY_OP, addr=addr)
-		obj._x = x
-		obj._y = y
-		return obj
+	def create_bool_op(cls, x:SExpr, y:SExpr):
+		return cls.make(cls.TYPE_BOOL_OP, x, y)
 
 	@classmethod
-	def create_type_literal(cls, literal_type:idaapi.tinfo_t, addr=-1):
-		obj = cls(cls.TYPE_LITERAL, addr=addr)
-		obj._x = literal_type
-		return obj
+	def create_binary_op(cls, x:SExpr, y:SExpr):
+		return cls.make(cls.TYPE_BINARY_OP, x, y)
 
 	@classmethod
-	def create_assign(cls, target:SExpr, value:SExpr, addr=-1):
-		obj = cls(cls.TYPE_ASSIGN, addr=addr)
-		obj._x = target
-		obj._y = value
-		return obj
+	def create_type_literal(cls, literal_type:idaapi.tinfo_t):
+		return cls.make(cls.TYPE_LITERAL, literal_type)
 
 	@classmethod
-	def create_rw_op(cls, target:SExpr, value:SExpr, addr=-1):
-		obj = cls(cls.TYPE_RW_OP, addr=addr)
-		obj._x = target
-		obj._y = value
-		return obj
+	def create_assign(cls, target:SExpr, value:SExpr):
+		return cls.make(cls.TYPE_ASSIGN, target, value)
 
 	@classmethod
-	def create_ref(cls, base:SExpr, addr=-1):
-		obj = cls(cls.TYPE_REF, addr=addr)
-		obj._x = base
-		return obj
+	def create_rw_op(cls, target:SExpr, value:SExpr):
+		return cls.make(cls.TYPE_RW_OP, target, value)
 
 	@classmethod
-	def create_ptr(cls, base:SExpr, offset=0, addr=-1):
-		obj = cls(cls.TYPE_PTR, addr=addr)
-		obj._x = base
-		obj._y = offset
-		return obj
+	def create_ref(cls, base:SExpr):
+		return cls.make(cls.TYPE_REF, base)
 
 	@classmethod
-	def create_tern(cls, x:SExpr, y:SExpr, addr=-1):
-		obj = cls(cls.TYPE_TERN, addr=addr)
-		obj._x = x
-		obj._y = y
-		return obj
+	def create_ptr(cls, base:SExpr, offset=0):
+		return cls.make(cls.TYPE_PTR, base, offset)
 
 	@classmethod
-	def create_partial(cls, base:SExpr, offset:int, size:int, addr=-1):
-		obj = cls(cls.TYPE_PARTIAL, addr=addr)
-		obj._x = base
-		obj._y = (offset, size)
-		return obj
+	def create_tern(cls, x:SExpr, y:SExpr):
+		return cls.make(cls.TYPE_TERN, x, y)
 
 	@classmethod
-	def create_combine(cls, x:SExpr, y:SExpr, addr=-1):
-		obj = cls(cls.TYPE_COMBINE, addr=addr)
-		obj._x = x
-		obj._y = y
-		return obj
+	def create_partial(cls, base:SExpr, offset:int, size:int):
+		return cls.make(cls.TYPE_PARTIAL, base, (offset, size))
 
-	@property
-	def func_ea(self) -> int:
-		rv = utils.get_func_start(self.addr)
-		if rv == idaapi.BADADDR:
-			rv = -1
-		return rv
+	@classmethod
+	def create_combine(cls, x:SExpr, y:SExpr):
+		return cls.make(cls.TYPE_COMBINE, x, y)
 
 	@property
 	def var_use_chain(self) -> VarUseChain|None:
@@ -505,7 +608,24 @@ class SExpr:
 		return self._y
 
 
-UNKNOWN_SEXPR = SExpr(-1, -1)
+UNKNOWN_SEXPR = SExpr(-1)
+
+
+class CompactedEdges:
+	"""
+	Edges of nodes in compacted TFGs, they exist only in CSR arrays of TFG graph
+	any access fails, so walking nodes directly does not see empty graph silently
+	"""
+	__slots__ = ()
+
+	def fail(self, *args):
+		raise RuntimeError("node belongs to compacted TFG, its edges are accessible only through TFG")
+
+	__iter__ = __len__ = __contains__ = __bool__ = add = remove = discard = fail
+
+
+# shared by all compacted nodes instead of per-node sets
+COMPACTED_EDGES = CompactedEdges()
 
 
 class Node:
@@ -513,11 +633,16 @@ class Node:
 	EXPR = 1
 	CALL_CAST = 2
 	TYPE_CAST = 3
-	def __init__(self, node_type, sexpr:SExpr, y=None, z=None) -> None:
+
+	__slots__ = ("node_type", "sexpr", "y", "z", "addr", "children", "parents")
+
+	def __init__(self, node_type, sexpr:SExpr, y=None, z=None, addr=-1) -> None:
 		self.node_type = node_type
 		self.sexpr = sexpr
 		self.y = y
 		self.z = z
+		# address of expr, that node is lifted from, -1 if unknown
+		self.addr = addr
 		self.children : set[Node] = set()
 		self.parents : set[Node] = set()
 
@@ -534,21 +659,19 @@ class Node:
 	def is_leaf(self):
 		return len(self.children) == 0
 
-	def copy(self) -> Node:
-		""" Copy node without edges """
-		return Node(self.node_type, self.sexpr, self.y, self.z)
-
 	def iterate_children(self):
-		visited_nodes = set()
-		queue = list(self.children)
-		while len(queue) != 0:
-			node = queue.pop(0)
-			if node in visited_nodes:
-				continue
-			visited_nodes.add(node)
-			yield node
+		""" Nodes reachable from node in BFS order, nodes of compacted TFGs must use TFG.iterate_children """
+		graph = CompactGraph.from_entry(self, lambda n: n.children)
+		yield from graph.nodes[1:]
 
-			queue += list(node.children)
+	def max_depth(self) -> int:
+		""" Number of nodes on the longest path to a leaf, nodes of compacted TFGs must use TFG.max_depth """
+		graph = CompactGraph.from_entry(self, lambda n: n.children)
+		return GraphAnalysis(graph).depth[0]
+
+	def copy(self) -> Node:
+		""" Copy node without edges """
+		return Node(self.node_type, self.sexpr, self.y, self.z, self.addr)
 
 	def __str__(self) -> str:
 		if self.node_type == self.EXPR and self.sexpr is UNKNOWN_SEXPR:
@@ -572,17 +695,6 @@ class Node:
 		rv = f"{node_type}Node\n{sexpr_text}"
 		return rv
 
-	def max_depth(self):
-		m = 1
-		for n in self.children:
-			m = max(m, n.max_depth() + 1)
-		return m
-
-	def print_node(self, lvl):
-		print(f"{lvl * ' '}node {str(self)} children_len={len(self.children)}")
-		for c in self.children:
-			c.print_node(lvl + 1)
-
 	def is_return(self):
 		return self.node_type == self.RETURN
 
@@ -607,5 +719,12 @@ class Node:
 	def tif(self) -> idaapi.tinfo_t:
 		return self.y
 
+	@property
+	def func_ea(self) -> int:
+		rv = utils.get_func_start(self.addr)
+		if rv == idaapi.BADADDR:
+			rv = -1
+		return rv
+
 
 NOP_NODE = Node(Node.EXPR, UNKNOWN_SEXPR)
\ No newline at end of file
@@ -4,8 +4,16 @@ import idaapi
 import idc
 import idautils
 import re
+import time
+import hashlib
+from typing import Iterable
+
+from pyphrank.util_log import log_debug
 
 def is_func_start(addr:int) -> bool:
+	return FUNC_ATTRS.get(addr).is_func_start
+
+def calc_is_func_start(addr:int) -> bool:
 	if addr == idaapi.BADADDR:
 		return False
 
@@ -63,6 +71,9 @@ def get_single_block_func_instructions(func_ea:int) -> list[int]:
 	return rv
 
 def get_trampoline_func_target(func_ea:int) -> int:
+	return FUNC_ATTRS.get(func_ea).trampoline_target
+
+def calc_trampoline_func_target(func_ea:int) -> int:
 	instrs = get_single_block_func_instructions(func_ea)
 	if len(instrs) != 1:
 		return -1
@@ -88,14 +99,7 @@ def get_trampoline_func_target(func_ea:int) -> int:
 	return -1
 
 def is_func_import(func_ea:int) -> bool:
-	if is_import_addr(func_ea):
-		return True
-
-	tramp_target = get_trampoline_func_target(func_ea)
-	if tramp_target != -1:
-		return is_func_import(tramp_target)
-
-	return False
+	return FUNC_ATTRS.get(func_ea).is_import
 
 def is_import_addr(addr:int) -> bool:
 	if idc.get_segm_name(addr) in (".idata", ".plt"):
@@ -108,6 +112,9 @@ def iterate_all_functions():
 			yield funcea
 
 def is_movrax_ret(func_ea:int) -> bool:
+	return FUNC_ATTRS.get(func_ea).is_movrax_ret
+
+def calc_is_movrax_ret(func_ea:int) -> bool:
 	instrs = get_single_block_func_instructions(func_ea)
 	if len(instrs) != 2:
 		return False
@@ -125,6 +132,92 @@ def is_movrax_ret(func_ea:int) -> bool:
 		return False
 	return True
 
+
+class FuncAttrs:
+	""" Attributes of address, that are checked for every object referenced in ctree """
+	__slots__ = ("is_func_start", "is_import", "trampoline_target", "is_movrax_ret")
+
+	def __init__(self, is_func_start:bool, is_import:bool, trampoline_target:int, is_movrax_ret:bool):
+		self.is_func_start = is_func_start
+		self.is_import = is_import
+		self.trampoline_target = trampoline_target
+		self.is_movrax_ret = is_movrax_ret
+
+
+class FuncAttrsTable:
+	"""
+	Attributes of functions and imports, computed once per session in a single pass
+	other addresses, e.g. globals, get their attributes on first request
+	IDB hooks drop changed addresses, so they are computed again on next request
+	"""
+	def __init__(self):
+		self.attrs : dict[int, FuncAttrs] = {}
+		# trampolines by their targets
+		self.trampolines : dict[int, set[int]] = {}
+		# addresses added on request after building, e.g. globals, that might become functions later
+		self.lazy_addrs : set[int] = set()
+		self.is_built = False
+
+	def build(self):
+		self.is_built = True
+		for func_ea in iterate_all_functions():
+			if func_ea not in self.attrs:
+				self.calc(func_ea)
+
+		for segea in idautils.Segments():
+			if not is_import_addr(segea):
+				continue
+			for ea in idautils.Heads(segea, idc.get_segm_end(segea)):
+				if ea not in self.attrs:
+					self.calc(ea)
+
+	def get(self, addr:int) -> FuncAttrs:
+		if not self.is_built:
+			self.build()
+
+		attrs = self.attrs.get(addr)
+		if attrs is None:
+			attrs = self.calc(addr)
+			self.lazy_addrs.add(addr)
+		return attrs
+
+	def calc(self, addr:int) -> FuncAttrs:
+		trampoline_target = calc_trampoline_func_target(addr)
+		is_import = is_import_addr(addr)
+		attrs = FuncAttrs(calc_is_func_start(addr), is_import, trampoline_target, calc_is_movrax_ret(addr))
+		# added before following trampoline, so cycles of trampolines end
+		self.attrs[addr] = attrs
+		if trampoline_target != -1:
+			self.trampolines.setdefault(trampoline_target, set()).add(addr)
+			if not is_import:
+				attrs.is_import = self.get(trampoline_target).is_import
+		return attrs
+
+	def invalidate(self, addr:int):
+		""" drops address and trampolines to it, even if address itself is not in table """
+		attrs = self.attrs.pop(addr, None)
+		self.lazy_addrs.discard(addr)
+		if attrs is not None and (target_trampolines := self.trampolines.get(attrs.trampoline_target)) is not None:
+			target_trampolines.discard(addr)
+		for ea in self.trampolines.pop(addr, ()):
+			self.invalidate(ea)
+
+	def invalidate_range(self, start_ea:int, end_ea:int):
+		""" drops start and lazily added addresses in range, e.g. when function is created over them """
+		self.invalidate(start_ea)
+		for addr in [a for a in self.lazy_addrs if start_ea <= a < end_ea]:
+			self.invalidate(addr)
+
+	def clear(self):
+		self.attrs.clear()
+		self.trampolines.clear()
+		self.lazy_addrs.clear()
+		self.is_built = False
+
+
+FUNC_ATTRS = FuncAttrsTable()
+
+
 def is_cfunc_bugged(cfunc:idaapi.cfunc_t) -> bool:
 	# IDA can mess up variables order, need to decompile once more
 	for i, arg in enumerate(cfunc.arguments):
@@ -132,23 +225,116 @@ def is_cfunc_bugged(cfunc:idaapi.cfunc_t) -> bool:
 			return True
 	return False
 
-def decompile_function(func_ea:int) -> idaapi.cfunc_t|None:
+class DecompilationStats:
+	""" Time spent by decompilations and by generating their pseudocode text """
+	def __init__(self):
+		self.decompilations = 0
+		self.failures = 0
+		self.retries = 0
+		self.decompile_time = 0.
+		self.text_time = 0.
+
+	def clear(self):
+		self.__init__()
+
+	def __str__(self) -> str:
+		return f"{self.decompilations} decompilations ({self.failures} failed, {self.retries} retried) "\
+			f"in {self.decompile_time:.2f}s, text generation {self.text_time:.2f}s"
+
+DECOMPILATION_STATS = DecompilationStats()
+
+
+# reason of functions, that decompile fine only after dropping their cached cfunc
+CFUNC_BUGGED = "bugged arguments"
+
+def decompile_once(func_ea:int, generate_text:bool) -> tuple[idaapi.cfunc_t|None, str]:
+	"""
+	Decompiles function, generating pseudocode text only if asked
+	decompile returns finalized ctree, text is generated only as a fallback
+	for cfunc, that somehow did not reach final maturity
+	returns cfunc and reason of failure, that is empty on success
+	"""
+	stats = DECOMPILATION_STATS
+	stats.decompilations += 1
+	start = time.perf_counter()
+	reason = ""
 	try:
 		cfunc = idaapi.decompile(func_ea)
-		str(cfunc)
-	except idaapi.DecompilationFailure:
-		return None
+	except idaapi.DecompilationFailure as e:
+		cfunc = None
+		reason = f"decompilation failure {e}"
+	decompile_time = time.perf_counter() - start
+	stats.decompile_time += decompile_time
+	if cfunc is None:
+		stats.failures += 1
+		return None, reason or "decompilation failure"
+
+	text_time = 0.
+	if generate_text or cfunc.maturity != idaapi.CMAT_FINAL:
+		start = time.perf_counter()
+		try:
+			str(cfunc)
+		except idaapi.DecompilationFailure as e:
+			cfunc = None
+			reason = f"text generation failure {e}"
+		text_time = time.perf_counter() - start
+		stats.text_time += text_time
 
+	total_time = decompile_time + text_time
+	text_share = text_time / total_time * 100 if total_time != 0 else 0
+	log_debug(
+		f"decompiled {idaapi.get_name(func_ea)} in {total_time:.3f}s, "\
+		f"text generation {text_time:.3f}s ({text_share:.0f}%)"
+	)
 	if cfunc is None:
-		return None
+		stats.failures += 1
+	return cfunc, reason
+
+def decompile_function(func_ea:int, generate_text:bool=False, known_bugged:bool=False) -> tuple[idaapi.cfunc_t|None, str]:
+	"""
+	Decompiles function, returns cfunc and reason, why function is bad, reason is empty for good ones
+	bugged functions are decompiled again, known bugged ones are decompiled anew right away
+	"""
+	if known_bugged:
+		idaapi.mark_cfunc_dirty(func_ea)
+		return decompile_once(func_ea, generate_text)
 
-	if not is_cfunc_bugged(cfunc):
-		return cfunc
+	cfunc, reason = decompile_once(func_ea, generate_text)
+	if cfunc is None or not is_cfunc_bugged(cfunc):
+		return cfunc, reason
 
+	DECOMPILATION_STATS.retries += 1
 	idaapi.mark_cfunc_dirty(func_ea)
-	try:
-		cfunc = idaapi.decompile(func_ea)
-		str(cfunc)
-	except idaapi.DecompilationFailure:
-		return None
-	return cfunc
\ No newline at end of file
+	cfunc, reason = decompile_once(func_ea, generate_text)
+	if cfunc is None:
+		return None, reason
+	return cfunc, CFUNC_BUGGED
+
+def get_func_fingerprint(func_ea:int, with_lvars=True) -> bytes:
+	"""
+	Hash of what decompilation of function depends on
+	function bytes, its prototype and user lvar settings
+	"""
+	h = hashlib.blake2b(digest_size=16)
+	h.update(str(idaapi.get_hexrays_version()).encode())
+	for start, end in idautils.Chunks(func_ea):
+		h.update(f"{start:x}:{end:x}".encode())
+		h.update(idaapi.get_bytes(start, end - start) or b'')
+
+	h.update((idc.get_type(func_ea) or '').encode())
+	if not with_lvars:
+		return h.digest()
+
+	lvinf = idaapi.lvar_uservec_t()
+	if idaapi.restore_user_lvar_settings(lvinf, func_ea):
+		for lv in lvinf.lvvec:
+			h.update(f"{lv.ll.defea:x}:{lv.name}:{lv.type}:{lv.size}:{lv.flags}".encode())
+		h.update(f"{lvinf.lmaps.size()}:{lvinf.stkoff_delta}:{lvinf.ulv_flags}".encode())
+	return h.digest()
+
+def get_types_fingerprint(eas:Iterable[int]) -> bytes:
+	""" Hash of types of functions and global vars at given addresses """
+	h = hashlib.blake2b(digest_size=16)
+	for ea in sorted(eas):
+		h.update(f"{ea:x}:{idc.get_type(ea) or ''};".encode())
+	return h.digest()
\ No newline at end of file
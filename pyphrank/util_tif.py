@@ -89,6 +89,24 @@ def str2tif(type_str:str) -> idaapi.tinfo_t:
 		return UNKNOWN_TYPE
 	return tinfo
 
+def serialize_tif(tif:idaapi.tinfo_t) -> tuple[bytes,bytes]|None:
+	""" Type and fields strings of tif, that can be stored in IDB """
+	if tif is UNKNOWN_TYPE:
+		return None
+	serialized = tif.serialize()
+	if serialized is None:
+		return None
+	type_str, fields = serialized[0], serialized[1]
+	return bytes(type_str or b''), bytes(fields or b'')
+
+def deserialize_tif(type_str:bytes, fields:bytes) -> idaapi.tinfo_t:
+	tif = idaapi.tinfo_t()
+	if not tif.deserialize(idaapi.get_idati(), type_str, fields):
+		return UNKNOWN_TYPE
+	if not tif.is_correct():
+		return UNKNOWN_TYPE
+	return tif
+
 def get_int_tinfo(size:int=1) -> idaapi.tinfo_t:
 	char_tinfo = idaapi.tinfo_t()
 	if size == 2:
@@ -0,0 +1,158 @@
+"""
+Expression lifting throughput on synthetic ctree snapshot, runs without IDA
+every statement mixes ops, that are common in decompiled code:
+var use chains, member accesses, arithmetics, calls and helper calls
+deep member chains, e.g. v->a->b->c, show cost of finding their var use chains
+long comma chains are nested deeper, than python recursion limit allows
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyphrank.snapshot_lifter import *
+
+
+def create_snapshot(statements:int) -> CTreeSnapshot:
+	snapshot = CTreeSnapshot(0x1000)
+	snapshot.int_type = 0
+	exprs = snapshot.exprs
+	instrs = snapshot.instrs
+
+	def add_expr(op, x=-1, y=-1, z=-1, extra=None) -> int:
+		exprs.append((op, 0x1000 + len(exprs), x, y, z, 0, extra))
+		return len(exprs) - 1
+
+	def add_instr(op, extra) -> int:
+		instrs.append((op, 0x1000 + len(instrs), extra))
+		return len(instrs) - 1
+
+	def var(i:int) -> int:
+		return add_expr(cot_var, extra=i % 16)
+
+	def num(n:int) -> int:
+		return add_expr(cot_num, extra=n)
+
+	block = []
+	for i in range(statements):
+		kind = i % 5
+		if kind == 0:
+			# v_i->field = v_j + 1
+			target = add_expr(cot_memptr, var(i), extra=8 * (i % 4))
+			value = add_expr(cot_add, var(i + 1), num(1), extra=None)
+		elif kind == 1:
+			# v_i = func(v_j, *(v_k + 16))
+			target = var(i)
+			func = add_expr(cot_obj, extra=(0x2000, True, False))
+			arg0 = add_expr(cot_cast, var(i + 1))
+			arg1 = add_expr(cot_ptr, add_expr(cot_add, var(i + 2), num(16), extra=1))
+			value = add_expr(cot_call, func, extra=(CALL_REGULAR, (arg0, arg1)))
+		elif kind == 2:
+			# v_i = LODWORD(v_j) * v_k
+			target = var(i)
+			helper = add_expr(cot_helper, extra=("LODWORD", False))
+			partial = add_expr(cot_call, helper, extra=(CALL_HELPER, (var(i + 1),), HELPER_PARTIAL, 0, 0, 4))
+			value = add_expr(cot_mul, partial, var(i + 2))
+		elif kind == 3:
+			# v_i = v_j[v_k] != 0 ? v_l : global
+			target = var(i)
+			elem = add_expr(cot_idx, var(i + 1), var(i + 2), extra=(8, True))
+			cond = add_expr(cot_ne, elem, num(0))
+			glob = add_expr(cot_obj, extra=(0x3000, False, False))
+			value = add_expr(cot_tern, cond, var(i + 3), glob)
+		else:
+			# v_i->field.inner += v_j
+			target = add_expr(cot_memref, add_expr(cot_memptr, var(i), extra=16), extra=(4, False))
+			value = var(i + 1)
+			block.append(add_instr(cit_expr, add_expr(cot_asgadd, target, value)))
+			continue
+
+		block.append(add_instr(cit_expr, add_expr(cot_asg, target, value)))
+
+	snapshot.body = add_instr(cit_block, block)
+	return snapshot
+
+
+def create_chain_snapshot(statements:int, depth:int) -> CTreeSnapshot:
+	snapshot = CTreeSnapshot(0x1000)
+	snapshot.int_type = 0
+	exprs = snapshot.exprs
+	instrs = snapshot.instrs
+	block = []
+	for i in range(statements):
+		# v_i->field->field...->field = 0
+		exprs.append((cot_var, 0x1000, -1, -1, -1, 0, i % 16))
+		for _ in range(depth):
+			exprs.append((cot_memptr, 0x1000, len(exprs) - 1, -1, -1, 0, 8))
+		target = len(exprs) - 1
+		exprs.append((cot_num, 0x1000, -1, -1, -1, 0, 0))
+		exprs.append((cot_asg, 0x1000, target, len(exprs) - 1, -1, 0, None))
+		instrs.append((cit_expr, 0x1000, len(exprs) - 1))
+		block.append(len(instrs) - 1)
+	instrs.append((cit_block, 0x1000, block))
+	snapshot.body = len(instrs) - 1
+	return snapshot
+
+
+def create_comma_snapshot(length:int) -> CTreeSnapshot:
+	snapshot = CTreeSnapshot(0x1000)
+	snapshot.int_type = 0
+	exprs = snapshot.exprs
+	# (v_0 = 0, (v_1 = 1, (... , v_n)))
+	exprs.append((cot_var, 0x1000, -1, -1, -1, 0, length % 16))
+	for i in range(length - 1, -1, -1):
+		exprs.append((cot_var, 0x1000, -1, -1, -1, 0, i % 16))
+		exprs.append((cot_num, 0x1000, -1, -1, -1, 0, i))
+		exprs.append((cot_asg, 0x1000, len(exprs) - 2, len(exprs) - 1, -1, 0, None))
+		exprs.append((cot_comma, 0x1000, len(exprs) - 1, len(exprs) - 4, -1, 0, None))
+	snapshot.instrs.append((cit_expr, 0x1000, len(exprs) - 1))
+	snapshot.instrs.append((cit_block, 0x1000, [0]))
+	snapshot.body = 1
+	return snapshot
+
+
+def measure(snapshot:CTreeSnapshot, repeats:int) -> float:
+	best = None
+	for _ in range(repeats):
+		start = time.perf_counter()
+		lifter = SnapshotLifter(snapshot)
+		for instr in snapshot.instrs[snapshot.body][2]:
+			lifter.lift_cexpr(snapshot.instrs[instr][2])
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def main():
+	for statements in (1000, 10000, 50000):
+		snapshot = create_snapshot(statements)
+		elapsed = measure(snapshot, 5)
+		exprs_count = len(snapshot.exprs)
+		print(
+			f"{statements} statements, {exprs_count} expressions: "\
+			f"{elapsed:.3f}s, {exprs_count / elapsed:.0f} expressions/s"
+		)
+
+	for depth in (8, 32, 128):
+		snapshot = create_chain_snapshot(1000, depth)
+		elapsed = measure(snapshot, 3)
+		exprs_count = len(snapshot.exprs)
+		print(
+			f"1000 chains of depth {depth}, {exprs_count} expressions: "\
+			f"{elapsed:.3f}s, {exprs_count / elapsed:.0f} expressions/s"
+		)
+
+	for length in (1000, 10000, 50000):
+		snapshot = create_comma_snapshot(length)
+		elapsed = measure(snapshot, 1)
+		exprs_count = len(snapshot.exprs)
+		print(
+			f"comma chain of length {length}, {exprs_count} expressions: "\
+			f"{elapsed:.3f}s, {exprs_count / elapsed:.0f} expressions/s"
+		)
+
+
+if __name__ == "__main__":
+	main()
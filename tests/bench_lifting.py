@@ -0,0 +1,99 @@
+"""
+Lifting benchmark on synthetic ctree snapshot, runs without IDA
+function consists of nested ifs, every one of them starts with the next nested if
+followed by a block of statements, so every chaining used to traverse all nested ifs
+"""
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyphrank.snapshot_lifter import *
+
+
+def create_snapshot(depth:int, statements_per_level:int) -> CTreeSnapshot:
+	snapshot = CTreeSnapshot(0x1000)
+	snapshot.int_type = 0
+	exprs = snapshot.exprs
+	instrs = snapshot.instrs
+
+	def add_expr(op, x=-1, y=-1, extra=None) -> int:
+		exprs.append((op, 0x1000 + len(exprs), x, y, -1, 0, extra))
+		return len(exprs) - 1
+
+	def add_instr(op, extra) -> int:
+		instrs.append((op, 0x1000 + len(instrs), extra))
+		return len(instrs) - 1
+
+	nested_if = -1
+	for level in range(depth):
+		block = []
+		if nested_if != -1:
+			block.append(nested_if)
+		for i in range(statements_per_level):
+			# v_i = v_j + 1
+			target = add_expr(cot_var, extra=i % 16)
+			value = add_expr(cot_add, add_expr(cot_var, extra=(i + level) % 16), add_expr(cot_num, extra=1))
+			block.append(add_instr(cit_expr, add_expr(cot_asg, target, value)))
+
+		body = add_instr(cit_block, block)
+		cond = add_expr(cot_ne, add_expr(cot_var, extra=level % 16), add_expr(cot_num, extra=0))
+		nested_if = add_instr(cit_if, (cond, body, -1))
+
+	snapshot.body = add_instr(cit_block, [nested_if])
+	return snapshot
+
+
+class RescanningLifter(SnapshotLifter):
+	""" Finds exits by traversing fragments again, like lifting did before exits were kept """
+	def iterate_exit_nodes(self, node:int):
+		if len(self.children[node]) == 0 and self.node_types[node] != NODE_RETURN:
+			yield node
+			return
+
+		visited = set(self.children[node])
+		queue = deque(self.children[node])
+		while len(queue) != 0:
+			node = queue.popleft()
+			if len(self.children[node]) == 0 and self.node_types[node] != NODE_RETURN:
+				yield node
+			for child in self.children[node]:
+				if child in visited:
+					continue
+				visited.add(child)
+				queue.append(child)
+
+	def chain_fragments(self, *fragments:tuple[int, list[int]]) -> list[int]:
+		for i in range(len(fragments) - 1):
+			child = fragments[i + 1][0]
+			for exit in list(self.iterate_exit_nodes(fragments[i][0])):
+				self.chain_nodes(exit, child)
+		return list(self.iterate_exit_nodes(fragments[0][0]))
+
+
+def measure(lifter_class, snapshot:CTreeSnapshot) -> tuple[float, int]:
+	lifter = lifter_class(snapshot)
+	start = time.perf_counter()
+	lifter.lift_instr(snapshot.body)
+	return time.perf_counter() - start, len(lifter.node_types)
+
+
+def main():
+	statements_per_level = 100
+	for depth in (25, 50, 100, 200):
+		snapshot = create_snapshot(depth, statements_per_level)
+		fragments_time, fragments_nodes = measure(SnapshotLifter, snapshot)
+		rescanning_time, rescanning_nodes = measure(RescanningLifter, snapshot)
+		assert fragments_nodes == rescanning_nodes
+		print(
+			f"{depth * statements_per_level} statements: "\
+			f"kept exits {fragments_time:.2f}s, "\
+			f"rescanned exits {rescanning_time:.2f}s, "\
+			f"{fragments_nodes} nodes"
+		)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,16 @@
+import phrank
+
+
+def main():
+	phrank.set_log_debug()
+	phrank.settings.LIFTING_WORKERS = 4
+	ta = phrank.TypeAnalyzer()
+	try:
+		ta.lift_functions(phrank.iterate_all_functions())
+	finally:
+		ta.lifting_pipeline.shutdown()
+
+
+# lifting workers are spawned and import main module again, they must not lift anything
+if __name__ == "__main__":
+	main()
@@ -1,7 +1,15 @@
 import idaapi
 import idc
 import phrank
+import pyphrank.snapshot_lifter as snapshot_lifter
+from pyphrank.snapshot_lifter import CTreeSnapshot, lift_snapshot
+from pyphrank.tfg_storage import TFGDecoder, serialize_tfg, deserialize_tfg
+from pyphrank.compact_graph import CompactGraph
+from pyphrank.graph_analysis import GraphAnalysis
+from array import array
 import time
+import marshal
+import zlib
 import os
 import sys
 
@@ -9,18 +17,22 @@ from typing import Callable
 
 
 def make_ptr_write(offset, value=None):
-	target = phrank.SExpr.create_var_use_chain(-1, phrank.VarUseChain(phrank.Var(0x123456, 0), phrank.VarUse(offset, phrank.VarUse.VAR_PTR)))
+	target = phrank.SExpr.create_var_use_chain(phrank.VarUseChain(phrank.Var(0x123456, 0), phrank.VarUse(offset, phrank.VarUse.VAR_PTR)))
 	if value is None:
-		value = phrank.SExpr.create_type_literal(-1, 0, phrank.str2tif("int"))
-	return phrank.SExpr.create_assign(-1, target, value)
+		value = phrank.SExpr.create_type_literal(phrank.str2tif("int"))
+	return phrank.Node(phrank.Node.EXPR, phrank.SExpr.create_assign(target, value))
+
+def make_ptr_writes_tfg() -> phrank.TFG:
+	""" TFG of two int writes to offsets 0 and 4 """
+	write0 = make_ptr_write(0)
+	write4 = make_ptr_write(4)
+	return phrank.TFG.from_children(write0, {write0: [write4]})
 
 def test_basic_struct_creation() -> bool:
 	"""testing creating new struct with two int assigns"""
-	var_uses = phrank.VarUses()
-	var_uses.writes.append(make_ptr_write(0))
-	var_uses.writes.append(make_ptr_write(4))
+	var = phrank.Var(0x123456, 0)
 	sa = phrank.TypeAnalyzer()
-	if sa.is_var_possible_ptr(var_uses):
+	if sa.is_var_possible_ptr(var, make_ptr_writes_tfg()):
 		rv = True
 	else:
 		rv = False
@@ -29,13 +41,11 @@ def test_basic_struct_creation() -> bool:
 
 def test_basic_struct_content() -> bool:
 	"""testing creating struct fields with two int assigns"""
-	var_uses = phrank.VarUses()
-	var_uses.writes.append(make_ptr_write(0))
-	var_uses.writes.append(make_ptr_write(4))
+	var = phrank.Var(0x123456, 0)
 	struc = phrank.Structure.new()
 	sa = phrank.TypeAnalyzer()
 	sa.container_manager.add_struct(struc)
-	sa.add_type_uses_to_var(var_uses, struc.ptr_tinfo)
+	sa.add_type_uses_to_var(var, make_ptr_writes_tfg(), struc.ptr_tinfo)
 	if struc.size != 8:
 		sa.container_manager.delete_containers()
 		return False
@@ -44,17 +54,262 @@ def test_basic_struct_content() -> bool:
 
 def test_var_uses_collection() -> bool:
 	var = phrank.Var(0x123456, 0)
-	mock_analysis = phrank.TFG(phrank.ASTCtx(0x123456))
-	mock_analysis.assigns.append(make_ptr_write(0))
+	write = make_ptr_write(0)
+	mock_analysis = phrank.TFG.from_children(write, {})
 
 	ta = phrank.TypeAnalyzer()
-	ta.cache_tfg(0x123456, mock_analysis)
+	ta.cache_tfg(0x123456, mock_analysis, b"")
 	vu = ta.get_all_var_uses(var)
-	if len(vu) != 1:
+	if len(list(vu.iterate_var_writes(var))) != 1:
 		return False
 	else:
 		return True
 
+def test_func_attrs_invalidation() -> bool:
+	"""testing dropping trampolines to uncached target and lazily added addresses, that became a function"""
+	table = phrank.FuncAttrsTable()
+	# filled by hand instead of building from IDB
+	table.is_built = True
+	table.attrs[0x2000] = phrank.FuncAttrs(True, False, 0x1000, False)
+	table.trampolines[0x1000] = {0x2000}
+	table.attrs[0x3010] = phrank.FuncAttrs(False, False, -1, False)
+	table.lazy_addrs.add(0x3010)
+	table.attrs[0x4000] = phrank.FuncAttrs(False, False, -1, False)
+	table.lazy_addrs.add(0x4000)
+
+	table.invalidate(0x1000)
+	if 0x2000 in table.attrs or 0x1000 in table.trampolines:
+		return False
+
+	table.invalidate_range(0x3000, 0x3100)
+	return 0x3010 not in table.attrs and 0x4000 in table.attrs
+
+def test_compact_graph_csr_roundtrip() -> bool:
+	"""testing, that graph restored from its saved CSR arrays has the same nodes and edges in both directions"""
+	children = {"a": ["b", "c"], "b": ["c"], "c": ["a"]}
+	graph = CompactGraph.from_entry("a", lambda n: children.get(n, ()))
+	offsets = array('i')
+	offsets.frombytes(graph.child_offsets.tobytes())
+	targets = array('i')
+	targets.frombytes(graph.child_targets.tobytes())
+	restored = CompactGraph.from_csr(list(graph.nodes), offsets, targets)
+	if restored.nodes != graph.nodes or list(restored.iterate_edges()) != list(graph.iterate_edges()):
+		return False
+	if any(list(restored.parents(i)) != list(graph.parents(i)) for i in range(len(graph))):
+		return False
+	if [restored.nodes[i] for i in restored.parents(0)] != ["c"]:
+		return False
+
+	try:
+		CompactGraph.from_csr(graph.nodes[:-1], offsets, targets)
+	except ValueError:
+		return True
+	return False
+
+def test_compacted_node_edges() -> bool:
+	"""testing, that nodes walk their edges until TFG is compacted and fail loudly after that"""
+	var = phrank.Var(0x1000, 1)
+	move = make_move(var, 0x2000)
+	ret = make_return(var)
+	move.children.add(ret)
+	ret.parents.add(move)
+	tfg = phrank.TFG(move)
+	if list(move.iterate_children()) != [ret] or move.max_depth() != 2:
+		return False
+
+	tfg.compact()
+	if list(tfg.iterate_children(move)) != [ret] or tfg.max_depth() != 2:
+		return False
+	try:
+		list(move.iterate_children())
+	except RuntimeError:
+		return True
+	return False
+
+def test_graph_analysis_orders() -> bool:
+	"""testing reverse postorder, loop components and depth of graph with loop in the middle"""
+	children = {0: [1, 3], 1: [2], 2: [1, 3]}
+	graph = CompactGraph.from_entry(0, lambda n: children.get(n, ()))
+	analysis = GraphAnalysis(graph)
+	if [graph.nodes[i] for i in analysis.rpo] != [0, 1, 2, 3]:
+		return False
+
+	sccs = [{graph.nodes[i] for i in component} for component in analysis.sccs]
+	if sccs != [{0}, {1, 2}, {3}]:
+		return False
+	if [analysis.is_loop(scc_id) for scc_id in range(len(sccs))] != [False, True, False]:
+		return False
+	return [analysis.depth[graph.get_id(n)] for n in range(4)] == [3, 2, 2, 1]
+
+def test_graph_analysis_dominators() -> bool:
+	"""testing immediate dominators and dominance of diamond followed by loop"""
+	children = {0: [1, 2], 1: [3], 2: [3], 3: [4], 4: [3]}
+	graph = CompactGraph.from_entry(0, lambda n: children.get(n, ()))
+	analysis = GraphAnalysis(graph)
+	idoms = [graph.nodes[analysis.idom[graph.get_id(n)]] for n in range(5)]
+	if idoms != [0, 0, 0, 0, 3]:
+		return False
+
+	def dominates(dominator:int, node:int) -> bool:
+		return analysis.dominates(graph.get_id(dominator), graph.get_id(node))
+	return dominates(0, 4) and dominates(3, 4) and dominates(4, 4) and not dominates(1, 3) and not dominates(4, 3)
+
+def make_move_snapshot() -> CTreeSnapshot:
+	""" snapshot of "v1 = v0; return v1;" in function at 0x1000 """
+	snapshot = CTreeSnapshot(0x1000)
+	snapshot.exprs = [
+		(snapshot_lifter.cot_var, 0x1010, -1, -1, -1, -1, 0),
+		(snapshot_lifter.cot_var, 0x1010, -1, -1, -1, -1, 1),
+		(snapshot_lifter.cot_asg, 0x1010, 1, 0, -1, -1, None),
+		(snapshot_lifter.cot_var, 0x1020, -1, -1, -1, -1, 1),
+	]
+	snapshot.instrs = [
+		(snapshot_lifter.cit_expr, 0x1010, 2),
+		(snapshot_lifter.cit_return, 0x1020, 3),
+		(snapshot_lifter.cit_block, 0x1010, (0, 1)),
+	]
+	snapshot.body = 2
+	return snapshot
+
+def test_snapshot_lifting() -> bool:
+	"""testing lifting of hand-built snapshot into shrunk TFG with move and return"""
+	payload, _ = lift_snapshot(make_move_snapshot())
+	tfg = TFGDecoder(payload, []).decode()
+	v0 = phrank.Var(0x1000, 0)
+	v1 = phrank.Var(0x1000, 1)
+	entry = tfg.entry
+	if len(tfg.graph) != 2 or not entry.is_expr() or not entry.sexpr.is_move_to_var(v1):
+		return False
+	if not entry.sexpr.value.is_var(v0):
+		return False
+	children = [tfg.graph.nodes[c] for c in tfg.graph.children(0)]
+	return len(children) == 1 and children[0].is_return() and children[0].sexpr.is_var(v1)
+
+def test_snapshot_partial_lifting() -> bool:
+	"""testing, that partial lifting skips exprs without vars of interest"""
+	payload, _ = lift_snapshot(make_move_snapshot(), frozenset(((0x1000, 2),)))
+	tfg = TFGDecoder(payload, []).decode()
+	# only return node is left after shrinking
+	return len(tfg.graph) == 1 and tfg.entry.is_return()
+
+def test_snapshot_lifting_deep_comma() -> bool:
+	"""testing lifting of comma chain, that is deeper than python recursion limit"""
+	snapshot = CTreeSnapshot(0x1000)
+	snapshot.exprs.append((snapshot_lifter.cot_var, 0x1010, -1, -1, -1, -1, 0))
+	depth = sys.getrecursionlimit() * 2
+	for i in range(depth):
+		snapshot.exprs.append((snapshot_lifter.cot_var, 0x1010, -1, -1, -1, -1, 1 + i % 3))
+		snapshot.exprs.append((snapshot_lifter.cot_var, 0x1010, -1, -1, -1, -1, 0))
+		snapshot.exprs.append((snapshot_lifter.cot_asg, 0x1010, len(snapshot.exprs) - 2, len(snapshot.exprs) - 1, -1, -1, None))
+		snapshot.exprs.append((snapshot_lifter.cot_comma, 0x1010, len(snapshot.exprs) - 1, len(snapshot.exprs) - 4, -1, -1, None))
+	snapshot.instrs.append((snapshot_lifter.cit_expr, 0x1010, len(snapshot.exprs) - 1))
+	snapshot.body = 0
+	payload, _ = lift_snapshot(snapshot)
+	tfg = TFGDecoder(payload, []).decode()
+	return len(tfg.graph) == depth and tfg.max_depth() == depth
+
+def make_move(var:phrank.Var, func_ea:int) -> phrank.Node:
+	""" node of "var = func()" """
+	target = phrank.SExpr.create_var_use_chain(phrank.VarUseChain(var))
+	value = phrank.SExpr.create_call(phrank.SExpr.create_function(func_ea))
+	return phrank.Node(phrank.Node.EXPR, phrank.SExpr.create_assign(target, value))
+
+def make_return(var:phrank.Var) -> phrank.Node:
+	return phrank.Node(phrank.Node.RETURN, phrank.SExpr.create_var_use_chain(phrank.VarUseChain(var)))
+
+def test_dataflow_kill() -> bool:
+	"""testing, that move to var is killed by next move to var"""
+	var = phrank.Var(0x1000, 1)
+	first = make_move(var, 0x2000)
+	second = make_move(var, 0x3000)
+	ret = make_return(var)
+	tfg = phrank.TFG.from_children(first, {first: [second], second: [ret]})
+	graph = tfg.graph
+	definitions = tfg.dataflow.reaching_definitions.get_definitions(graph.get_id(ret), var)
+	if definitions != [graph.get_id(second)]:
+		return False
+	# moves query stays flow-insensitive
+	return list(tfg.iterate_moves_to(var)) == [first.sexpr.value, second.sexpr.value]
+
+def test_dataflow_loop() -> bool:
+	"""testing, that moves to var in loop reach nodes before them"""
+	var = phrank.Var(0x1000, 1)
+	first = make_move(var, 0x2000)
+	ret = make_return(var)
+	second = make_move(var, 0x3000)
+	tfg = phrank.TFG.from_children(first, {first: [ret], ret: [second], second: [ret]})
+	graph = tfg.graph
+	definitions = tfg.dataflow.reaching_definitions.get_definitions(graph.get_id(ret), var)
+	return definitions == [graph.get_id(first), graph.get_id(second)]
+
+def test_dataflow_arg_entry() -> bool:
+	"""testing, that argument holds its entry value only until it is overwritten"""
+	arg = phrank.Var(0x1000, 0)
+	target = phrank.SExpr.create_var_use_chain(phrank.VarUseChain(arg, phrank.VarUse(0, phrank.VarUse.VAR_PTR)))
+	value = phrank.SExpr.create_type_literal(phrank.str2tif("int"))
+	write = phrank.Node(phrank.Node.EXPR, phrank.SExpr.create_assign(target, value))
+	move = make_move(arg, 0x2000)
+	overwritten = phrank.TFG.from_children(move, {move: [write]})
+	if overwritten.dataflow.pointer_sources.may_hold(overwritten.graph.get_id(write), arg, arg):
+		return False
+
+	# write is reached both with and without move
+	entry = phrank.NOP_NODE.copy()
+	branched = phrank.TFG.from_children(entry, {entry: [move, write], move: [write]})
+	sources = branched.dataflow.pointer_sources.get_sources(branched.graph.get_id(write), arg)
+	return len(sources) == 2 and any(s is arg for s in sources) and any(s is move.sexpr.value for s in sources)
+
+def test_tfg_payload_roundtrip() -> bool:
+	"""testing, that saved TFG is restored with the same nodes, and is rejected with other fingerprint or format version"""
+	var = phrank.Var(0x1000, 1)
+	move = make_move(var, 0x2000)
+	move.addr = 0x1010
+	ret = make_return(var)
+	ret.addr = 0x1020
+	tfg = phrank.TFG.from_children(move, {move: [ret, move]})
+	fingerprint = b"fingerprint"
+	data = serialize_tfg(tfg, fingerprint)
+	restored = deserialize_tfg(data, fingerprint)
+	if restored is None or list(restored.graph.iterate_edges()) != list(tfg.graph.iterate_edges()):
+		return False
+	for node, restored_node in zip(tfg.graph.nodes, restored.graph.nodes):
+		# sexprs are hash-consed, so restored ones are the same objects
+		if node.node_type != restored_node.node_type or node.sexpr is not restored_node.sexpr or node.addr != restored_node.addr:
+			return False
+
+	if deserialize_tfg(data, b"other") is not None:
+		return False
+	payload = list(marshal.loads(zlib.decompress(data)))
+	payload[0] -= 1
+	old_data = zlib.compress(marshal.dumps(tuple(payload), 4))
+	return deserialize_tfg(old_data, fingerprint) is None
+
+class MockCFunc:
+	def __init__(self, entry_ea:int):
+		self.entry_ea = entry_ea
+
+def test_cfunc_cache_eviction() -> bool:
+	"""testing, that least recently used cfuncs are evicted first and pinned ones are kept"""
+	max_entries, max_bytes = phrank.settings.CFUNC_CACHE_MAX_ENTRIES, phrank.settings.CFUNC_CACHE_MAX_BYTES
+	phrank.settings.CFUNC_CACHE_MAX_ENTRIES = 2
+	phrank.settings.CFUNC_CACHE_MAX_BYTES = 0
+	try:
+		factory = phrank.CFunctionFactory()
+		factory.pin(0x10)
+		for func_ea in (0x10, 0x20, 0x30):
+			factory.set_cfunc(MockCFunc(func_ea))
+		if list(factory.cached_cfuncs) != [0x10, 0x30]:
+			return False
+
+		# pinned cfunc becomes least recently used one after unpinning
+		factory.get_cfunc(0x30)
+		factory.unpin_all()
+		factory.set_cfunc(MockCFunc(0x40))
+		return list(factory.cached_cfuncs) == [0x30, 0x40] and factory.stats.evictions == 2
+	finally:
+		phrank.settings.CFUNC_CACHE_MAX_ENTRIES = max_entries
+		phrank.settings.CFUNC_CACHE_MAX_BYTES = max_bytes
+
 def run_test(test_func:Callable[[], bool]):
 	code = test_func.__code__
 	func_descr = f"{os.path.basename(code.co_filename)}/{test_func.__name__}@{code.co_firstlineno}"